@@ -3,14 +3,55 @@ import torch
 import time
 
 
+class CGWorkspace:
+    """Preallocated buffers for cg_batch(..., workspace=workspace).
+    A set of buffers is allocated for each shape, dtype and device of the
+    right hand sides and reused by every later call with the same ones, and
+    the iterations update them in place. The solution and the per-system
+    tensors in info returned by such a call are buffers of the workspace:
+    they are overwritten by the next call with the same shape.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self.n_allocations = 0
+
+    def buffers(self, B):
+        key = (tuple(B.shape), B.dtype, B.device)
+        if key not in self._buffers:
+            K, n, m = B.shape
+            buffers = {name: torch.empty_like(B)
+                       for name in ('X', 'R', 'P', 'T')}
+            for name in ('alpha', 'beta', 'RZ', 'RZ_old', 'denominator',
+                         'residual', 'stopping'):
+                buffers[name] = B.new_empty(K, m)
+            for name in ('converged', 'active', 'mask'):
+                buffers[name] = torch.empty(K, m, dtype=torch.bool,
+                                            device=B.device)
+            buffers['niters'] = torch.empty(K, m, dtype=torch.long,
+                                            device=B.device)
+            self._buffers[key] = buffers
+            self.n_allocations += 1
+        return self._buffers[key]
+
+
 def cg_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-3, atol=0., maxiter=None,
-             verbose=False):
+             verbose=False, check_every=None, workspace=None, compact=False,
+             AX0=None):
     """Solves a batch of PD matrix linear systems using the preconditioned
     CG algorithm.
     This function solves a batch of matrix linear systems of the form
         A_i X_i = B_i,  i=1,...,K,
     where A_i is a n x n positive definite matrix and B_i is a n x m matrix,
     and X_i is the n x m matrix representing the solution for the ith system.
+    Each iteration takes one call of A_bmm: convergence is checked on the
+    recursively updated residual, which is replaced by the true residual
+    B - A X (one more call of A_bmm) every check_every iterations. Systems
+    (columns) that have converged are no longer updated, but by default
+    A_bmm still runs on the whole batch, so this does not reduce the cost of
+    an iteration. With compact=True, A_bmm only runs on the systems with an
+    active column. This requires that the systems are independent, which
+    they are not, e.g., for products through batch norm in training mode.
     Args:
         A_bmm: A callable that performs a batch matrix multiply of A and a
         K x n x m matrix.
@@ -27,6 +68,24 @@ def cg_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-3, atol=0., maxiter=None,
         (default=5*n)
         verbose: (optional) Whether or not to print status messages.
         (default=False)
+        check_every: (optional) Iterations between true residual
+        replacements. (default=None, never)
+        workspace: (optional) A CGWorkspace whose buffers are updated in
+        place instead of allocating new tensors every iteration; the
+        iterates are bitwise identical to those without one.
+        (default=None)
+        compact: (optional) Call A_bmm(X, index) on the K' x n x m systems
+        index (a LongTensor) that have an active column, instead of
+        A_bmm(X) on all K. Not supported with a workspace. (default=False)
+        AX0: (optional) A X0 when it is already known, e.g. from the
+        computation of X0, which saves the initial call of A_bmm.
+        (default=None)
+    Returns X and an info dict with the number of iterations (niter), the
+    number of calls of A_bmm (n_matvecs), the number of systems these calls
+    multiplied (n_system_matvecs, K per call unless compact), whether all
+    systems converged (optimal), and per system (K x m tensors) whether it
+    converged (converged), its iterations (niters) and its residual norm
+    (residual).
     """
     K, n, m = B.shape
 
@@ -44,103 +103,500 @@ def cg_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-3, atol=0., maxiter=None,
     assert rtol > 0 or atol > 0
     assert isinstance(maxiter, int)
 
-    X_k = X0
-    R_k = B - A_bmm(X_k)
-    Z_k = M_bmm(R_k)
+    if workspace is not None:
+        if compact:
+            raise ValueError('compact is not supported with a workspace')
+        return _cg_batch_workspace(A_bmm, B, M_bmm, X0, rtol, atol, maxiter,
+                                   verbose, check_every,
+                                   workspace.buffers(B), AX0)
 
-    P_k = torch.zeros_like(Z_k)
+    def safe(denominator):
+        denominator[denominator == 0] = 1e-8
+        return denominator
+
+    n_system_matvecs = [0]
+
+    def A_active_bmm(X, active):
+        # A X on the systems with an active column (zero on the others)
+        if not compact:
+            n_system_matvecs[0] += K
+            return A_bmm(X)
+        index = active.any(1).nonzero().squeeze(1)
+        n_system_matvecs[0] += len(index)
+        AX = torch.zeros_like(X)
+        AX[index] = A_bmm(X[index], index)
+        return AX
 
-    P_k1 = P_k
-    R_k1 = R_k
-    R_k2 = R_k
-    X_k1 = X0
-    Z_k1 = Z_k
-    Z_k2 = Z_k
+    X_k = X0
+    n_matvecs = 0
+    if AX0 is None:
+        AX0 = A_active_bmm(X_k, torch.ones(K, m, dtype=torch.bool,
+                                           device=B.device))
+        n_matvecs = 1
+    R_k = B - AX0
+    Z_k = M_bmm(R_k)
+    P_k = Z_k
+    RZ_k = (R_k * Z_k).sum(1)
 
     B_norm = torch.norm(B, dim=1)
     stopping_matrix = torch.max(rtol*B_norm, atol*torch.ones_like(B_norm))
+    residual_norm = torch.norm(R_k, dim=1)
+    converged = residual_norm <= stopping_matrix
+    niters = torch.zeros(K, m, dtype=torch.long, device=B.device)
 
     if verbose:
         print("%03s | %010s %06s" % ("it", "dist", "it/s"))
 
-    optimal = False
-    start = time.perf_counter()
+    niter = 0
+    if verbose:
+        start = time.perf_counter()
     for k in range(1, maxiter + 1):
-        start_iter = time.perf_counter()
-        Z_k = M_bmm(R_k)
+        if bool(converged.all()):
+            break
+        niter = k
+        if verbose:
+            start_iter = time.perf_counter()
+        active = ~converged
 
-        if k == 1:
-            P_k = Z_k
-            R_k1 = R_k
-            X_k1 = X_k
-            Z_k1 = Z_k
+        AP_k = A_active_bmm(P_k, active)
+        n_matvecs += 1
+        alpha = RZ_k / safe((P_k * AP_k).sum(1))
+        alpha = torch.where(active, alpha, torch.zeros_like(alpha))
+        X_k = X_k + alpha.unsqueeze(1) * P_k
+        if check_every and k % check_every == 0:
+            R_new = B - A_active_bmm(X_k, active)
+            # compacted products are zero on the converged systems
+            R_k = torch.where(active.unsqueeze(1), R_new, R_k) \
+                if compact else R_new
+            n_matvecs += 1
         else:
-            R_k2 = R_k1
-            Z_k2 = Z_k1
-            P_k1 = P_k
-            R_k1 = R_k
-            Z_k1 = Z_k
-            X_k1 = X_k
-            denominator = (R_k2 * Z_k2).sum(1)
-            denominator[denominator == 0] = 1e-8
-            beta = (R_k1 * Z_k1).sum(1) / denominator
-            P_k = Z_k1 + beta.unsqueeze(1) * P_k1
-
-        denominator = (P_k * A_bmm(P_k)).sum(1)
-        denominator[denominator == 0] = 1e-8
-        alpha = (R_k1 * Z_k1).sum(1) / denominator
-        X_k = X_k1 + alpha.unsqueeze(1) * P_k
-        R_k = R_k1 - alpha.unsqueeze(1) * A_bmm(P_k)
-        end_iter = time.perf_counter()
+            R_k = R_k - alpha.unsqueeze(1) * AP_k
 
-        residual_norm = torch.norm(A_bmm(X_k) - B, dim=1)
+        residual_norm = torch.norm(R_k, dim=1)
+        niters += active.long()
+        converged = converged | (residual_norm <= stopping_matrix)
+
+        Z_k = M_bmm(R_k)
+        RZ_k1 = RZ_k
+        RZ_k = (R_k * Z_k).sum(1)
+        beta = RZ_k / safe(RZ_k1.clone())
+        P_k = Z_k + beta.unsqueeze(1) * P_k
 
         if verbose:
+            end_iter = time.perf_counter()
             print("%03d | %8.4e %4.2f" %
                   (k, torch.max(residual_norm-stopping_matrix),
                    1. / (end_iter - start_iter)))
 
-        if (residual_norm <= stopping_matrix).all():
-            optimal = True
-            break
+    optimal = bool(converged.all())
+
+    if verbose:
+        end = time.perf_counter()
+        print("Terminated in %d steps (optimal = %s). Took %.3f ms." %
+              (niter, optimal, (end - start) * 1000))
+
+    info = {
+        "niter": niter,
+        "n_matvecs": n_matvecs,
+        "n_system_matvecs": n_system_matvecs[0],
+        "optimal": optimal,
+        "converged": converged,
+        "niters": niters,
+        "residual": residual_norm
+    }
+
+    return X_k, info
 
-    end = time.perf_counter()
+
+def _cg_batch_workspace(A_bmm, B, M_bmm, X0, rtol, atol, maxiter, verbose,
+                        check_every, w, AX0=None):
+    """cg_batch with the buffers w of a CGWorkspace, updated in place
+
+    The operations are those of cg_batch in the same order (the products
+    alpha P and alpha A P are formed in T before they are added, as
+    cg_batch does, not fused into addcmul_), so the iterates are bitwise
+    identical to those of cg_batch.
+    """
+    def safe_(denominator):
+        torch.eq(denominator, 0, out=w['mask'])
+        return denominator.masked_fill_(w['mask'], 1e-8)
+
+    X_k, R_k, P_k, T = w['X'], w['R'], w['P'], w['T']
+    X_k.copy_(X0)
+    n_matvecs = 0
+    if AX0 is None:
+        AX0 = A_bmm(X_k)
+        n_matvecs = 1
+    R_k.copy_(B).sub_(AX0)
+    Z_k = M_bmm(R_k)
+    P_k.copy_(Z_k)
+    torch.sum(torch.mul(R_k, Z_k, out=T), 1, out=w['RZ'])
+
+    stopping_matrix = w['stopping']
+    torch.norm(B, dim=1, out=stopping_matrix)
+    stopping_matrix.mul_(rtol).clamp_(min=atol)
+    residual_norm = w['residual']
+    torch.norm(R_k, dim=1, out=residual_norm)
+    converged, active = w['converged'], w['active']
+    torch.le(residual_norm, stopping_matrix, out=converged)
+    niters = w['niters'].zero_()
+    alpha, beta = w['alpha'].unsqueeze(1), w['beta'].unsqueeze(1)
 
     if verbose:
-        if optimal:
-            print("Terminated in %d steps (reached maxiter). Took %.3f ms." %
-                  (k, (end - start) * 1000))
+        print("%03s | %010s %06s" % ("it", "dist", "it/s"))
+
+    niter = 0
+    if verbose:
+        start = time.perf_counter()
+    for k in range(1, maxiter + 1):
+        if bool(converged.all()):
+            break
+        niter = k
+        if verbose:
+            start_iter = time.perf_counter()
+        torch.logical_not(converged, out=active)
+
+        AP_k = A_bmm(P_k)
+        n_matvecs += 1
+        torch.sum(torch.mul(P_k, AP_k, out=T), 1, out=w['denominator'])
+        torch.div(w['RZ'], safe_(w['denominator']), out=w['alpha'])
+        w['alpha'].masked_fill_(converged, 0)
+        X_k.add_(torch.mul(alpha, P_k, out=T))
+        if check_every and k % check_every == 0:
+            R_k.copy_(B).sub_(A_bmm(X_k))
+            n_matvecs += 1
         else:
-            print("Terminated in %d steps (optimal). Took %.3f ms." %
-                  (k, (end - start) * 1000))
+            R_k.sub_(torch.mul(alpha, AP_k, out=T))
+
+        torch.norm(R_k, dim=1, out=residual_norm)
+        niters.add_(active)
+        torch.le(residual_norm, stopping_matrix, out=w['mask'])
+        converged.logical_or_(w['mask'])
+
+        Z_k = M_bmm(R_k)
+        w['RZ'], w['RZ_old'] = w['RZ_old'], w['RZ']
+        torch.sum(torch.mul(R_k, Z_k, out=T), 1, out=w['RZ'])
+        torch.div(w['RZ'], safe_(w['RZ_old']), out=w['beta'])
+        P_k.mul_(beta).add_(Z_k)
+
+        if verbose:
+            end_iter = time.perf_counter()
+            print("%03d | %8.4e %4.2f" %
+                  (k, torch.max(residual_norm-stopping_matrix),
+                   1. / (end_iter - start_iter)))
+
+    optimal = bool(converged.all())
+
+    if verbose:
+        end = time.perf_counter()
+        print("Terminated in %d steps (optimal = %s). Took %.3f ms." %
+              (niter, optimal, (end - start) * 1000))
 
     info = {
-        "niter": k,
-        "optimal": optimal
+        "niter": niter,
+        "n_matvecs": n_matvecs,
+        "n_system_matvecs": n_matvecs * B.shape[0],
+        "optimal": optimal,
+        "converged": converged,
+        "niters": niters,
+        "residual": residual_norm
     }
 
     return X_k, info
 
 
 class CG(torch.autograd.Function):
+    """Differentiable batched CG solve X = A^{-1} B, use through cg_solve.
+    A is symmetric, so the backward solves A^T dB = A dB = dX by CG with the
+    same A_bmm, M_bmm and tolerances. Its initial guess is the projection
+    gamma X of the solution onto the forward solution X, with
+    gamma = <X, dX> / <X, B> per system (<X, A X> = <X, B>), which minimizes
+    the A-norm error over span{X} and so is never worse than zero. Only X
+    and <X, B> are saved, not the graph of the iterations, and the backward
+    is itself a CG solve, so it can be differentiated again. A_bmm and M_bmm
+    are constants: no gradient flows to the tensors they use.
+    """
 
-    def __init__(self, A_bmm, M_bmm=None, rtol=1e-3, atol=0., maxiter=None,
-                 verbose=False):
-        self.A_bmm = A_bmm
-        self.M_bmm = M_bmm
-        self.rtol = rtol
-        self.atol = atol
-        self.maxiter = maxiter
-        self.verbose = verbose
-
-    def forward(self, B, X0=None):
-        X, _ = cg_batch(self.A_bmm, B, M_bmm=self.M_bmm, X0=X0, rtol=self.rtol,
-                        atol=self.atol, maxiter=self.maxiter,
-                        verbose=self.verbose)
+    @staticmethod
+    def forward(ctx, B, A_bmm, M_bmm, X0, rtol, atol, maxiter, verbose):
+        X, _ = cg_batch(A_bmm, B, M_bmm=M_bmm, X0=X0, rtol=rtol, atol=atol,
+                        maxiter=maxiter, verbose=verbose)
+        ctx.A_bmm = A_bmm
+        ctx.M_bmm = M_bmm
+        ctx.options = (rtol, atol, maxiter, verbose)
+        ctx.save_for_backward(X, (X * B).sum(1))
         return X
 
-    def backward(self, dX):
-        dB, _ = cg_batch(self.A_bmm, dX, M_bmm=self.M_bmm, rtol=self.rtol,
-                         atol=self.atol, maxiter=self.maxiter,
-                         verbose=self.verbose)
-        return dB
+    @staticmethod
+    def backward(ctx, dX):
+        X, XB = ctx.saved_tensors
+        gamma = (X * dX.detach()).sum(1)
+        gamma = torch.where(XB != 0, gamma / torch.where(XB != 0, XB, 1.),
+                            torch.zeros_like(gamma))
+        dB = CG.apply(dX, ctx.A_bmm, ctx.M_bmm, gamma.unsqueeze(1) * X,
+                      *ctx.options)
+        return (dB,) + (None,) * 7
+
+
+def cg_solve(A_bmm, B, M_bmm=None, X0=None, rtol=1e-3, atol=0., maxiter=None,
+             verbose=False):
+    """cg_batch(A_bmm, B, ...)[0] differentiable with respect to B.
+    Backpropagation through X takes one more CG solve (see CG) instead of
+    the graph of the forward iterations. The arguments are those of
+    cg_batch.
+    """
+    return CG.apply(B, A_bmm, M_bmm, X0, rtol, atol, maxiter, verbose)
+
+
+def bicgstab_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-3, atol=0.,
+                   maxiter=None, verbose=False):
+    """Solves a batch of general (nonsymmetric) linear systems using the
+    right-preconditioned BiCGSTAB algorithm.
+    This function solves a batch of matrix linear systems of the form
+        A_i X_i = B_i,  i=1,...,K,
+    where A_i is a n x n nonsingular matrix and B_i is a n x m matrix, and
+    X_i is the n x m matrix representing the solution for the ith system.
+    Each iteration takes two calls of A_bmm. Systems (columns) that have
+    converged are no longer updated.
+    Args:
+        A_bmm: A callable that performs a batch matrix multiply of A and a
+        K x n x m matrix.
+        B: A K x n x m matrix representing the right hand sides.
+        M_bmm: (optional) A callable that performs a batch matrix multiply of
+        the preconditioning matrices M and a K x n x m matrix.
+        (default=identity matrix)
+        X0: (optional) Initial guess for X. (default=zeros)
+        rtol: (optional) Relative tolerance for norm of residual.
+        (default=1e-3)
+        atol: (optional) Absolute tolerance for norm of residual. (default=0)
+        maxiter: (optional) Maximum number of iterations to perform.
+        (default=5*n)
+        verbose: (optional) Whether or not to print status messages.
+        (default=False)
+    Returns X and an info dict with the number of iterations (niter), the
+    number of calls of A_bmm (n_matvecs), whether all systems converged
+    (optimal) and the per-system convergence (converged, a K x m bool
+    tensor).
+    """
+    K, n, m = B.shape
+
+    if M_bmm is None:
+        def M_bmm(x):
+            return x
+    if X0 is None:
+        X0 = torch.zeros_like(B)
+    if maxiter is None:
+        maxiter = 5 * n
+
+    assert X0.shape == (K, n, m)
+    assert rtol > 0 or atol > 0
+    assert isinstance(maxiter, int)
+
+    def safe(denominator):
+        denominator[denominator == 0] = 1e-8
+        return denominator
+
+    X_k = X0
+    R_k = B - A_bmm(X_k)
+    R_hat = R_k.clone()
+    rho = torch.ones(K, m, dtype=B.dtype, device=B.device)
+    alpha = torch.ones_like(rho)
+    omega = torch.ones_like(rho)
+    V_k = torch.zeros_like(B)
+    P_k = torch.zeros_like(B)
+
+    B_norm = torch.norm(B, dim=1)
+    stopping_matrix = torch.max(rtol*B_norm, atol*torch.ones_like(B_norm))
+    converged = torch.norm(R_k, dim=1) <= stopping_matrix
+
+    if verbose:
+        print("%03s | %010s" % ("it", "dist"))
+
+    niter = 0
+    start = time.perf_counter()
+    for k in range(1, maxiter + 1):
+        if bool(converged.all()):
+            break
+        niter = k
+        active = (~converged).unsqueeze(1)
+
+        rho_new = (R_hat * R_k).sum(1)
+        beta = (rho_new / safe(rho.clone())) * (alpha / safe(omega.clone()))
+        P_k = R_k + beta.unsqueeze(1) * (P_k - omega.unsqueeze(1) * V_k)
+        P_hat = M_bmm(P_k)
+        V_k = A_bmm(P_hat)
+        alpha = rho_new / safe((R_hat * V_k).sum(1))
+        S_k = R_k - alpha.unsqueeze(1) * V_k
+        S_hat = M_bmm(S_k)
+        T_k = A_bmm(S_hat)
+        omega = (T_k * S_k).sum(1) / safe((T_k * T_k).sum(1))
+        X_new = X_k + alpha.unsqueeze(1) * P_hat + omega.unsqueeze(1) * S_hat
+        R_new = S_k - omega.unsqueeze(1) * T_k
+        rho = rho_new
+
+        X_k = torch.where(active, X_new, X_k)
+        R_k = torch.where(active, R_new, R_k)
+        residual_norm = torch.norm(R_k, dim=1)
+        converged = converged | (residual_norm <= stopping_matrix)
+
+        if verbose:
+            print("%03d | %8.4e" %
+                  (k, torch.max(residual_norm-stopping_matrix)))
+
+    optimal = bool(converged.all())
+    end = time.perf_counter()
+
+    if verbose:
+        print("Terminated in %d steps (optimal = %s). Took %.3f ms." %
+              (niter, optimal, (end - start) * 1000))
+
+    info = {
+        "niter": niter,
+        "n_matvecs": 1 + 2 * niter,
+        "optimal": optimal,
+        "converged": converged
+    }
+
+    return X_k, info
+
+
+def gmres_batch(A_bmm, B, M_bmm=None, X0=None, rtol=1e-3, atol=0.,
+                restart=20, maxiter=None, verbose=False):
+    """Solves a batch of general (nonsymmetric) linear systems using the
+    right-preconditioned restarted GMRES algorithm.
+    This function solves a batch of matrix linear systems of the form
+        A_i X_i = B_i,  i=1,...,K,
+    where A_i is a n x n nonsingular matrix and B_i is a n x m matrix, and
+    X_i is the n x m matrix representing the solution for the ith system.
+    Each iteration takes one call of A_bmm, plus one per restart for the
+    true residual. Systems (columns) that have converged at a restart are
+    no longer updated.
+    Args:
+        A_bmm: A callable that performs a batch matrix multiply of A and a
+        K x n x m matrix.
+        B: A K x n x m matrix representing the right hand sides.
+        M_bmm: (optional) A callable that performs a batch matrix multiply of
+        the preconditioning matrices M and a K x n x m matrix.
+        (default=identity matrix)
+        X0: (optional) Initial guess for X. (default=zeros)
+        rtol: (optional) Relative tolerance for norm of residual.
+        (default=1e-3)
+        atol: (optional) Absolute tolerance for norm of residual. (default=0)
+        restart: (optional) Size of the Krylov basis before a restart.
+        (default=20)
+        maxiter: (optional) Maximum number of iterations to perform.
+        (default=5*n)
+        verbose: (optional) Whether or not to print status messages.
+        (default=False)
+    Returns X and an info dict with the number of iterations (niter), the
+    number of calls of A_bmm (n_matvecs), whether all systems converged
+    (optimal) and the per-system convergence (converged, a K x m bool
+    tensor).
+    """
+    K, n, m = B.shape
+
+    if M_bmm is None:
+        def M_bmm(x):
+            return x
+    if X0 is None:
+        X0 = torch.zeros_like(B)
+    if maxiter is None:
+        maxiter = 5 * n
+
+    assert X0.shape == (K, n, m)
+    assert rtol > 0 or atol > 0
+    assert isinstance(maxiter, int)
+
+    def safe(denominator):
+        denominator[denominator == 0] = 1e-8
+        return denominator
+
+    X_k = X0
+    R_k = B - A_bmm(X_k)
+    n_matvecs = 1
+
+    B_norm = torch.norm(B, dim=1)
+    stopping_matrix = torch.max(rtol*B_norm, atol*torch.ones_like(B_norm))
+    residual_norm = torch.norm(R_k, dim=1)
+    converged = residual_norm <= stopping_matrix
+
+    if verbose:
+        print("%03s | %010s" % ("it", "dist"))
+
+    niter = 0
+    start = time.perf_counter()
+    while niter < maxiter and not bool(converged.all()):
+        active = (~converged).unsqueeze(1)
+        n_inner = min(restart, maxiter - niter)
+
+        # Arnoldi with modified Gram-Schmidt; the Hessenberg matrix H is
+        # reduced to upper triangular form by Givens rotations (cs, sn) as
+        # it is built, so g holds the residual of the least squares problem
+        V = [R_k / safe(residual_norm.clone()).unsqueeze(1)]
+        Z = []
+        H = torch.zeros(K, m, n_inner + 1, n_inner, dtype=B.dtype,
+                        device=B.device)
+        g = torch.zeros(K, m, n_inner + 1, dtype=B.dtype, device=B.device)
+        g[..., 0] = residual_norm
+        cs, sn = [], []
+        for j in range(n_inner):
+            niter += 1
+            Z.append(M_bmm(V[j]))
+            W = A_bmm(Z[j])
+            n_matvecs += 1
+            for i in range(j + 1):
+                H[..., i, j] = (W * V[i]).sum(1)
+                W = W - H[..., i, j].unsqueeze(1) * V[i]
+            H[..., j + 1, j] = torch.norm(W, dim=1)
+            V.append(W / safe(H[..., j + 1, j].clone()).unsqueeze(1))
+
+            for i in range(j):
+                h_i = cs[i] * H[..., i, j] + sn[i] * H[..., i + 1, j]
+                H[..., i + 1, j] = (-sn[i] * H[..., i, j]
+                                    + cs[i] * H[..., i + 1, j])
+                H[..., i, j] = h_i
+            r = safe(torch.sqrt(H[..., j, j]**2 + H[..., j + 1, j]**2))
+            cs.append(H[..., j, j] / r)
+            sn.append(H[..., j + 1, j] / r)
+            H[..., j, j] = r
+            H[..., j + 1, j] = 0
+            g[..., j + 1] = -sn[j] * g[..., j]
+            g[..., j] = cs[j] * g[..., j]
+
+            estimate = torch.abs(g[..., j + 1])
+            if verbose:
+                print("%03d | %8.4e" %
+                      (niter, torch.max(estimate-stopping_matrix)))
+            if bool((converged | (estimate <= stopping_matrix)).all()):
+                break
+
+        # back substitution for the coefficients y of the Krylov basis
+        k = len(Z)
+        y = torch.zeros(K, m, k, dtype=B.dtype, device=B.device)
+        for i in reversed(range(k)):
+            y[..., i] = ((g[..., i] - (H[..., i, i + 1:k]
+                                       * y[..., i + 1:k]).sum(-1))
+                         / safe(H[..., i, i].clone()))
+        X_new = X_k + sum(y[..., i].unsqueeze(1) * Z[i] for i in range(k))
+
+        X_k = torch.where(active, X_new, X_k)
+        R_k = B - A_bmm(X_k)
+        n_matvecs += 1
+        residual_norm = torch.norm(R_k, dim=1)
+        converged = converged | (residual_norm <= stopping_matrix)
+
+    optimal = bool(converged.all())
+    end = time.perf_counter()
+
+    if verbose:
+        print("Terminated in %d steps (optimal = %s). Took %.3f ms." %
+              (niter, optimal, (end - start) * 1000))
+
+    info = {
+        "niter": niter,
+        "n_matvecs": n_matvecs,
+        "optimal": optimal,
+        "converged": converged
+    }
+
+    return X_k, info
@@ -0,0 +1,1305 @@
+import time
+import warnings
+import torch
+import torch.nn as nn
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from BatchCG import bicgstab_batch
+
+latent_variable = torch.tensor
+
+SOLVERS = {}
+
+
+def register_solver(name):
+    ''' Decorator adding a fixed point solver to SOLVERS under name
+
+        A solver is called as solver(R, Qd, u0=None, eps=..., max_depth=...,
+        **options), where R(u, Qd) is the latent operator, and returns a
+        SolverResult.
+    '''
+    def register(solver):
+        SOLVERS[name] = solver
+        return solver
+    return register
+
+
+class SolverResult:
+    ''' Outcome of a fixed point solve
+
+        u is the solution, computed as u = R(u_prev, Qd) from the last
+        iterate u_prev. depth holds the number of applications of R to each
+        sample, residual_hist the largest residual of the batch at each
+        convergence check and solve_time the wall-clock time of the solve
+        in seconds. Multiresolution solves also report the per-sample depth
+        of the coarse solve in coarse_depth (None otherwise).
+
+        FixedPointSolver fills in the final per-sample residual (a tensor on
+        the device of u) and norm_time, the time spent rescaling the latent
+        operator with normalize_lip_const.
+    '''
+
+    def __init__(self, u, u_prev, depth, residual_hist=(), solve_time=0.0,
+                 coarse_depth=None):
+        self.u = u
+        self.u_prev = u_prev
+        self.depth = depth
+        self.coarse_depth = coarse_depth
+        self.residual_hist = []
+        if len(residual_hist) > 0:
+            self.residual_hist = torch.stack(list(residual_hist)).tolist()
+        self.solve_time = solve_time
+        self.residual = None
+        self.norm_time = 0.0
+
+    def capped(self, eps, max_depth, residual='channel', norm_type=2):
+        ''' Number of samples stopped by max_depth with residual above eps '''
+        res = self.residual
+        if res is None:
+            res = sample_residual(self.u, self.u_prev, residual, norm_type)
+        return int(((self.depth >= max_depth) & (res > eps)).sum())
+
+
+def sample_residual(u: latent_variable, u_prev: latent_variable,
+                    residual='channel', norm_type=2):
+    ''' Per-sample residual of a fixed point step
+
+        'channel' is the original convergence measure of the FPN loops: the
+        norm over the channel dimension, maximized over all remaining
+        (spatial) dimensions of the sample. 'absolute' is the norm of the
+        whole flattened difference u - u_prev and 'relative' divides it by
+        the norm of u. norm_type is passed on to torch.norm, e.g. 2 or
+        float('inf').
+    '''
+    n_samples = u.shape[0]
+    diff = u - u_prev
+    if residual == 'channel':
+        res = torch.norm(diff, p=norm_type, dim=1)
+        return res.reshape(n_samples, -1).max(dim=1)[0]
+
+    res = torch.norm(diff.reshape(n_samples, -1), p=norm_type, dim=1)
+    if residual == 'relative':
+        u_norm = torch.norm(u.reshape(n_samples, -1), p=norm_type, dim=1)
+        res = res / u_norm.clamp(min=1.0e-12)
+    elif residual != 'absolute':
+        raise ValueError('Unknown residual type: ' + str(residual))
+    return res
+
+
+def _stalled(residual_hist, stall_ratio):
+    ''' True if the last check reduced the residual by less than stall_ratio
+
+        Used to stop an iteration that plateaus above eps, e.g. because of
+        the limited accuracy of low precision arithmetic.
+    '''
+    return stall_ratio is not None and len(residual_hist) > 1 and \
+        bool(residual_hist[-1] > stall_ratio * residual_hist[-2])
+
+
+@register_solver('picard')
+def picard(R, Qd: latent_variable, u0=None, eps=1.0e-3, max_depth=100,
+           active_set=False, residual='channel', norm_type=2, check_every=1,
+           stall_ratio=None):
+    ''' Plain fixed point iteration u <-- R(u, Qd)
+
+        By default the whole batch is iterated until every sample satisfies
+        residual <= eps. With active_set=True, each sample is frozen as soon
+        as its own residual drops below eps and only the unconverged subset
+        is passed through R, which keeps a few slow samples from setting the
+        depth of the whole batch.
+
+        Note R sees a smaller batch once samples are frozen. When R contains
+        batch norm in training mode, the batch statistics then change with
+        the active set, so the frozen and full-batch iterations only agree
+        exactly in eval mode or for latent operators without batch norm.
+
+        Reading the convergence test back from the device synchronizes it
+        with the host. With check_every=k, the residual is only computed and
+        tested every k iterations and the steps in between run unchecked.
+        Samples may then take up to k-1 iterations more than needed, which
+        only moves them closer to the fixed point. Iterates alternate by
+        reference (R returns a fresh tensor), so no copies of u are made.
+        If R provides steps(u, Qd, n) (see CompiledLatentOperator), the
+        full-batch iteration runs the k steps between checks as one call.
+
+        With stall_ratio set, the iteration also stops once a check reduces
+        the largest residual by less than this factor (see _stalled). This
+        holds for all registered solvers.
+
+        Returns a SolverResult.
+    '''
+    n_samples = Qd.shape[0]
+    u = torch.zeros(Qd.shape, device=Qd.device) if u0 is None else u0
+    depth = torch.zeros(n_samples, dtype=torch.long, device=Qd.device)
+    residual_hist = []
+
+    if not active_set:
+        steps = getattr(R, 'steps', None)
+        u_prev = u
+        num_iter = 0
+        all_samp_conv = False
+        while not all_samp_conv and num_iter < max_depth:
+            if steps is not None:
+                n_steps = min(check_every - num_iter % check_every,
+                              max_depth - num_iter)
+                u_prev, u = steps(u, Qd, n_steps)
+                num_iter += n_steps
+            else:
+                u_prev = u
+                u = R(u, Qd)
+                num_iter += 1
+            if num_iter % check_every == 0:
+                res = sample_residual(u, u_prev, residual, norm_type)
+                residual_hist.append(torch.max(res))
+                all_samp_conv = residual_hist[-1] <= eps
+                if _stalled(residual_hist, stall_ratio):
+                    break
+        depth += num_iter
+        return SolverResult(u, u_prev, depth, residual_hist)
+
+    u_sol = torch.empty_like(u)
+    u_sol_prev = torch.empty_like(u)
+    idx = torch.arange(n_samples, device=Qd.device)
+    u_act, prev_act, Qd_act = u, u, Qd
+    num_iter = 0
+    unchecked_steps = 0
+    while idx.numel() > 0 and num_iter < max_depth:
+        prev_act, u_act = u_act, R(u_act, Qd_act)
+        num_iter += 1
+        unchecked_steps += 1
+        if num_iter % check_every != 0:
+            continue
+        depth[idx] += unchecked_steps
+        unchecked_steps = 0
+        res = sample_residual(u_act, prev_act, residual, norm_type)
+        residual_hist.append(torch.max(res))
+        if _stalled(residual_hist, stall_ratio):
+            break
+        not_conv = res > eps
+        if not bool(not_conv.all()):
+            # scatter converged samples back and compact the active set
+            conv = ~not_conv
+            u_sol[idx[conv]] = u_act[conv]
+            u_sol_prev[idx[conv]] = prev_act[conv]
+            idx = idx[not_conv]
+            u_act = u_act[not_conv]
+            prev_act = prev_act[not_conv]
+            Qd_act = Qd_act[not_conv]
+
+    # samples still active hit max_depth
+    depth[idx] += unchecked_steps
+    u_sol[idx] = u_act
+    u_sol_prev[idx] = prev_act
+    return SolverResult(u_sol, u_sol_prev, depth, residual_hist)
+
+
+@register_solver('relaxed')
+def relaxed(R, Qd: latent_variable, u0=None, eps=1.0e-3, max_depth=100,
+            alpha=0.5, adaptive=False, alpha_min=0.1, alpha_max=1.0,
+            residual='channel', norm_type=2, check_every=1,
+            stall_ratio=None):
+    ''' Krasnoselskii-Mann iteration u <-- (1 - alpha) u + alpha R(u, Qd)
+
+        Averaging with the previous iterate damps oscillations of operators
+        that are only barely contractive. The residual is measured on the
+        undamped step R(u, Qd) - u and tested every check_every iterations.
+
+        With adaptive=True, each sample has its own alpha, starting from
+        alpha, which is set after every step from the ratio of its successive
+        residuals g = R(u, Qd) - u,
+
+            rho = <g_new, g_old> / |g_old|^2,   alpha <-- alpha / (1 - rho),
+
+        clipped to [alpha_min, alpha_max]. For a linear map with eigenvalue
+        lam along g, rho = 1 - alpha (1 - lam), so the new alpha cancels the
+        residual in that direction: oscillations (lam near -1) are damped
+        with alpha near 1/2 and slow contractions (lam near 1) move towards
+        alpha_max. alpha_max > 1 allows over-relaxation. If the residual
+        grows along g (rho >= 1), alpha is halved. The per-sample ratios are
+        computed on the device every step, the convergence test still only
+        every check_every steps.
+
+        Returns a SolverResult.
+    '''
+    n_samples = Qd.shape[0]
+    u = torch.zeros(Qd.shape, device=Qd.device) if u0 is None else u0
+    depth = torch.zeros(n_samples, dtype=torch.long, device=Qd.device)
+    residual_hist = []
+    if adaptive:
+        alpha = torch.full((n_samples,) + (1,) * (Qd.dim() - 1), alpha,
+                           dtype=Qd.dtype, device=Qd.device)
+        g_prev = None
+
+    u_prev = u
+    num_iter = 0
+    all_samp_conv = False
+    while not all_samp_conv and num_iter < max_depth:
+        if num_iter > 0:
+            u_prev = torch.lerp(u_prev, u, alpha)
+        u = R(u_prev, Qd)
+        num_iter += 1
+        if adaptive:
+            g = (u - u_prev).reshape(n_samples, -1)
+            if g_prev is not None:
+                rho = (g * g_prev).sum(dim=1) / \
+                    (g_prev * g_prev).sum(dim=1).clamp(min=1.0e-30)
+                rho = rho.view(alpha.shape)
+                alpha = torch.where(rho < 1.0,
+                                    alpha / (1.0 - rho).clamp(min=1.0e-6),
+                                    0.5 * alpha)
+                alpha = alpha.clamp(min=alpha_min, max=alpha_max)
+            g_prev = g
+        if num_iter % check_every == 0:
+            res = sample_residual(u, u_prev, residual, norm_type)
+            residual_hist.append(torch.max(res))
+            all_samp_conv = residual_hist[-1] <= eps
+            if _stalled(residual_hist, stall_ratio):
+                break
+
+    depth += num_iter
+    return SolverResult(u, u_prev, depth, residual_hist)
+
+
+@register_solver('anderson')
+def anderson(R, Qd: latent_variable, u0=None, eps=1.0e-3, max_depth=100,
+             m=5, beta=1.0, lam=1.0e-4, residual='channel', norm_type=2,
+             check_every=1, stall_ratio=None):
+    ''' Anderson accelerated fixed point iteration
+
+        Keeps the last m iterates x_i and their images f_i = R(x_i, Qd).
+        The next iterate is
+
+            u <-- beta * sum_i alpha_i f_i + (1 - beta) * sum_i alpha_i x_i,
+
+        where, for each sample, alpha minimizes |sum_i alpha_i (f_i - x_i)|
+        subject to sum_i alpha_i = 1. The least squares problem is
+        regularized by lam times the mean squared residual in memory, so the
+        regularization does not take over as the residuals shrink. beta is a
+        damping factor. With m = 1 and beta = 1 this is plain Picard
+        iteration. The residual is tested every check_every iterations.
+
+        Returns a SolverResult.
+    '''
+    n_samples = Qd.shape[0]
+    u = torch.zeros(Qd.shape, device=Qd.device) if u0 is None else u0
+    depth = torch.zeros(n_samples, dtype=torch.long, device=Qd.device)
+    residual_hist = []
+    if max_depth < 1:
+        return SolverResult(u, u, depth)
+
+    n_features = Qd[0].numel()
+    X = torch.zeros(n_samples, m, n_features, dtype=Qd.dtype,
+                    device=Qd.device)
+    F = torch.zeros_like(X)
+    H = torch.zeros(n_samples, m + 1, m + 1, dtype=Qd.dtype,
+                    device=Qd.device)
+    H[:, 0, 1:] = 1.0
+    H[:, 1:, 0] = 1.0
+    y = torch.zeros(n_samples, m + 1, 1, dtype=Qd.dtype, device=Qd.device)
+    y[:, 0] = 1.0
+    eye = torch.eye(m, dtype=Qd.dtype, device=Qd.device).unsqueeze(0)
+
+    u_prev = u
+    u = R(u_prev, Qd)
+    X[:, 0] = u_prev.reshape(n_samples, -1)
+    F[:, 0] = u.reshape(n_samples, -1)
+    num_iter = 1
+    all_samp_conv = False
+    if check_every == 1:
+        res = sample_residual(u, u_prev, residual, norm_type)
+        residual_hist.append(torch.max(res))
+        all_samp_conv = residual_hist[-1] <= eps
+
+    k = 1
+    while not all_samp_conv and num_iter < max_depth:
+        n_hist = min(k, m)
+        G = F[:, :n_hist] - X[:, :n_hist]
+        GGT = torch.bmm(G, G.transpose(1, 2))
+        scale = GGT.diagonal(dim1=1, dim2=2).mean(dim=1).clamp(min=1.0e-30)
+        H[:, 1:n_hist+1, 1:n_hist+1] = (GGT + lam * scale[:, None, None]
+                                        * eye[:, :n_hist, :n_hist])
+        alpha = torch.linalg.solve(H[:, :n_hist+1, :n_hist+1],
+                                   y[:, :n_hist+1])[:, 1:n_hist+1, 0]
+        alpha = alpha.unsqueeze(1)
+        x = beta * torch.bmm(alpha, F[:, :n_hist])[:, 0]
+        if beta != 1.0:
+            x += (1.0 - beta) * torch.bmm(alpha, X[:, :n_hist])[:, 0]
+
+        u_prev = x.view(Qd.shape)
+        u = R(u_prev, Qd)
+        X[:, k % m] = x
+        F[:, k % m] = u.reshape(n_samples, -1)
+        k += 1
+        num_iter += 1
+        if num_iter % check_every == 0:
+            res = sample_residual(u, u_prev, residual, norm_type)
+            residual_hist.append(torch.max(res))
+            all_samp_conv = residual_hist[-1] <= eps
+            if _stalled(residual_hist, stall_ratio):
+                break
+
+    depth += num_iter
+    return SolverResult(u, u_prev, depth, residual_hist)
+
+
+class BroydenState:
+    ''' Low-rank inverse Jacobian estimate of the Broyden solver
+
+        The inverse Jacobian of g(u) = R(u, Qd) - u is approximated by
+
+            Jinv = -I + sum_i U_i V_i^T,
+
+        with the rank-one factors of every sample stored in preallocated
+        ring buffers Us and VTs of shape (n_samples, memory, n_features).
+        Once memory updates are stored, the oldest factor is overwritten.
+        The per-sample trust radii of the last solve are kept in radius.
+
+        Passing the same state to consecutive broyden() calls reuses the
+        buffers. With reuse=True the stored factors and trust radii are
+        used as the starting inverse Jacobian estimate as well, e.g. when
+        solving again for the same samples with slightly changed weights.
+    '''
+
+    def __init__(self, memory=10):
+        self.memory = memory
+        self.Us = None
+        self.VTs = None
+        self.radius = None
+        self.count = 0
+
+    def allocate(self, n_samples, n_features, dtype, device, reuse=False):
+        shape = (n_samples, self.memory, n_features)
+        if self.Us is None or self.Us.shape != shape or \
+                self.Us.dtype != dtype or self.Us.device != device:
+            self.Us = torch.zeros(shape, dtype=dtype, device=device)
+            self.VTs = torch.zeros(shape, dtype=dtype, device=device)
+            reuse = False
+        if not reuse:
+            self.count = 0
+            self.radius = torch.full((n_samples,), float('inf'), dtype=dtype,
+                                     device=device)
+
+    def rank(self):
+        return min(self.count, self.memory)
+
+    def matvec(self, x):
+        ''' Jinv x for a batch x of shape (n_samples, n_features) '''
+        k = self.rank()
+        if k == 0:
+            return -x
+        VTx = torch.bmm(self.VTs[:, :k], x.unsqueeze(2))
+        return -x + torch.bmm(self.Us[:, :k].transpose(1, 2), VTx)[:, :, 0]
+
+    def rmatvec(self, x):
+        ''' x^T Jinv for a batch x of shape (n_samples, n_features) '''
+        k = self.rank()
+        if k == 0:
+            return -x
+        xTU = torch.bmm(x.unsqueeze(1), self.Us[:, :k].transpose(1, 2))
+        return -x + torch.bmm(xTU, self.VTs[:, :k])[:, 0]
+
+    def update(self, dx, dg):
+        ''' Good Broyden update from the secant pair (dx, dg) '''
+        vT = self.rmatvec(dx)
+        denominator = (vT * dg).sum(dim=1)
+        valid = denominator.abs() > 1.0e-12
+        denominator[~valid] = 1.0
+        u = (dx - self.matvec(dg)) / denominator.unsqueeze(1)
+        u[~valid] = 0.0
+        slot = self.count % self.memory
+        self.Us[:, slot] = u
+        self.VTs[:, slot] = vT
+        self.count += 1
+
+
+@register_solver('broyden')
+def broyden(R, Qd: latent_variable, u0=None, eps=1.0e-3, max_depth=100,
+            memory=10, state=None, reuse=False, residual='channel',
+            norm_type=2, check_every=1, stall_ratio=None):
+    ''' Limited-memory Broyden root solver for g(u) = R(u, Qd) - u = 0
+
+        The quasi-Newton step dx = -Jinv g uses the rank-memory inverse
+        Jacobian estimate of a BroydenState (see its docstring for reuse of
+        the state across calls). With no stored factors the step is a plain
+        Picard step.
+
+        Each sample takes a trust step: the step is clipped to the sample's
+        trust radius, and it is only accepted if it decreases |g|. Accepted
+        steps double the radius, rejected ones shrink it to half the step
+        length. The secant pair of every step updates the Jacobian estimate,
+        accepted or not. The residual is tested every check_every
+        iterations.
+
+        Returns a SolverResult.
+    '''
+    n_samples = Qd.shape[0]
+    u = torch.zeros(Qd.shape, device=Qd.device) if u0 is None else u0
+    depth = torch.zeros(n_samples, dtype=torch.long, device=Qd.device)
+    residual_hist = []
+    if max_depth < 1:
+        return SolverResult(u, u, depth)
+
+    if state is None:
+        state = BroydenState(memory)
+    state.allocate(n_samples, Qd[0].numel(), Qd.dtype, Qd.device, reuse=reuse)
+
+    x = u.reshape(n_samples, -1)
+    f = R(u, Qd).reshape(n_samples, -1)
+    g = f - x
+    g_norm = torch.norm(g, dim=1)
+    num_iter = 1
+    all_samp_conv = False
+    if check_every == 1:
+        res = sample_residual(f.view(Qd.shape), x.view(Qd.shape), residual,
+                              norm_type)
+        residual_hist.append(torch.max(res))
+        all_samp_conv = residual_hist[-1] <= eps
+
+    while not all_samp_conv and num_iter < max_depth:
+        step = -state.matvec(g)
+        step_norm = torch.norm(step, dim=1).clamp(min=1.0e-30)
+        dx = step * (state.radius / step_norm).clamp(max=1.0).unsqueeze(1)
+        x_new = x + dx
+        f_new = R(x_new.view(Qd.shape), Qd).reshape(n_samples, -1)
+        g_new = f_new - x_new
+        g_new_norm = torch.norm(g_new, dim=1)
+        num_iter += 1
+
+        state.update(dx, g_new - g)
+
+        accept = g_new_norm < g_norm
+        state.radius = torch.where(accept, 2.0 * state.radius,
+                                   0.5 * torch.norm(dx, dim=1))
+        accept = accept.unsqueeze(1)
+        x = torch.where(accept, x_new, x)
+        f = torch.where(accept, f_new, f)
+        g = torch.where(accept, g_new, g)
+        g_norm = torch.where(accept[:, 0], g_new_norm, g_norm)
+
+        if num_iter % check_every == 0:
+            res = sample_residual(f.view(Qd.shape), x.view(Qd.shape),
+                                  residual, norm_type)
+            residual_hist.append(torch.max(res))
+            all_samp_conv = residual_hist[-1] <= eps
+            if _stalled(residual_hist, stall_ratio):
+                break
+
+    depth += num_iter
+    return SolverResult(f.view(Qd.shape), x.view(Qd.shape), depth,
+                        residual_hist)
+
+
+@register_solver('multires')
+def multires(R, Qd: latent_variable, u0=None, eps=1.0e-3, max_depth=100,
+             factor=2, coarse_eps=None, coarse_max_depth=None, inner='picard',
+             **options):
+    ''' Coarse-to-fine solve of the spatial latent fixed point
+
+        The latent operators are convolutional, so R also acts on coarser
+        feature maps. Qd is average pooled by factor, the fixed point of R
+        is solved at the coarse resolution, where every iteration costs
+        about 1/factor^2 of a fine one, and its bilinear upsampling is used
+        as the starting point of the full resolution solve. Both solves use
+        the registered solver inner with the remaining options. The coarse
+        solve stops at coarse_eps (10 * eps by default), as its solution
+        only approximates the fine one anyway.
+
+        Note that batch norm layers in training mode see (and record in
+        their running statistics) coarse feature maps during the coarse
+        solve. If u0 is given, e.g. from a LatentCache, or the maps are too
+        small to pool, only the fine solve is run.
+
+        Returns the SolverResult of the fine solve, with the depth of the
+        coarse solve in coarse_depth.
+    '''
+    solver = SOLVERS[inner]
+    coarse_depth = torch.zeros(Qd.shape[0], dtype=torch.long,
+                               device=Qd.device)
+    if u0 is None and Qd.dim() == 4 and min(Qd.shape[-2:]) >= 2 * factor:
+        Qd_coarse = torch.nn.functional.avg_pool2d(Qd, factor,
+                                                   ceil_mode=True)
+        coarse = solver(R, Qd_coarse,
+                        eps=10.0 * eps if coarse_eps is None else coarse_eps,
+                        max_depth=max_depth if coarse_max_depth is None
+                        else coarse_max_depth, **options)
+        u0 = torch.nn.functional.interpolate(coarse.u, size=Qd.shape[-2:],
+                                             mode='bilinear',
+                                             align_corners=False)
+        coarse_depth = coarse.depth
+
+    result = solver(R, Qd, u0=u0, eps=eps, max_depth=max_depth, **options)
+    result.coarse_depth = coarse_depth
+    return result
+
+
+class LatentCache:
+    ''' Memory-bounded store of fixed points u* keyed by sample index
+
+        Used to warm-start the fixed point iteration of a training sample
+        from its solution in the previous epoch. Latents are stored on the
+        CPU, compressed to fp16 (half=True), in a slot pool of at most
+        max_bytes that is allocated on the first store. The pool is pinned
+        when CUDA is available, or memory-mapped to the file mmap_path.
+        When the pool is full, the least recently used sample is evicted.
+    '''
+
+    def __init__(self, max_bytes=2**30, half=True, pin_memory=True,
+                 mmap_path=None):
+        self.max_bytes = max_bytes
+        self.dtype = torch.float16 if half else torch.float32
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.mmap_path = mmap_path
+        self.storage = None
+        self.staging = None
+        self.slots = OrderedDict()  # sample index -> slot, oldest first
+        self.free_slots = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _allocate(self, sample_shape):
+        numel = int(np.prod(sample_shape))
+        bytes_per_sample = numel * torch.tensor([], dtype=self.dtype)\
+            .element_size()
+        capacity = max(1, self.max_bytes // bytes_per_sample)
+        if self.mmap_path is not None:
+            np_dtype = np.float16 if self.dtype == torch.float16 \
+                else np.float32
+            memmap = np.memmap(self.mmap_path, dtype=np_dtype, mode='w+',
+                               shape=(capacity,) + tuple(sample_shape))
+            self.storage = torch.from_numpy(memmap)
+        else:
+            self.storage = torch.empty((capacity,) + tuple(sample_shape),
+                                       dtype=self.dtype)
+            if self.pin_memory:
+                self.storage = self.storage.pin_memory()
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def _staging(self, n_samples):
+        if self.staging is None or self.staging.shape[0] < n_samples:
+            self.staging = torch.empty((n_samples,) + self.storage.shape[1:],
+                                       dtype=self.dtype)
+            if self.pin_memory:
+                self.staging = self.staging.pin_memory()
+        return self.staging[:n_samples]
+
+    def lookup(self, indices, Qd: latent_variable):
+        ''' Cached latents for indices, zeros for samples not in the cache
+
+            Returns a tensor shaped, typed and placed like Qd.
+        '''
+        u0 = torch.zeros(Qd.shape, dtype=Qd.dtype, device=Qd.device)
+        if self.storage is None:
+            self.misses += len(indices)
+            return u0
+
+        rows, slots = [], []
+        for row, index in enumerate(indices.tolist()):
+            slot = self.slots.get(index)
+            if slot is not None:
+                self.slots.move_to_end(index)
+                rows.append(row)
+                slots.append(slot)
+        self.hits += len(rows)
+        self.misses += len(indices) - len(rows)
+
+        if rows:
+            staging = self._staging(len(rows))
+            torch.index_select(self.storage, 0, torch.tensor(slots),
+                               out=staging)
+            u0[torch.tensor(rows, device=Qd.device)] = staging.to(
+                Qd.device, non_blocking=True).to(Qd.dtype)
+        return u0
+
+    def store(self, indices, u: latent_variable):
+        ''' Store (or refresh) the latents u of the samples indices '''
+        if self.storage is None:
+            self._allocate(u.shape[1:])
+
+        slots = []
+        for index in indices.tolist():
+            slot = self.slots.get(index)
+            if slot is not None:
+                self.slots.move_to_end(index)
+            elif self.free_slots:
+                slot = self.free_slots.pop()
+                self.slots[index] = slot
+            else:
+                _, slot = self.slots.popitem(last=False)
+                self.slots[index] = slot
+            slots.append(slot)
+
+        u = u.detach().to(dtype=self.dtype, device='cpu')
+        self.storage.index_copy_(0, torch.tensor(slots), u)
+
+
+class _UnrolledOperator(torch.nn.Module):
+    ''' n_steps applications of R, a module so that tracing keeps the
+        parameters of net as parameters (a traced function would bake them
+        in as constants)
+    '''
+
+    def __init__(self, net, R, n_steps):
+        super().__init__()
+        self.net = net
+        self.R = R
+        self.n_steps = n_steps
+
+    def forward(self, u, v):
+        u_prev = u
+        for _ in range(self.n_steps):
+            u_prev, u = u, self.R(u, v)
+        return u_prev, u
+
+
+class CompiledLatentOperator:
+    ''' No-grad latent operator R(u, Qd) of net, compiled when possible
+
+        Wraps net.latent_space_forward_fused (dropout-free, with in-place
+        residual adds and gamma scaling) if the network defines it, and
+        net.latent_space_forward otherwise. backend='compile' uses
+        torch.compile, backend='script' traces the operator with TorchScript.
+        Tracing records the batch norm mode, so traced operators are kept per
+        mode, and it bakes in the batch shape, so it is best suited to eval
+        mode with a fixed batch size. If compiling or running the compiled
+        operator raises a RuntimeError (the base of the torch.compile and
+        TorchScript errors), a warning naming the backend is emitted and the
+        eager operator is used from then on; active_backend is the backend
+        actually in use ('compile', 'script' or 'eager').
+
+        steps(u, Qd, n) applies R n times in a single compiled call and
+        returns the last two iterates. picard uses it to run the check_every
+        steps between two convergence checks without returning to Python.
+    '''
+
+    backends = ('compile', 'script')
+
+    def __init__(self, net, backend='compile'):
+        if backend not in self.backends:
+            raise ValueError('Unknown backend: ' + str(backend)
+                             + ', choose from ' + str(list(self.backends)))
+        self.net = net
+        self.backend = backend
+        self.active_backend = backend
+        self.eager = getattr(net, 'latent_space_forward_fused',
+                             net.latent_space_forward)
+        self.compiled = {}  # (n_steps, training) -> callable
+
+    def _unrolled(self, n_steps):
+        return _UnrolledOperator(self.net, self.eager, n_steps)
+
+    def _fall_back(self, error):
+        warnings.warn(self.backend + ' backend failed on the latent operator '
+                      'of ' + type(self.net).__name__ + ', using the eager '
+                      'operator: ' + str(error))
+        self.active_backend = 'eager'
+        self.compiled.clear()
+
+    def _compile(self, n_steps, u, v):
+        unrolled = self._unrolled(n_steps)
+        if self.active_backend == 'eager':
+            return unrolled
+        try:
+            if self.backend == 'compile':
+                return torch.compile(unrolled, dynamic=True)
+            return torch.jit.trace(unrolled, (u, v), check_trace=False)
+        except RuntimeError as error:
+            self._fall_back(error)
+        return unrolled
+
+    def steps(self, u: latent_variable, v: latent_variable, n_steps=1):
+        key = (n_steps, self.net.training)
+        with torch.no_grad():
+            if key not in self.compiled:
+                self.compiled[key] = self._compile(n_steps, u, v)
+            if self.active_backend == 'eager':
+                return self.compiled[key](u, v)
+            try:
+                return self.compiled[key](u, v)
+            except RuntimeError as error:
+                # compilation errors of torch.compile surface on first call
+                self._fall_back(error)
+                self.compiled[key] = self._unrolled(n_steps)
+                return self.compiled[key](u, v)
+
+    def __call__(self, u: latent_variable, v: latent_variable):
+        return self.steps(u, v, 1)[1]
+
+
+def compiled_latent_operator(net, backend='compile'):
+    ''' CompiledLatentOperator of net, created once per backend '''
+    operators = net.__dict__.setdefault('_compiled_latent_operators', {})
+    if backend not in operators:
+        operators[backend] = CompiledLatentOperator(net, backend)
+    return operators[backend]
+
+
+class LipschitzEstimator:
+    ''' Power iteration estimate of the Lipschitz constant of R in u
+
+        normalize_lip_const compares R at two random perturbations, which
+        takes two latent passes per call and only measures R along random
+        directions. This estimator keeps a probe direction v (one sample
+        shaped, shared by the batch) across calls and refines it by one
+        power iteration step on J^T J per call, where J is the Jacobian of R
+        in u:
+
+            Jv = (R(u_prev + h v, Qd) - R(u_prev, Qd)) / h,
+            w = J^T Jv (a vector-Jacobian product),   v <-- w / |w|,
+
+        where R(u_prev, Qd) = u is the last step of the solve, so a call
+        takes a single latent pass and its backward. Iterating J alone would
+        converge to the spectral radius of J, which for the non-normal
+        Jacobians of the latent convolutions can lie well below the
+        Lipschitz constant |J|_2 that J^T J gives. estimate is the largest
+        sqrt(|J^T J v|) over the batch, and v follows the w of that sample.
+        As the weights change little per step, v stays close to the
+        dominant right singular vector. h is fd_step times the norm of
+        u_prev (at least fd_step).
+
+        normalize() rescales the latent operator with net.rescale_lip_const
+        whenever the estimate exceeds net.gamma. n_updates and n_rescales
+        count the calls and the rescalings.
+    '''
+
+    def __init__(self, fd_step=1.0e-2):
+        self.fd_step = fd_step
+        self.probe = None
+        self.estimate = None
+        self.n_updates = 0
+        self.n_rescales = 0
+
+    def update(self, R, u_prev: latent_variable, u: latent_variable,
+               Qd: latent_variable):
+        ''' One power iteration step at u_prev, where u = R(u_prev, Qd) '''
+        n_samples = Qd.shape[0]
+        shape = (1,) + tuple(Qd.shape[1:])
+        if self.probe is None or self.probe.shape != shape or \
+                self.probe.device != Qd.device:
+            self.probe = torch.randn(shape, dtype=Qd.dtype, device=Qd.device)
+            self.probe /= torch.norm(self.probe)
+
+        h = self.fd_step * torch.norm(u_prev.reshape(n_samples, -1),
+                                      dim=1).clamp(min=1.0)
+        h = h.view((n_samples,) + (1,) * (Qd.dim() - 1))
+        with torch.enable_grad():
+            x = (u_prev.detach() + h * self.probe).requires_grad_()
+            Rx = R(x, Qd.detach())
+            Jv = (Rx.detach() - u) / h
+            JTJv = torch.autograd.grad(Rx, x, grad_outputs=Jv)[0]
+        norms = torch.norm(JTJv.reshape(n_samples, -1), dim=1)
+        worst = int(norms.argmax())
+        self.estimate = norms[worst].sqrt()
+        self.probe = JTJv[worst:worst + 1] / norms[worst].clamp(min=1.0e-30)
+        self.n_updates += 1
+        return self.estimate
+
+    def normalize(self, net, u_prev: latent_variable, u: latent_variable,
+                  Qd: latent_variable):
+        ''' Rescale R to be net.gamma Lipschitz if the estimate exceeds it
+
+            Returns True if R was rescaled.
+        '''
+        estimate = self.update(net.latent_space_forward, u_prev, u, Qd)
+        if estimate <= net.gamma:
+            return False
+        net.rescale_lip_const(net.gamma / estimate)
+        self.n_rescales += 1
+        return True
+
+
+class NormalizationSchedule:
+    ''' Decides when a training solve rescales the latent operator
+
+        Normalizing every batch costs extra latent passes although the
+        weights change little per optimizer step. A schedule lets the
+        normalization fire only
+
+            - every `every` solves (the first solve always normalizes),
+            - when the relative change of the latent weights since the last
+              normalization exceeds drift_tol (if set), or
+            - when the last solve reached max_depth (on_max_depth=True),
+
+        whichever comes first. The default every=1 normalizes on every
+        solve. Counters: n_checks (solves seen), n_fired (normalizations
+        run), n_rescaled (normalizations that changed the weights) and
+        fired_by, which counts the triggers 'interval', 'drift' and
+        'max_depth'. Pass it as lip_schedule in the solver options.
+    '''
+
+    def __init__(self, every=1, drift_tol=None, on_max_depth=True):
+        self.every = every
+        self.drift_tol = drift_tol
+        self.on_max_depth = on_max_depth
+        self.since = None
+        self.capped = False
+        self.snapshot = None
+        self.n_checks = 0
+        self.n_fired = 0
+        self.n_rescaled = 0
+        self.fired_by = {'interval': 0, 'drift': 0, 'max_depth': 0}
+
+    def __str__(self):
+        fmt = 'normalization: fired {:d}/{:d} (interval {:d}, drift {:d}, '
+        fmt += 'max_depth {:d}), rescaled {:d}'
+        return fmt.format(self.n_fired, self.n_checks,
+                          self.fired_by['interval'], self.fired_by['drift'],
+                          self.fired_by['max_depth'], self.n_rescaled)
+
+    def _latent_params(self, net):
+        latent = getattr(net, 'latent_convs', net)
+        return [p.detach() for p in latent.parameters()]
+
+    def drift(self, net):
+        ''' Relative change of the latent weights since the last snapshot '''
+        params = self._latent_params(net)
+        diff = sum(torch.sum((p - q) ** 2)
+                   for p, q in zip(params, self.snapshot))
+        ref = sum(torch.sum(q ** 2) for q in self.snapshot)
+        return float(torch.sqrt(diff / ref.clamp(min=1.0e-30)))
+
+    def observe(self, result, max_depth):
+        ''' Remember whether the solve of result reached max_depth '''
+        self.capped = bool((result.depth >= max_depth).any())
+
+    def due(self, net):
+        ''' True if the normalization should run now (counts the trigger) '''
+        self.n_checks += 1
+        self.since = self.every if self.since is None else self.since + 1
+        trigger = None
+        if self.since >= self.every:
+            trigger = 'interval'
+        elif self.on_max_depth and self.capped:
+            trigger = 'max_depth'
+        elif self.drift_tol is not None and self.snapshot is not None and \
+                self.drift(net) > self.drift_tol:
+            trigger = 'drift'
+        if trigger is not None:
+            self.fired_by[trigger] += 1
+        return trigger is not None
+
+    def fired(self, net, rescaled):
+        ''' Record a normalization that just ran '''
+        self.n_fired += 1
+        self.n_rescaled += int(bool(rescaled))
+        self.since = 0
+        self.capped = False
+        if self.drift_tol is not None:
+            self.snapshot = [p.clone() for p in self._latent_params(net)]
+
+
+class FixedPointSolver:
+    ''' A registered solver together with its options
+
+        Works with any module exposing latent_space_forward(u, Qd), e.g.
+
+            solver = FixedPointSolver('anderson', m=5)
+            result = solver(net, net.data_space_forward(d), eps=1e-3,
+                            max_depth=50)
+
+        Options given to the call override those given to the constructor.
+
+        lip_normalize='before' or 'after' rescales the latent operator with
+        net.normalize_lip_const when the network is in training mode, either
+        at the starting point before solving (so the solution belongs to the
+        rescaled weights) or at the last iterate after solving. With a
+        LipschitzEstimator passed as lip_estimator, the operator is rescaled
+        from its power iteration estimate instead; after solving this takes
+        a single latent pass. A NormalizationSchedule passed as lip_schedule
+        decides which solves normalize at all. Networks with contractive
+        latent layers (net.contractive) are never normalized.
+
+        compiled='compile' or 'script' iterates with the network's
+        CompiledLatentOperator instead of net.latent_space_forward (see its
+        docstring); the default None keeps the eager operator.
+
+        precision selects the arithmetic of the solve: 'fp32' (default),
+        'bf16', 'fp16' or 'auto' (bf16 on CPU, fp16 on CUDA). In low
+        precision, R runs under autocast while the iterates are kept in the
+        dtype of Qd. Once the residual plateaus above eps (stall_ratio,
+        0.9 by default), the solve is finished in full precision from the
+        low precision iterate. The returned solution is always in the dtype
+        of Qd, so the attached step and map_latent_to_inference stay in full
+        precision.
+    '''
+
+    def __init__(self, name='picard', **options):
+        if name not in SOLVERS:
+            raise ValueError('Unknown fixed point solver: ' + str(name)
+                             + ', choose from ' + str(sorted(SOLVERS)))
+        self.name = name
+        self.options = options
+
+    def __repr__(self):
+        return 'FixedPointSolver(' + repr(self.name) + ', ' + \
+            repr(self.options) + ')'
+
+    def __call__(self, net, Qd: latent_variable, eps=1.0e-3, max_depth=100,
+                 lip_normalize=None, **options) -> SolverResult:
+        options = {**self.options, **options}
+        lip_estimator = options.pop('lip_estimator', None)
+        lip_schedule = options.pop('lip_schedule', None)
+        # contractive latent layers need no normalization
+        normalize = net.training and not getattr(net, 'contractive', False)
+        norm_time = 0.0
+        if lip_normalize == 'before' and normalize and \
+                (lip_schedule is None or lip_schedule.due(net)):
+            start = time.perf_counter()
+            u0 = options.get('u0')
+            if u0 is None:
+                u0 = torch.zeros(Qd.shape, device=Qd.device)
+            if lip_estimator is None:
+                rescaled = net.normalize_lip_const(u0, Qd)
+            else:
+                Ru0 = net.latent_space_forward(u0, Qd)
+                rescaled = lip_estimator.normalize(net, u0, Ru0, Qd)
+            if lip_schedule is not None:
+                lip_schedule.fired(net, rescaled)
+            norm_time += time.perf_counter() - start
+
+        precision = options.pop('precision', 'fp32')
+        compiled = options.pop('compiled', None)
+        R = net.latent_space_forward
+        if compiled is not None:
+            R = compiled_latent_operator(net, compiled)
+        start = time.perf_counter()
+        if precision == 'fp32':
+            result = SOLVERS[self.name](R, Qd, eps=eps, max_depth=max_depth,
+                                        **options)
+        else:
+            result = self._mixed_precision_solve(R, Qd, eps, max_depth,
+                                                 precision, options)
+        result.solve_time = time.perf_counter() - start
+        result.residual = sample_residual(result.u, result.u_prev,
+                                          options.get('residual', 'channel'),
+                                          options.get('norm_type', 2))
+
+        if lip_schedule is not None and normalize:
+            lip_schedule.observe(result, max_depth)
+        if lip_normalize == 'after' and normalize and \
+                (lip_schedule is None or lip_schedule.due(net)):
+            start = time.perf_counter()
+            if lip_estimator is None:
+                rescaled = net.normalize_lip_const(result.u_prev, Qd)
+            else:
+                u = result.u
+                if precision != 'fp32':
+                    # the finite difference needs u = R(u_prev) in fp32
+                    u = net.latent_space_forward(result.u_prev, Qd)
+                rescaled = lip_estimator.normalize(net, result.u_prev, u, Qd)
+            if lip_schedule is not None:
+                lip_schedule.fired(net, rescaled)
+            norm_time += time.perf_counter() - start
+        result.norm_time = norm_time
+        return result
+
+    def _mixed_precision_solve(self, R, Qd, eps, max_depth, precision,
+                               options):
+        solver = SOLVERS[self.name]
+        if precision == 'auto':
+            precision = 'fp16' if Qd.device.type == 'cuda' else 'bf16'
+        dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+
+        def R_low(u, v):
+            with torch.autocast(Qd.device.type, dtype=dtype):
+                Ru = R(u, v)
+            return Ru.to(Qd.dtype)
+
+        low = solver(R_low, Qd, eps=eps, max_depth=max_depth,
+                     **{'stall_ratio': 0.9, **options})
+        low_depth = int(low.depth.max())
+        converged = len(low.residual_hist) > 0 and \
+            low.residual_hist[-1] <= eps
+        if converged or low_depth >= max_depth:
+            return low
+
+        # promote to full precision for the remaining iterations
+        options['u0'] = low.u
+        result = solver(R, Qd, eps=eps, max_depth=max_depth - low_depth,
+                        **options)
+        result.depth += low.depth
+        result.residual_hist = low.residual_hist + result.residual_hist
+        return result
+
+
+def make_solver(solver='picard', **options):
+    ''' FixedPointSolver from a registered name or an existing solver '''
+    if isinstance(solver, FixedPointSolver):
+        if not options:
+            return solver
+        return FixedPointSolver(solver.name, **{**solver.options, **options})
+    return FixedPointSolver(solver, **options)
+
+
+# -----------------------------------------------------------------------------
+# Implicit backward modes
+# -----------------------------------------------------------------------------
+BACKWARD_MODES = ('jfb', 'phantom', 'neumann', 'adjoint-fixed-point',
+                  'krylov')
+
+
+def parse_backward(backward):
+    ''' Split a backward spec such as 'phantom:5:0.5' into its mode and args
+
+        e.g. ('phantom', [5, 0.5]) or ('neumann', [5]). Arguments are ints
+        where possible and floats otherwise ('1e-1', '0.5').
+    '''
+    def number(arg):
+        try:
+            return int(arg)
+        except ValueError:
+            return float(arg)
+
+    mode, *args = backward.split(':')
+    if mode not in BACKWARD_MODES:
+        raise ValueError('Unknown backward mode: ' + str(backward)
+                         + ', choose from ' + str(BACKWARD_MODES))
+    return mode, [number(arg) for arg in args]
+
+
+@contextmanager
+def frozen_batch_norm(net):
+    ''' Keep the running statistics of the batch norm layers of net fixed
+
+        Used while R is re-evaluated for a backward solve, which must not
+        count as another batch seen by the batch norm layers. The layers in
+        training mode stop tracking their running statistics, so they
+        normalize with the batch statistics as before but update no buffer
+        in place (which torch.func transforms do not allow).
+    '''
+    bns = [m for m in net.modules()
+           if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d))
+           and m.training and m.track_running_stats]
+    for m in bns:
+        m.track_running_stats = False
+    try:
+        yield
+    finally:
+        for m in bns:
+            m.track_running_stats = True
+
+
+class ImplicitBackward(torch.autograd.Function):
+    ''' Identity on Ru = R(u*, Qd) whose backward solves the adjoint equation
+
+        The gradient of a loss l(u*) at the fixed point u* = R(u*, Qd) with
+        respect to the weights is x^T dR/dtheta, where x solves
+
+            (I - J^T) x = dl/du*,   J = dR/du at u*.
+
+        Applied to the attached step Ru, this Function replaces the incoming
+        gradient g = dl/dRu by an approximation of x, so autograd then
+        propagates x through the graph of Ru to the weights and to Qd. The
+        backward re-evaluates R once at u* (with the batch norm statistics
+        frozen) and applies J^T with vector-Jacobian products on that one
+        graph, so no graph of the forward solve is ever kept.
+
+        mode is one of
+            'neumann'             x = sum_{i=0}^{order} (J^T)^i g,
+            'adjoint-fixed-point' x <-- g + J^T x until the relative change
+                                  is below tol or maxiter steps,
+            'krylov'              BiCGSTAB on (I - J^T) x = g, with the
+                                  whole batch as one system, since batch
+                                  norm couples the samples.
+        The number of vector-Jacobian products of the last backward is
+        stored in ImplicitBackward.n_vjps.
+    '''
+    n_vjps = 0
+
+    @staticmethod
+    def forward(ctx, Ru, u, Qd, net, mode, order, tol, maxiter):
+        ctx.save_for_backward(u.detach(), Qd.detach())
+        ctx.net = net
+        ctx.mode = mode
+        ctx.order = order
+        ctx.tol = tol
+        ctx.maxiter = maxiter
+        return Ru.clone()
+
+    @staticmethod
+    def backward(ctx, grad):
+        u, Qd = ctx.saved_tensors
+        with torch.enable_grad(), frozen_batch_norm(ctx.net):
+            u = u.detach().requires_grad_()
+            Ru = ctx.net.latent_space_forward(u, Qd)
+        n_vjps = [0]
+
+        def JT(x):
+            n_vjps[0] += 1
+            return torch.autograd.grad(Ru, u, x, retain_graph=True)[0]
+
+        if ctx.mode == 'neumann':
+            x, term = grad, grad
+            for _ in range(ctx.order):
+                term = JT(term)
+                x = x + term
+        elif ctx.mode == 'adjoint-fixed-point':
+            x = grad
+            g_norm = torch.norm(grad).clamp(min=1.0e-30)
+            for _ in range(ctx.maxiter):
+                x_new = grad + JT(x)
+                converged = torch.norm(x_new - x) <= ctx.tol * g_norm
+                x = x_new
+                if converged:
+                    break
+        else:
+            shape = grad.shape
+
+            def A_bmm(x):
+                return x - JT(x.view(shape)).reshape(1, -1, 1)
+
+            x, _ = bicgstab_batch(A_bmm, grad.reshape(1, -1, 1),
+                                  X0=grad.reshape(1, -1, 1), rtol=ctx.tol,
+                                  maxiter=ctx.maxiter)
+            x = x.view(shape)
+
+        ImplicitBackward.n_vjps = n_vjps[0]
+        return x, None, None, None, None, None, None, None
+
+
+def implicit_backward(net, Ru, u, Qd, backward='jfb', tol=1.0e-3,
+                      maxiter=100):
+    ''' Attach the backward mode backward to the attached step Ru = R(u, Qd)
+
+        backward is 'jfb' (Ru unchanged, i.e. the Jacobian-free backprop of
+        a single step), 'neumann:k', 'adjoint-fixed-point' or 'krylov', see
+        ImplicitBackward.
+    '''
+    mode, args = parse_backward(backward)
+    if mode == 'jfb':
+        return Ru
+    order = args[0] if args else 1
+    return ImplicitBackward.apply(Ru, u, Qd, net, mode, order, tol, maxiter)
+
+
+def attached_step(net, u, Qd, backward='jfb', tol=1.0e-3, maxiter=100):
+    ''' Step from the fixed point u with gradients attached
+
+        Qd must carry the graph of the data space operator. For 'jfb' and
+        the implicit modes of implicit_backward this is Ru = R(u, Qd).
+        'phantom:k:lam' instead unrolls k damped steps
+
+            u <-- (1 - lam) u + lam R(u, Qd)
+
+        from u with gradients attached (a phantom gradient): memory grows
+        linearly in k, k = 1 with lam = 1 is JFB and larger k moves the
+        gradient towards the implicit one. The defaults are k = 5 and
+        lam = 0.5.
+    '''
+    u = u.detach()
+    mode, args = parse_backward(backward)
+    if mode == 'phantom':
+        n_steps = args[0] if len(args) > 0 else 5
+        lam = args[1] if len(args) > 1 else 0.5
+        for _ in range(n_steps):
+            Ru = net.latent_space_forward(u, Qd)
+            u = Ru if lam == 1 else torch.lerp(u, Ru, lam)
+        return u
+    Ru = net.latent_space_forward(u, Qd)
+    return implicit_backward(net, Ru, u, Qd, backward, tol=tol,
+                             maxiter=maxiter)
+
+
+# -----------------------------------------------------------------------------
+# Linearized latent operator
+# -----------------------------------------------------------------------------
+MATVEC_ENGINES = ('func', 'autograd')
+
+
+class LinearizedLatentOperator:
+    ''' J = I - dR/du of the latent operator R(., Qd) at the fixed point u
+
+        Products are taken in the row vector convention of the Jacobian-based
+        trainers: vJ(v) = v - v dR/du takes one VJP, vJT(v) = v - v dR/du^T
+        one JVP, and vJJT(v) = v J J^T is the matvec of the normal
+        equations. Vectors have the shape of u, or (n_samples, n_dim, 1) as
+        used by the batched Krylov solvers.
+
+        R is linearized once per batch and every matvec reuses it, so no
+        graph is built (or kept) per Krylov iteration. engine='func' uses
+        torch.func.vjp and torch.func.linearize; if linearize cannot trace R
+        (linearized is then False), the JVPs transpose the torch.func VJP
+        instead, which is slower. 'autograd' keeps one graph of R and one
+        double-backward graph for the JVP. If torch.func fails on R
+        altogether, the operator warns and uses 'autograd'; engine is the
+        engine in use. The linearization does not update the batch norm
+        statistics.
+    '''
+
+    def __init__(self, net, u, Qd, engine='func'):
+        if engine not in MATVEC_ENGINES:
+            raise ValueError('Unknown matvec engine: ' + str(engine)
+                             + ', choose from ' + str(MATVEC_ENGINES))
+        self.shape = u.shape
+        self.engine = engine
+        self.linearized = False
+        self.n_vjps = 0
+        self.n_jvps = 0
+        u = u.detach()
+        Qd = Qd.detach()
+
+        def R(u):
+            return net.latent_space_forward(u, Qd)
+
+        with torch.enable_grad(), frozen_batch_norm(net):
+            if engine == 'func':
+                try:
+                    Ru, self._vjp = torch.func.vjp(R, u)
+                except RuntimeError as error:
+                    warnings.warn('torch.func.vjp failed on the latent '
+                                  'operator, using the autograd matvec '
+                                  'engine: ' + str(error))
+                    self.engine = 'autograd'
+            if self.engine == 'func':
+                try:
+                    self._jvp = torch.func.linearize(R, u)[1]
+                    self.linearized = True
+                except RuntimeError as error:
+                    warnings.warn('torch.func.linearize failed on the latent '
+                                  'operator, the JVPs transpose the VJP: '
+                                  + str(error))
+                    # v dR/du is linear in v: its VJP is w dR/du^T
+                    transpose = torch.func.vjp(lambda v: self._vjp(v)[0],
+                                               torch.zeros_like(Ru))[1]
+
+                    def transposed_jvp(w):
+                        return transpose(w)[0]
+                    self._jvp = transposed_jvp
+            if self.engine == 'autograd':
+                u = u.clone().requires_grad_()
+                Ru = R(u)
+                # v dR/du is linear in v, so d(v dR/du)/dv applied to w is
+                # w dR/du^T: one double-backward graph serves every JVP
+                z = torch.zeros_like(Ru, requires_grad=True)
+                z_dRdu = torch.autograd.grad(Ru, u, grad_outputs=z,
+                                             create_graph=True)[0]
+
+                def vjp(v):
+                    return (torch.autograd.grad(Ru, u, grad_outputs=v,
+                                                retain_graph=True)[0],)
+
+                def jvp(w):
+                    return torch.autograd.grad(z_dRdu, z, grad_outputs=w,
+                                               retain_graph=True)[0]
+                self._vjp = vjp
+                self._jvp = jvp
+
+    def vJ(self, v):
+        ''' v J = v - v dR/du (one VJP) '''
+        self.n_vjps += 1
+        w = v.reshape(self.shape)
+        return (w - self._vjp(w)[0].detach()).view(v.shape)
+
+    def vJT(self, v):
+        ''' v J^T = v - v dR/du^T (one JVP) '''
+        self.n_jvps += 1
+        w = v.reshape(self.shape)
+        return (w - self._jvp(w).detach()).view(v.shape)
+
+    def vJJT(self, v, shift=0.0):
+        ''' v (J J^T + shift I), the matvec of the normal equations '''
+        vJJT = self.vJT(self.vJ(v))
+        return vJJT + shift * v if shift else vJJT
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
-import numpy as np
 import torch.nn.functional as F
+from FixedPointSolvers import make_solver, attached_step
 
 classification = torch.tensor
 latent_variable = torch.tensor
@@ -9,38 +9,82 @@ image = torch.tensor
 
 
 def forward_implicit(net, d: image, eps=1.0e-3, max_depth=100,
-                     depth_warning=False):
+                     depth_warning=False, solver=None, cache=None,
+                     indices=None, backward='jfb', **solver_kwargs):
     ''' Fixed Point Iteration forward prop
 
         With gradients detached, find fixed point. During forward iteration,
         u is updated via R(u,Q(d)) and Lipschitz constant estimates are
         refined. Gradient are attached performing one final step.
+
+        solver selects the fixed point solver, either by name from
+        FixedPointSolvers.SOLVERS ('picard', 'relaxed', 'anderson',
+        'broyden', 'multires') or as a FixedPointSolver; by default the
+        solver and options stored on the network (net.solver,
+        net.solver_kwargs) are used. Keyword arguments are passed on to the
+        solver, e.g. active_set=True for Picard, m and beta for Anderson, a
+        BroydenState to reuse, precision='bf16' for a low precision solve,
+        compiled='compile' to iterate with the compiled, fused latent
+        operator, or adaptive=True for relaxation with per-sample step sizes
+        (solver='relaxed'). solver='multires' starts from the solution at a
+        coarser resolution.
+
+        The SolverResult of the solve is stored in net.solve_report, with the
+        number of iterations and the final residual of each sample, the
+        residual history and the time spent solving and normalizing. For
+        convenience, the per-sample depths are also stored in
+        net.sample_depth, the largest of them in net.depth and the number of
+        samples that reached max_depth without converging in net.capped.
+
+        If a FixedPointSolvers.LatentCache is given, the iteration of each
+        sample starts from its cached fixed point (found by the sample
+        indices) and the new fixed points are stored in the cache.
+
+        backward selects the gradient of the attached step: 'jfb' (default)
+        backpropagates through the single step only, 'phantom:k:lam'
+        through k damped steps (see FixedPointSolvers.attached_step), and
+        'neumann:k', 'adjoint-fixed-point' and 'krylov' approximate the
+        implicit gradient with a custom autograd Function
+        (FixedPointSolvers.ImplicitBackward), so a plain loss.backward()
+        works in every mode and the memory of the backward does not grow
+        with the solve. The adjoint solves use eps as
+        relative tolerance and max_depth as iteration limit.
+
+        In training, Q(d) is computed once with gradients: the solve
+        iterates on Qd.detach() and the attached step reuses Qd, so the
+        BatchNorm running statistics are updated once per forward and the
+        solve and the attached step share the same dropout masks.
     '''
 
-    with torch.no_grad():
-        net.depth = 0.0
+    if solver is None:
+        solver = make_solver(getattr(net, 'solver', 'picard'),
+                             **getattr(net, 'solver_kwargs', {}))
+    solver = make_solver(solver, **solver_kwargs)
+
+    attach_gradients = net.training
+    with torch.set_grad_enabled(attach_gradients and torch.is_grad_enabled()):
         Qd = net.data_space_forward(d)
-        u = torch.zeros(Qd.shape, device=net.device())
-        u_prev = np.Inf*torch.ones(u.shape, device=net.device())
-        all_samp_conv = False
-        while not all_samp_conv and net.depth < max_depth:
-            u_prev = u.clone()
-            u = net.latent_space_forward(u, Qd)
-            res_norm = torch.max(torch.norm(u - u_prev, dim=1))
-            net.depth += 1.0
-            all_samp_conv = res_norm <= eps
-
-        if net.training:
-            net.normalize_lip_const(u_prev, Qd)
+
+    with torch.no_grad():
+        u0 = None
+        if cache is not None:
+            u0 = cache.lookup(indices, Qd)
+        result = solver(net, Qd.detach(), eps=eps, max_depth=max_depth,
+                        u0=u0, lip_normalize='after')
+        u = result.u
+        net.solve_report = result
+        net.sample_depth = result.depth
+        net.depth = float(result.depth.max())
+        net.capped = result.capped(eps, max_depth)
+        if cache is not None:
+            cache.store(indices, u)
 
     if net.depth >= max_depth and depth_warning:
         print("\nWarning: Max Depth Reached - Break Forward Loop\n")
 
-    attach_gradients = net.training
     if attach_gradients:
-        Qd = net.data_space_forward(d)
-        return net.map_latent_to_inference(
-            net.latent_space_forward(u.detach(), Qd))
+        Ru = attached_step(net, u, Qd, backward, tol=eps, maxiter=max_depth)
+        return net.map_latent_to_inference(Ru)
     else:
         return net.map_latent_to_inference(u).detach()
 
@@ -77,8 +121,12 @@ def normalize_lip_const(net, u: latent_variable, v: latent_variable):
 
         which is accurate up to an identity term scaled by (norm_fact - 1).
         If we do this often enough, then norm_fact ~ 1.0 and the identity
-        term is negligible.
+        term is negligible. Returns True if the convolutions were rescaled.
+        Networks with contractive latent convolutions need no normalization,
+        so nothing is done for them.
     '''
+    if getattr(net, 'contractive', False):
+        return False
     noise_u = torch.randn(u.size(), device=net.device())
     noise_v = torch.randn(u.size(), device=net.device())
     w = u.clone() + noise_u
@@ -89,12 +137,183 @@ def normalize_lip_const(net, u: latent_variable, v: latent_variable):
     R_is_gamma_lip = R_diff_norm <= net.gamma * u_diff_norm
     if not R_is_gamma_lip:
         violation_ratio = net.gamma * u_diff_norm / R_diff_norm
-        normalize_factor = violation_ratio ** (1.0 / net._lat_layers)
-        for i in range(net._lat_layers):
-            net.latent_convs[i][0].weight.data *= normalize_factor
-            net.latent_convs[i][0].bias.data *= normalize_factor
-            net.latent_convs[i][3].weight.data *= normalize_factor
-            net.latent_convs[i][3].bias.data *= normalize_factor
+        rescale_latent_convs(net, violation_ratio)
+    return not R_is_gamma_lip
+
+
+def rescale_latent_convs(net, violation_ratio):
+    ''' Scale the convolutions of R by violation_ratio overall
+
+        Each of the _lat_layers residual blocks is scaled by the
+        _lat_layers-th root of violation_ratio, see normalize_lip_const.
+    '''
+    if getattr(net, 'contractive', False):
+        return
+    normalize_factor = violation_ratio ** (1.0 / net._lat_layers)
+    for i in range(net._lat_layers):
+        net.latent_convs[i][0].weight.data *= normalize_factor
+        net.latent_convs[i][0].bias.data *= normalize_factor
+        net.latent_convs[i][3].weight.data *= normalize_factor
+        net.latent_convs[i][3].bias.data *= normalize_factor
+
+
+class ContractiveConv2d(nn.Conv2d):
+    ''' Conv2d with operator norm bounded by bound
+
+        The convolution is applied with weight * min(1, bound / sigma), where
+        sigma is the spectral norm of the convolution as a linear map on
+        inputs of shape (in_channels, *input_size), i.e. including the
+        padding, not just of the reshaped kernel. sigma is estimated by
+        power iteration on a persistent probe buffer: one step (conv followed
+        by its transpose) whenever the weight has changed in training mode,
+        e.g. after an optimizer step, so the fixed point iterations of a
+        batch share a single estimate. With gradients enabled, sigma is
+        recomputed differentiably from the probe, as in
+        torch.nn.utils.spectral_norm. The bias does not change the Lipschitz
+        constant and is not scaled.
+    '''
+
+    def __init__(self, in_channels, out_channels, kernel_size, input_size,
+                 bound=1.0, n_power_iterations=1, **kwargs):
+        super().__init__(in_channels, out_channels, kernel_size, **kwargs)
+        self.bound = bound
+        self.input_size = tuple(input_size)
+        self.n_power_iterations = n_power_iterations
+        probe = torch.randn(1, in_channels, *self.input_size)
+        self.register_buffer('probe', probe / torch.norm(probe))
+        self.register_buffer('sigma', torch.ones(()))
+        self._weight_version = None
+        self.power_iteration(n_iterations=20)
+
+    def _conv(self, x, weight):
+        return F.conv2d(x, weight, None, self.stride, self.padding,
+                        self.dilation, self.groups)
+
+    def _conv_transpose(self, y, weight):
+        x = F.conv_transpose2d(y, weight, None, self.stride, self.padding, 0,
+                               self.groups, self.dilation)
+        # rows and columns dropped by the stride get no contribution
+        return F.pad(x, (0, self.input_size[1] - x.shape[-1],
+                         0, self.input_size[0] - x.shape[-2]))
+
+    def power_iteration(self, n_iterations=None):
+        ''' Refine the probe and the stored sigma of the current weight '''
+        n_iterations = n_iterations or self.n_power_iterations
+        with torch.no_grad():
+            x = self.probe
+            for _ in range(n_iterations):
+                x = self._conv_transpose(self._conv(x, self.weight),
+                                         self.weight)
+                x = x / torch.norm(x).clamp(min=1.0e-12)
+            self.probe.copy_(x)
+            self.sigma.copy_(torch.norm(self._conv(x, self.weight)))
+        self._weight_version = self.weight._version
+
+    def forward(self, x):
+        if self.training and self._weight_version != self.weight._version:
+            self.power_iteration()
+        sigma = self.sigma
+        if torch.is_grad_enabled() and self.weight.requires_grad:
+            sigma = torch.norm(self._conv(self.probe, self.weight))
+        scale = (self.bound / sigma).clamp(max=1.0)
+        return F.conv2d(x, self.weight * scale, self.bias, self.stride,
+                        self.padding, self.dilation, self.groups)
+
+
+def latent_conv2d(num_channels, contractive=False, input_size=None,
+                  bound=1.0):
+    ''' 3x3 convolution of the latent residual blocks '''
+    if contractive:
+        return ContractiveConv2d(num_channels, num_channels, kernel_size=3,
+                                 input_size=input_size, bound=bound,
+                                 stride=1, padding=(1, 1))
+    return nn.Conv2d(in_channels=num_channels, out_channels=num_channels,
+                     kernel_size=3, stride=1, padding=(1, 1))
+
+
+def scaled(factor, x):
+    ''' factor * x for the Python float factor (e.g. gamma) of R
+
+        factor is taken as a 0-dim tensor: torch.func.linearize (torch 2.0)
+        cannot trace the product of a tensor with a Python float, which
+        would keep the 'func' matvec engine of LinearizedLatentOperator from
+        linearizing R.
+    '''
+    return torch.as_tensor(factor, dtype=x.dtype) * x
+
+
+def contractive_conv_bound(gamma, lip_bound, lat_layers):
+    ''' Operator norm bound of the latent convs making R lip_bound Lipschitz
+
+        Each residual block u + LeakyReLU(conv(LeakyReLU(conv(u)))) is at
+        most 1 + c^2 Lipschitz when both convs are bounded by c (LeakyReLU
+        is 1-Lipschitz) and R scales the blocks' input or output by gamma,
+        so gamma * (1 + c^2)^lat_layers = lip_bound.
+    '''
+    if not gamma < lip_bound < 1.0:
+        raise ValueError('lip_bound must lie in (contraction_factor, 1), '
+                         'got ' + str(lip_bound))
+    return ((lip_bound / gamma) ** (1.0 / lat_layers) - 1.0) ** 0.5
+
+
+def check_contractive_architecture(contractive, architecture):
+    ''' Contractive convs only certify R without latent batch norm
+
+        The batch norm architectures normalize with batch statistics in
+        training mode, which have no Lipschitz bound (see
+        latent_lipschitz_bound), so they would run with neither a
+        certificate nor normalize_lip_const.
+    '''
+    if contractive and architecture != 'Jacobian':
+        raise ValueError('contractive latent convs need '
+                         'architecture=\'Jacobian\' (no latent batch norm), '
+                         'got ' + str(architecture))
+
+
+def latent_lipschitz_bound(net):
+    ''' Certified Lipschitz constant of R in u for contractive networks
+
+        Computed from the stored operator norms of the latent convs. Latent
+        batch norm layers scale by at most max(1 / sqrt(running_var + eps))
+        in eval mode; in training mode they use batch statistics, which
+        have no such bound, so None is returned (also for networks without
+        contractive convs). For a bound L < 1, the Picard iteration reaches
+        |u_k - u*| <= L^k |u_0 - u*|, which bounds the depth for a given eps.
+    '''
+    if not getattr(net, 'contractive', False):
+        return None
+    bound = net.gamma
+    for idx, conv in enumerate(net.latent_convs):
+        sigma_0 = min(float(conv[0].sigma), conv[0].bound)
+        sigma_3 = min(float(conv[3].sigma), conv[3].bound)
+        bound *= 1.0 + sigma_0 * sigma_3
+        if net.architecture != 'Jacobian':
+            if net.training:
+                return None
+            bn = net.lat_batch_norm[idx]
+            bound *= float((bn.running_var + bn.eps).rsqrt().max())
+    return bound
+
+
+def fused_latent_space_forward(net, u: latent_variable, v: latent_variable):
+    ''' latent_space_forward of MNIST_FPN and SVHN_FPN for the no-grad solve
+
+        Computes the same R(u,v) with fewer kernels and allocations: the
+        no-op drop_outR layers are skipped, the two consecutive LeakyReLUs
+        at the end of each block are merged into one with the squared slope,
+        and the residual adds and the gamma scaling are done in place. The
+        layers are taken from latent_convs by index, so the module structure
+        (and saved state dicts) are unchanged. Only valid without autograd.
+    '''
+    slope = net.leaky_relu.negative_slope
+    uv = u + v
+    for idx, conv in enumerate(net.latent_convs):
+        res = F.leaky_relu(conv[0](uv), slope, inplace=True)
+        res = F.leaky_relu(conv[3](res), slope ** 2, inplace=True)
+        uv = uv.add_(res)
+        if net.architecture != 'Jacobian':
+            uv = net.lat_batch_norm[idx](uv)
+    return uv.mul_(net.gamma)
 
 
 # ------------------------------------------------------------------------------------------------
@@ -103,7 +322,8 @@ def normalize_lip_const(net, u: latent_variable, v: latent_variable):
 
 class MNIST_FPN(nn.Module):
     def __init__(self, lat_layers=4, num_channels=32, contraction_factor=0.1,
-                 momentum=0.1, architecture='FPN'):
+                 momentum=0.1, architecture='FPN', solver='picard',
+                 solver_kwargs=None, contractive=False, lip_bound=0.95):
         super().__init__()
 
         self._channels = num_channels
@@ -116,6 +336,8 @@ class MNIST_FPN(nn.Module):
         self.max_pool = nn.MaxPool2d(kernel_size=3)
         self.architecture = architecture
         self.depth = 0.0
+        self.solver = solver
+        self.solver_kwargs = solver_kwargs or {}
 
         self.channel_dim = 32
 
@@ -124,17 +346,23 @@ class MNIST_FPN(nn.Module):
         self.conv_d2 = nn.Conv2d(16, 32, kernel_size=3, stride=1, padding=1,
                                  bias=True)
 
+        # contractive latent convs keep R lip_bound Lipschitz without
+        # normalize_lip_const (latent features are 9x9)
+        check_contractive_architecture(contractive, architecture)
+        self.contractive = contractive
+        bound = None
+        if contractive:
+            bound = contractive_conv_bound(self.gamma, lip_bound, lat_layers)
+
         self.latent_convs = nn.ModuleList([nn.Sequential(
-                                           nn.Conv2d(in_channels=num_channels,
-                                                     out_channels=num_channels,
-                                                     kernel_size=3, stride=1,
-                                                     padding=(1, 1)),
+                                           latent_conv2d(num_channels,
+                                                         contractive, (9, 9),
+                                                         bound),
                                            self.leaky_relu,
                                            self.drop_outR,
-                                           nn.Conv2d(in_channels=num_channels,
-                                                     out_channels=num_channels,
-                                                     kernel_size=3, stride=1,
-                                                     padding=(1, 1)),
+                                           latent_conv2d(num_channels,
+                                                         contractive, (9, 9),
+                                                         bound),
                                            self.leaky_relu,
                                            self.drop_outR)
                                            for _ in range(lat_layers)])
@@ -195,9 +423,13 @@ class MNIST_FPN(nn.Module):
                 uv = uv + res
             else:
                 uv = self.lat_batch_norm[idx](uv + res)
-        R_uv = self.gamma * uv
+        R_uv = scaled(self.gamma, uv)
         return R_uv
 
+    def latent_space_forward_fused(self, u: latent_variable,
+                                   v: latent_variable):
+        return fused_latent_space_forward(self, u, v)
+
     def map_latent_to_inference(self, u: latent_variable) -> classification:
         ''' Transform feature vectors into a classification
 
@@ -212,7 +444,7 @@ class MNIST_FPN(nn.Module):
         return y
 
     def forward(self, d: image, eps=1.0e-3, max_depth=100,
-                depth_warning=False) -> classification:
+                depth_warning=False, **solver_kwargs) -> classification:
         ''' FPN forward prop
 
             With gradients detached, find fixed point. During forward
@@ -226,11 +458,17 @@ class MNIST_FPN(nn.Module):
                                     depth_warning=False)
         else:
             return forward_implicit(self, d, eps=eps, max_depth=max_depth,
-                                    depth_warning=False)
+                                    depth_warning=False, **solver_kwargs)
 
     def normalize_lip_const(self, u: latent_variable, v: latent_variable):
         return normalize_lip_const(self, u, v)
 
+    def rescale_lip_const(self, violation_ratio):
+        return rescale_latent_convs(self, violation_ratio)
+
+    def lipschitz_bound(self):
+        return latent_lipschitz_bound(self)
+
 
 # -----------------------------------------------------------------------------
 # SVHN Architectures
@@ -308,7 +546,8 @@ def _make_layer(net, block, planes, num_blocks, stride):
 class SVHN_FPN(nn.Module):
     def __init__(self, lat_layers=4, num_channels=32, contraction_factor=0.1,
                  momentum=0.1, block=BasicBlock, num_blocks=[1, 1, 1],
-                 architecture='FPN'):
+                 architecture='FPN', solver='picard', solver_kwargs=None,
+                 contractive=False, lip_bound=0.95):
         super().__init__()
         self.avg_pool = nn.AvgPool2d(kernel_size=2)
         self._channels = num_channels
@@ -320,6 +559,8 @@ class SVHN_FPN(nn.Module):
         self.mom = momentum
         self.architecture = architecture
         self.depth = 0.0
+        self.solver = solver
+        self.solver_kwargs = solver_kwargs or {}
 
         self.channel_dim = 64
 
@@ -331,17 +572,23 @@ class SVHN_FPN(nn.Module):
         self.layer2 = self._make_layer(block, 32, num_blocks[1], stride=2)
         self.layer3 = self._make_layer(block, 64, num_blocks[2], stride=2)
 
+        # contractive latent convs keep R lip_bound Lipschitz without
+        # normalize_lip_const (latent features are 8x8)
+        check_contractive_architecture(contractive, architecture)
+        self.contractive = contractive
+        bound = None
+        if contractive:
+            bound = contractive_conv_bound(self.gamma, lip_bound, lat_layers)
+
         self.latent_convs = nn.ModuleList([nn.Sequential(
-                                           nn.Conv2d(in_channels=num_channels,
-                                                     out_channels=num_channels,
-                                                     kernel_size=3, stride=1,
-                                                     padding=(1, 1)),
+                                           latent_conv2d(num_channels,
+                                                         contractive, (8, 8),
+                                                         bound),
                                            self.leaky_relu,
                                            self.drop_outR,
-                                           nn.Conv2d(in_channels=num_channels,
-                                                     out_channels=num_channels,
-                                                     kernel_size=3, stride=1,
-                                                     padding=(1, 1)),
+                                           latent_conv2d(num_channels,
+                                                         contractive, (8, 8),
+                                                         bound),
                                            self.leaky_relu,
                                            self.drop_outR)
                                            for _ in range(lat_layers)])
@@ -401,16 +648,20 @@ class SVHN_FPN(nn.Module):
             for idx, conv in enumerate(self.latent_convs):
                 res = (self.leaky_relu(conv(uv)))
                 uv = uv + res
-            R_uv = self.gamma * uv
+            R_uv = scaled(self.gamma, uv)
             return R_uv
         else:
             uv = u + v
             for idx, conv in enumerate(self.latent_convs):
                 res = (self.leaky_relu(conv(uv)))
                 uv = self.lat_batch_norm[idx](uv + res)
-            R_uv = self.gamma * uv
+            R_uv = scaled(self.gamma, uv)
             return R_uv
 
+    def latent_space_forward_fused(self, u: latent_variable,
+                                   v: latent_variable):
+        return fused_latent_space_forward(self, u, v)
+
     def map_latent_to_inference(self, u: latent_variable) -> classification:
         ''' Transform feature vectors into a classification
 
@@ -426,7 +677,7 @@ class SVHN_FPN(nn.Module):
         return y
 
     def forward(self, d: image, eps=1.0e-3, max_depth=100,
-                depth_warning=False) -> classification:
+                depth_warning=False, **solver_kwargs) -> classification:
         ''' FPN forward prop
 
             With gradients detached, find fixed point. During forward
@@ -440,11 +691,17 @@ class SVHN_FPN(nn.Module):
                                     depth_warning=False)
         else:
             return forward_implicit(self, d, eps=eps, max_depth=max_depth,
-                                    depth_warning=False)
+                                    depth_warning=False, **solver_kwargs)
 
     def normalize_lip_const(self, u: latent_variable, v: latent_variable):
         return normalize_lip_const(self, u, v)
 
+    def rescale_lip_const(self, violation_ratio):
+        return rescale_latent_convs(self, violation_ratio)
+
+    def lipschitz_bound(self):
+        return latent_lipschitz_bound(self)
+
     def _make_layer(self, block, planes, num_blocks, stride):
 
         return _make_layer(self, block, planes, num_blocks, stride)
@@ -455,7 +712,9 @@ class SVHN_FPN(nn.Module):
 # -----------------------------------------------------------------------------
 class CIFAR10_FPN(nn.Module):
     def __init__(self, data_layers=16, num_channels=35, contraction_factor=0.5,
-                 momentum=0.1, lat_layers=5, architecture='FPN'):
+                 momentum=0.1, lat_layers=5, architecture='FPN',
+                 solver='picard', solver_kwargs=None, contractive=False,
+                 lip_bound=0.95):
         super().__init__()
         self.avg_pool = nn.AvgPool2d(kernel_size=2)
         self._channels = num_channels
@@ -469,6 +728,8 @@ class CIFAR10_FPN(nn.Module):
         self._lat_layers = lat_layers
         self.mom = momentum
         self.depth = 0.0
+        self.solver = solver
+        self.solver_kwargs = solver_kwargs or {}
 
         def in_chan(i):
             return 35
@@ -501,18 +762,24 @@ class CIFAR10_FPN(nn.Module):
                                       padding=(1, 1)))
                             for i in range(2 * data_layers)])
 
+        # contractive latent convs keep R lip_bound Lipschitz without
+        # normalize_lip_const (latent features are 10x10)
+        check_contractive_architecture(contractive, architecture)
+        self.contractive = contractive
+        bound = None
+        if contractive:
+            bound = contractive_conv_bound(self.gamma, lip_bound, lat_layers)
+
         self.latent_convs = nn.ModuleList([nn.Sequential(
-                                nn.Conv2d(in_channels=num_channels,
-                                          out_channels=num_channels,
-                                          kernel_size=3, stride=1,
-                                          padding=(1, 1)),
-                                self.leaky_relu,
-                                self.drop_outR,
-                                nn.Conv2d(in_channels=num_channels,
-                                          out_channels=num_channels,
-                                          kernel_size=3, stride=1,
-                                          padding=(1, 1)))
-                                for _ in range(lat_layers)])
+                                           latent_conv2d(num_channels,
+                                                         contractive, (10, 10),
+                                                         bound),
+                                           self.leaky_relu,
+                                           self.drop_outR,
+                                           latent_conv2d(num_channels,
+                                                         contractive, (10, 10),
+                                                         bound))
+                                           for _ in range(lat_layers)])
 
         self.dat_batch_norm = nn.ModuleList([nn.BatchNorm2d(out_chan(i),
                                                             momentum=self.mom,
@@ -576,18 +843,36 @@ class CIFAR10_FPN(nn.Module):
             Lipschitz constant and normalize updates using this.
         '''
         if self.architecture == 'Jacobian':
-            R_uv = v + self.gamma * u
+            R_uv = v + scaled(self.gamma, u)
             for idx, leaky_conv in enumerate(self.latent_convs):
                 res = leaky_conv(R_uv)
                 R_uv = self.leaky_relu(R_uv + res)
             return R_uv
         else:
-            R_uv = v + self.gamma * u
+            R_uv = v + scaled(self.gamma, u)
             for idx, leaky_conv in enumerate(self.latent_convs):
                 res = leaky_conv(R_uv)
                 R_uv = self.lat_batch_norm[idx](self.leaky_relu(R_uv + res))
             return R_uv
 
+    def latent_space_forward_fused(self, u: latent_variable,
+                                   v: latent_variable):
+        ''' latent_space_forward for the no-grad solve
+
+            Same R(u,v) with the no-op drop_outR skipped, v + gamma * u
+            computed in one kernel and the residual adds and activations
+            done in place. Only valid without autograd.
+        '''
+        slope = self.leaky_relu.negative_slope
+        R_uv = torch.add(v, u, alpha=self.gamma)
+        for idx, leaky_conv in enumerate(self.latent_convs):
+            res = F.leaky_relu(leaky_conv[0](R_uv), slope, inplace=True)
+            res = leaky_conv[3](res).add_(R_uv)
+            R_uv = F.leaky_relu(res, slope, inplace=True)
+            if self.architecture != 'Jacobian':
+                R_uv = self.lat_batch_norm[idx](R_uv)
+        return R_uv
+
     def map_latent_to_inference(self, u: latent_variable) -> classification:
         ''' Transform feature vectors into a classification
 
@@ -601,7 +886,7 @@ class CIFAR10_FPN(nn.Module):
         return class_label
 
     def forward(self, d: image, eps=1.0e-3, max_depth=100,
-                depth_warning=False) -> classification:
+                depth_warning=False, **solver_kwargs) -> classification:
         ''' FPN forward prop
 
             With gradients detached, find fixed point. During forward
@@ -616,7 +901,13 @@ class CIFAR10_FPN(nn.Module):
                                     depth_warning=False)
         else:
             return forward_implicit(self, d, eps=eps, max_depth=max_depth,
-                                    depth_warning=False)
+                                    depth_warning=False, **solver_kwargs)
 
     def normalize_lip_const(self, u: latent_variable, v: latent_variable):
         return normalize_lip_const(self, u, v)
+
+    def rescale_lip_const(self, violation_ratio):
+        return rescale_latent_convs(self, violation_ratio)
+
+    def lipschitz_bound(self):
+        return latent_lipschitz_bound(self)
@@ -0,0 +1,304 @@
+from abc import ABC, abstractmethod
+import torch
+
+PRECONDITIONERS = {}
+
+
+def register_preconditioner(name):
+    ''' Decorator adding a preconditioner class to PRECONDITIONERS as name '''
+    def register(cls):
+        PRECONDITIONERS[name] = cls
+        return cls
+    return register
+
+
+@register_preconditioner('shift')
+class TikhonovShift:
+    ''' Tikhonov shift A + shift I of the adjoint system, without M
+
+        Base class of the preconditioners. A preconditioner is used around a
+        batched Krylov solve as
+
+            preconditioner.update(A_bmm, B)
+            X, info = cg_batch(preconditioner.shifted(A_bmm), B,
+                               M_bmm=preconditioner.M_bmm, ...)
+            preconditioner.observe(info)
+
+        where A_bmm is the unshifted matvec. With target_iters set the
+        shift is adaptive: it grows by factor (starting from at least
+        min_shift) after a solve that took more than target_iters iterations
+        and shrinks by factor after one that took fewer than half of them,
+        within [min_shift, max_shift]. The shift regularizes the (normal)
+        equations, so it trades bias of the gradient for fewer iterations.
+        Counters: n_solves, n_refreshes, n_matvecs (spent building M) and
+        niter (Krylov iterations of the last solve).
+    '''
+
+    def __init__(self, shift=0.0, target_iters=None, factor=2.0,
+                 min_shift=1.0e-6, max_shift=1.0):
+        self.shift = shift
+        self.target_iters = target_iters
+        self.factor = factor
+        self.min_shift = min_shift
+        self.max_shift = max_shift
+        self.n_solves = 0
+        self.n_refreshes = 0
+        self.n_matvecs = 0
+        self.niter = 0
+
+    def __str__(self):
+        fmt = '{:s}: shift = {:.1e}, refreshed {:d}/{:d} ({:d} matvecs)'
+        return fmt.format(type(self).__name__, self.shift, self.n_refreshes,
+                          self.n_solves, self.n_matvecs)
+
+    def shifted(self, A_bmm):
+        ''' The matvec of A + shift I (with the shift at call time) '''
+        def A_shift_bmm(X):
+            AX = A_bmm(X)
+            return AX + self.shift * X if self.shift else AX
+        return A_shift_bmm
+
+    def update(self, A_bmm, B):
+        ''' Called before every solve of A X = B (refreshes M when due) '''
+        self.n_solves += 1
+
+    def M_bmm(self, X):
+        return X
+
+    def observe(self, info):
+        ''' Adapt the shift to the iterations of the solve that just ran '''
+        self.niter = info['niter']
+        if self.target_iters is None:
+            return
+        if self.niter > self.target_iters:
+            self.shift = min(max(self.shift, self.min_shift) * self.factor,
+                             self.max_shift)
+        elif 2 * self.niter < self.target_iters:
+            self.shift = max(self.shift / self.factor, self.min_shift)
+
+
+class RefreshedPreconditioner(TikhonovShift, ABC):
+    ''' A preconditioner approximating A from matvecs every refresh_every
+        solves
+
+        The approximation is shared by the systems of the batch (it is
+        built from the average over the batch), so it can be reused for the
+        next batches while the weights change little. It approximates the
+        unshifted A; the current shift is added when M is applied.
+    '''
+
+    def __init__(self, refresh_every=1, **kwargs):
+        super().__init__(**kwargs)
+        self.refresh_every = refresh_every
+
+    def update(self, A_bmm, B):
+        if self.n_solves % self.refresh_every == 0:
+            self.refresh(A_bmm, B)
+            self.n_refreshes += 1
+        super().update(A_bmm, B)
+
+    @abstractmethod
+    def refresh(self, A_bmm, B):
+        ''' Rebuild the approximation of A from matvecs A_bmm like B '''
+
+
+@register_preconditioner('diagonal')
+class HutchinsonDiagonal(RefreshedPreconditioner):
+    ''' Jacobi preconditioner M = (diag(A) + shift I)^{-1}
+
+        diag(A) = E[z * A z] is estimated with n_probes Rademacher probes z
+        per system (n_probes matvecs per refresh); the absolute values of
+        the estimates are averaged over the batch and clamped to rel_floor
+        times their mean.
+    '''
+
+    def __init__(self, n_probes=4, rel_floor=1.0e-2, **kwargs):
+        super().__init__(**kwargs)
+        self.n_probes = n_probes
+        self.rel_floor = rel_floor
+        self.diagonal = None
+
+    def refresh(self, A_bmm, B):
+        estimate = torch.zeros_like(B)
+        for _ in range(self.n_probes):
+            z = torch.randint_like(B, 2) * 2 - 1
+            estimate += z * A_bmm(z)
+        self.n_matvecs += self.n_probes
+        estimate = estimate.abs().mean(0) / self.n_probes
+        self.diagonal = estimate.clamp(min=self.rel_floor
+                                       * float(estimate.mean()))
+
+    def M_bmm(self, X):
+        if self.diagonal is None:
+            return X
+        return X / (self.diagonal + self.shift)
+
+
+@register_preconditioner('nystrom')
+class NystromPreconditioner(RefreshedPreconditioner):
+    ''' Randomized Nystrom preconditioner of a positive semidefinite A
+
+        A ~ U diag(lam) U^T of rank `rank` from rank matvecs with an
+        orthonormal Gaussian sketch, and
+
+            M = (lam_min + shift) U (diag(lam) + shift I)^{-1} U^T
+                + (I - U U^T)
+
+        which maps the top of the spectrum of A + shift I to about
+        lam_min + shift. M uses a shift of at least 1e-6 lam_max so that it
+        stays nonsingular. Only for the normal equations (linear_solver
+        'cg'); a failed factorization keeps the previous approximation.
+    '''
+
+    def __init__(self, rank=10, **kwargs):
+        super().__init__(**kwargs)
+        self.rank = rank
+        self.U = None
+        self.eigenvalues = None
+
+    def refresh(self, A_bmm, B):
+        K, n, m = B.shape
+        Omega = torch.linalg.qr(torch.randn(n, self.rank, dtype=B.dtype,
+                                            device=B.device))[0]
+        Y = torch.stack([A_bmm(omega.view(1, n, 1).expand(K, n, m)).mean(0)
+                         .mean(-1) for omega in Omega.t()], dim=1)
+        self.n_matvecs += self.rank
+
+        nu = n**0.5 * torch.finfo(B.dtype).eps * torch.norm(Y)
+        Y_nu = Y + nu * Omega
+        L, info = torch.linalg.cholesky_ex(Omega.t() @ Y_nu)
+        if int(info) != 0:
+            return
+        F = torch.linalg.solve_triangular(L, Y_nu.t(), upper=False).t()
+        U, S, _ = torch.linalg.svd(F, full_matrices=False)
+        self.U = U
+        self.eigenvalues = (S**2 - nu).clamp(min=0)
+
+    def M_bmm(self, X):
+        if self.U is None:
+            return X
+        UtX = torch.einsum('nk,bnm->bkm', self.U, X)
+        mu = max(self.shift, 1.0e-6 * float(self.eigenvalues[0]))
+        scale = ((self.eigenvalues[-1] + mu)
+                 / (self.eigenvalues + mu).clamp(min=1.0e-30))
+        return X + torch.einsum('nk,bkm->bnm', self.U,
+                                (scale.view(1, -1, 1) - 1) * UtX)
+
+
+class KrylovRecycler:
+    ''' Deflated CG solves of consecutive batches from a recycled subspace
+
+        The operators of consecutive batches differ by one optimizer step,
+        so their solutions share the directions that are hard for CG (the
+        eigenvectors of the small eigenvalues of A). The recycler keeps an
+        orthonormal basis W (n x rank, shared by the systems of the batch)
+        of the leading left singular vectors of the previous solutions and
+        deflates the next solve of the symmetric system A X = B with it
+        (deflated PCG in its A-DEF2 form): with E = W^T A W per system,
+
+            X0 = W E^{-1} W^T B,
+            M_D R = P^T M R + W E^{-1} W^T R,  P^T = I - W E^{-1} (A W)^T,
+
+        so the residual stays orthogonal to W and CG iterates as if the
+        eigenvalues that W captures were removed. A W is computed once per
+        solve (rank matvecs); an iteration still takes one matvec. After the
+        solve, W is updated from the singular vectors of
+        [decay W diag(s), X].
+
+        The savings are measured: every measure_every-th deflated solve is
+        compared with a cold (undeflated) solve of the same system, and
+        iterations_saved and matvecs_saved (net of those spent on A W) sum
+        the differences over these n_measured solves. Counters: n_solves,
+        n_deflated, n_matvecs (spent on A W), deflation_matvecs (of the
+        last solve) and niter (iterations of the last solve).
+    '''
+
+    def __init__(self, rank=5, decay=0.5, measure_every=20):
+        self.rank = rank
+        self.decay = decay
+        self.measure_every = measure_every
+        self.W = None
+        self.singular_values = None
+        self.n_solves = 0
+        self.n_deflated = 0
+        self.n_matvecs = 0
+        self.deflation_matvecs = 0
+        self.niter = 0
+        self.n_measured = 0
+        self.iterations_saved = 0
+        self.matvecs_saved = 0
+
+    def __str__(self):
+        fmt = '{:s}: rank {:d}, deflated {:d}/{:d} solves ({:d} matvecs on '
+        fmt += 'A W) | measured on {:d} solves: {:d} iterations and {:d} '
+        fmt += 'matvecs saved'
+        rank = 0 if self.W is None else self.W.shape[1]
+        return fmt.format(type(self).__name__, rank, self.n_deflated,
+                          self.n_solves, self.n_matvecs, self.n_measured,
+                          self.iterations_saved, self.matvecs_saved)
+
+    def deflate(self, A_bmm, B, M_bmm=None):
+        ''' The initial guess X0, A X0 and the deflated preconditioner of
+            the solve of A X = B (None, None and M_bmm before the first
+            solution was observed)
+        '''
+        self.n_solves += 1
+        self.deflation_matvecs = 0
+        if self.W is None:
+            return None, None, M_bmm
+        self.n_deflated += 1
+        K, n, m = B.shape
+        W = self.W.expand(K, n, self.W.shape[1])
+        # one matvec (on K x n x m, like a CG iteration) per column of W
+        AW = torch.cat([A_bmm(w.view(1, n, 1).repeat(K, 1, m))[:, :, :1]
+                        for w in self.W.t()], dim=2)
+        self.deflation_matvecs = self.W.shape[1]
+        self.n_matvecs += self.deflation_matvecs
+        E_inv = torch.linalg.pinv(W.transpose(1, 2) @ AW, hermitian=True)
+
+        def deflated_M_bmm(R):
+            Z = R if M_bmm is None else M_bmm(R)
+            Z = Z - W @ (E_inv @ (AW.transpose(1, 2) @ Z))
+            return Z + W @ (E_inv @ (W.transpose(1, 2) @ R))
+
+        Y = E_inv @ (W.transpose(1, 2) @ B)
+        return W @ Y, AW @ Y, deflated_M_bmm
+
+    def measuring(self):
+        ''' Whether the last deflated solve is to be compared with a cold
+            solve (the first one, then every measure_every-th)
+        '''
+        return (self.measure_every > 0 and self.deflation_matvecs > 0
+                and (self.n_deflated - 1) % self.measure_every == 0)
+
+    def observe(self, X, info, cold_info=None):
+        ''' Update the basis from the solution X of the deflated solve,
+            where info['n_matvecs'] includes the matvecs on A W, and the
+            measured savings from the info of the cold solve if given
+        '''
+        self.niter = info['niter']
+        if cold_info is not None:
+            self.n_measured += 1
+            self.iterations_saved += cold_info['niter'] - info['niter']
+            self.matvecs_saved += cold_info['n_matvecs'] - info['n_matvecs']
+
+        K, n, m = X.shape
+        columns = X.detach().transpose(0, 1).reshape(n, K * m)
+        if self.W is not None:
+            columns = torch.cat([self.decay * self.W * self.singular_values,
+                                 columns], dim=1)
+        U, S, _ = torch.linalg.svd(columns, full_matrices=False)
+        self.W = U[:, :self.rank]
+        self.singular_values = S[:self.rank]
+
+
+def make_preconditioner(preconditioner=None, **kwargs):
+    ''' A preconditioner from its registered name (kwargs go to the class);
+        instances and None are returned unchanged
+    '''
+    if preconditioner is None or not isinstance(preconditioner, str):
+        return preconditioner
+    if preconditioner not in PRECONDITIONERS:
+        raise ValueError('Unknown preconditioner: ' + str(preconditioner)
+                         + ', choose from ' + str(list(PRECONDITIONERS)))
+    return PRECONDITIONERS[preconditioner](**kwargs)
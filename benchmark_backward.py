@@ -0,0 +1,94 @@
+import time
+import tempfile
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from prettytable import PrettyTable
+from Networks import MNIST_FPN, SVHN_FPN, BasicBlock
+from utils import mnist_loaders, svhn_loaders, get_stats
+from utils import train_class_net, train_Neumann_FPN_net
+
+device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+print('device = ', device)
+seed = 0
+
+# -----------------------------------------------------------------------------
+# Benchmark settings
+# -----------------------------------------------------------------------------
+batch_size = 100
+test_batch_size = 400
+n_train = 10000   # training samples per epoch
+max_epochs = 2
+neumann_order = 5
+backward_modes = ['jfb', 'phantom:1:1', 'phantom:3:0.5', 'phantom:5:0.5',
+                  'phantom:10:0.5', 'neumann:' + str(neumann_order)]
+
+# -----------------------------------------------------------------------------
+# Networks and optimizers (settings of the training drivers)
+# -----------------------------------------------------------------------------
+problems = [
+    ('MNIST',
+     lambda: MNIST_FPN(lat_layers=2, num_channels=32, contraction_factor=0.5,
+                       architecture='FPN'),
+     lambda net: optim.Adam(net.parameters(), lr=2e-4, weight_decay=1e-6),
+     mnist_loaders, 1.0e-1, 50),
+    ('SVHN',
+     lambda: SVHN_FPN(lat_layers=1, num_channels=64, contraction_factor=0.9,
+                      block=BasicBlock, num_blocks=[1, 1, 1],
+                      architecture='FPN'),
+     lambda net: optim.Adam(net.parameters(), lr=1e-4, weight_decay=2e-4),
+     svhn_loaders, 1.0e-4, 200),
+]
+
+
+def run(train, make_net, make_optimizer, train_loader, test_loader, eps,
+        max_depth, **kwargs):
+    ''' train with one of the drivers and return (ms/step, MB, test acc) '''
+    torch.manual_seed(seed)
+    net = make_net().to(device)
+    optimizer = make_optimizer(net)
+    lr_scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=100,
+                                             gamma=1.0)
+    criterion = nn.CrossEntropyLoss()
+    if device != 'cpu':
+        torch.cuda.reset_peak_memory_stats(device)
+    with tempfile.TemporaryDirectory() as save_dir:
+        train(net, max_epochs, lr_scheduler, train_loader, test_loader,
+              optimizer, criterion, 10, eps, max_depth,
+              save_dir=save_dir + '/', **kwargs)
+        history = torch.load(save_dir + '/' + net.name() + '_history.pth')
+    memory = torch.cuda.max_memory_allocated(device) / 2**20 \
+        if device != 'cpu' else float('nan')
+
+    # the epoch times include a test pass, which is the same for every mode
+    start = time.time()
+    get_stats(net, test_loader, criterion, 10, eps, max_depth)
+    test_time = time.time() - start
+    train_time = sum(history['time_hist']) - max_epochs * test_time
+    step_time = train_time / (max_epochs * len(train_loader))
+    return 1000 * step_time, memory, history['test_acc_hist'][-1]
+
+
+table = PrettyTable(['Dataset', 'Trainer', 'Backward', 'Time/step (ms)',
+                     'Peak memory (MB)', 'Test acc (%)'])
+for name, make_net, make_optimizer, loaders, eps, max_depth in problems:
+    train_loader, test_loader = loaders(train_batch_size=batch_size,
+                                        test_batch_size=test_batch_size)
+    train_subset = torch.utils.data.Subset(train_loader.dataset,
+                                           range(n_train))
+    train_loader = torch.utils.data.DataLoader(train_subset,
+                                               batch_size=batch_size,
+                                               shuffle=True)
+    runs = [('train_class_net', train_class_net, {'backward': mode})
+            for mode in backward_modes]
+    runs.append(('train_Neumann_FPN_net', train_Neumann_FPN_net,
+                 {'neumann_order': neumann_order}))
+    for trainer, train, kwargs in runs:
+        step_time, memory, test_acc = run(train, make_net, make_optimizer,
+                                          train_loader, test_loader, eps,
+                                          max_depth, **kwargs)
+        table.add_row([name, trainer,
+                       kwargs.get('backward', 'neumann:' + str(neumann_order)),
+                       '{:.1f}'.format(step_time), '{:.0f}'.format(memory),
+                       '{:.2f}'.format(test_acc)])
+print(table)
@@ -0,0 +1,75 @@
+import time
+import torch
+from prettytable import PrettyTable
+from BatchCG import cg_batch, CGWorkspace
+
+device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+print('device = ', device)
+seed = 0
+torch.manual_seed(seed)
+
+# -----------------------------------------------------------------------------
+# Benchmark settings
+# -----------------------------------------------------------------------------
+batch_sizes = [50, 100, 200]
+latent_size = 10      # latent dimension of the FPNs
+n_iters = 30          # CG iterations per solve (run to completion)
+n_repeats = 20
+
+
+def spd_batch(batch_size, n):
+    ''' a batch of well conditioned symmetric positive definite matrices '''
+    Q = torch.randn(batch_size, n, n, device=device)
+    return Q @ Q.transpose(1, 2) / n + torch.eye(n, device=device)
+
+
+def count_allocations(solve):
+    ''' number of tensor allocations of one call of solve '''
+    if device != 'cpu':
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_stats(device)['allocation.all.allocated']
+        solve()
+        torch.cuda.synchronize(device)
+        return (torch.cuda.memory_stats(device)['allocation.all.allocated']
+                - before)
+    with torch.profiler.profile(profile_memory=True) as prof:
+        solve()
+    return sum(1 for event in prof.events()
+               if event.name == '[memory]' and event.cpu_memory_usage > 0)
+
+
+table = PrettyTable(['Batch', 'Kernel', 'Allocations/solve', 'Time (ms)',
+                     'Speedup'])
+for batch_size in batch_sizes:
+    A = spd_batch(batch_size, latent_size)
+    B = torch.randn(batch_size, latent_size, 1, device=device)
+    AX = torch.empty_like(B)
+
+    def A_bmm(X):
+        return torch.bmm(A, X, out=AX)
+
+    workspace = CGWorkspace()
+    kernels = [('cg_batch', {}),
+               ('cg_batch + workspace', {'workspace': workspace})]
+    default_time = None
+    for name, kwargs in kernels:
+        # atol = 0 is not allowed, a tiny tolerance runs all n_iters iterations
+        def solve():
+            return cg_batch(A_bmm, B, rtol=0, atol=1.0e-30, maxiter=n_iters,
+                            **kwargs)
+        solve()  # warm up (allocates the workspace)
+        allocations = count_allocations(solve)
+        if device != 'cpu':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            solve()
+        if device != 'cpu':
+            torch.cuda.synchronize(device)
+        solve_time = (time.perf_counter() - start) / n_repeats
+        if default_time is None:
+            default_time = solve_time
+        table.add_row([batch_size, name, allocations,
+                       '{:.2f}'.format(1000 * solve_time),
+                       '{:.2f}'.format(default_time / solve_time)])
+print(table)
@@ -0,0 +1,87 @@
+import time
+import torch
+from prettytable import PrettyTable
+from Networks import MNIST_FPN, SVHN_FPN, CIFAR10_FPN, BasicBlock
+from FixedPointSolvers import compiled_latent_operator, FixedPointSolver
+
+device = 'cpu'
+print('device = ', device)
+seed = 0
+torch.manual_seed(seed)
+
+# -----------------------------------------------------------------------------
+# Benchmark settings
+# -----------------------------------------------------------------------------
+batch_size = 100
+n_iters = 50      # latent operator applications per timing
+n_trials = 5
+check_every = 5   # steps per compiled block
+eps = 1.0e-3
+max_depth = 200
+
+# -----------------------------------------------------------------------------
+# Networks (settings of the training drivers)
+# -----------------------------------------------------------------------------
+networks = [
+    (MNIST_FPN(lat_layers=2, num_channels=32, contraction_factor=0.5,
+               architecture='FPN'), (1, 28, 28)),
+    (SVHN_FPN(lat_layers=1, num_channels=64, contraction_factor=0.9,
+              block=BasicBlock, num_blocks=[1, 1, 1], architecture='FPN'),
+     (3, 32, 32)),
+    (CIFAR10_FPN(lat_layers=5, num_channels=35, contraction_factor=0.5,
+                 data_layers=16, architecture='FPN'), (3, 32, 32)),
+]
+
+
+def time_iterations(step, Qd, n_steps=1):
+    ''' median time per latent operator application '''
+    times = []
+    for _ in range(n_trials + 1):  # first trial compiles
+        u = torch.zeros(Qd.shape)
+        start = time.perf_counter()
+        for _ in range(n_iters // n_steps):
+            u = step(u, Qd)
+        times.append((time.perf_counter() - start) / n_iters)
+    return sorted(times[1:])[n_trials // 2]
+
+
+table = PrettyTable(['Network', 'Operator', 'Time/iter (ms)', 'Speedup',
+                     'Solve (ms)', '|R - R_eager|'])
+for net, image_shape in networks:
+    net.eval()
+    with torch.no_grad():
+        Qd = net.data_space_forward(torch.randn(batch_size, *image_shape))
+        u = torch.randn(Qd.shape)
+        Ru_ref = net.latent_space_forward(u, Qd)
+
+        compiled = compiled_latent_operator(net, 'compile')
+        scripted = compiled_latent_operator(net, 'script')
+        operators = [
+            ('eager', net.latent_space_forward, 1, None),
+            ('fused', net.latent_space_forward_fused, 1, None),
+            ('compile', compiled, 1, 'compile'),
+            ('compile, ' + str(check_every) + ' steps',
+             lambda u, v: compiled.steps(u, v, check_every)[1], check_every,
+             'compile'),
+            ('script', scripted, 1, 'script'),
+        ]
+        eager_time = None
+        for name, step, n_steps, backend in operators:
+            iter_time = time_iterations(step, Qd, n_steps)
+            if eager_time is None:
+                eager_time = iter_time
+            solver = FixedPointSolver('picard', compiled=backend,
+                                      check_every=n_steps)
+            solver(net, Qd, eps=eps, max_depth=max_depth)  # warm up
+            result = solver(net, Qd, eps=eps, max_depth=max_depth)
+            error = torch.norm(step(u, Qd) - Ru_ref).item() \
+                if n_steps == 1 else float('nan')
+            if backend is not None and compiled_latent_operator(
+                    net, backend).active_backend != backend:
+                name += ' (eager fallback)'
+            table.add_row([net.name(), name,
+                           '{:.2f}'.format(1000 * iter_time),
+                           '{:.2f}'.format(eager_time / iter_time),
+                           '{:.1f}'.format(1000 * result.solve_time),
+                           '{:.2e}'.format(error)])
+print(table)
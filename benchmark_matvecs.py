@@ -0,0 +1,91 @@
+import time
+import torch
+import torch.nn as nn
+from prettytable import PrettyTable
+from Networks import MNIST_FPN, SVHN_FPN, CIFAR10_FPN, BasicBlock
+from FixedPointSolvers import picard, LinearizedLatentOperator
+from utils import solve_adjoint
+
+device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+print('device = ', device)
+seed = 0
+torch.manual_seed(seed)
+
+# -----------------------------------------------------------------------------
+# Benchmark settings
+# -----------------------------------------------------------------------------
+batch_sizes = [50, 100, 200]
+n_iters = 30      # Krylov iterations per solve (run to completion)
+max_depth = 50
+linear_solvers = ['cg', 'gmres']
+# None: matvecs from the graph of the batch (create_graph double backward)
+engines = [None, 'autograd', 'func']
+
+# -----------------------------------------------------------------------------
+# Networks (settings of the Jacobian-based training drivers)
+# -----------------------------------------------------------------------------
+networks = [
+    (MNIST_FPN(lat_layers=2, num_channels=32, contraction_factor=0.5,
+               architecture='Jacobian'), (1, 28, 28)),
+    (SVHN_FPN(lat_layers=1, num_channels=64, contraction_factor=0.9,
+              block=BasicBlock, num_blocks=[1, 1, 1],
+              architecture='Jacobian'), (3, 32, 32)),
+    (CIFAR10_FPN(lat_layers=5, num_channels=35, contraction_factor=0.5,
+                 data_layers=16, architecture='Jacobian'), (3, 32, 32)),
+]
+criterion = nn.CrossEntropyLoss()
+
+
+def adjoint_solve(net, u, d, labels, linear_solver, engine):
+    ''' one adjoint solve of the Jacobian-based trainer at fixed point u '''
+    u = u.clone().requires_grad_()
+    Qd = net.data_space_forward(d)
+    Ru = net.latent_space_forward(u, Qd)
+    loss = criterion(net.map_latent_to_inference(Ru), labels)
+    operator = None
+    if engine is not None:
+        operator = LinearizedLatentOperator(net, u, Qd, engine)
+    # atol = 0 is not allowed, a tiny tolerance runs all n_iters iterations
+    solve_adjoint(u, Ru, loss, linear_solver, tol=1.0e-30, maxiter=n_iters,
+                  operator=operator)
+    return operator
+
+
+table = PrettyTable(['Network', 'Batch', 'Solver', 'Iterations', 'Time (ms)',
+                     'Speedup', 'Peak memory (MB)'])
+for net, image_shape in networks:
+    net = net.to(device)
+    net.train()
+    for batch_size in batch_sizes:
+        d = torch.randn(batch_size, *image_shape, device=device)
+        labels = torch.randint(10, (batch_size,), device=device)
+        with torch.no_grad():
+            u = picard(net.latent_space_forward, net.data_space_forward(d),
+                       eps=1.0e-6, max_depth=max_depth).u
+        for linear_solver in linear_solvers:
+            graph_time = None
+            for engine in engines:
+                adjoint_solve(net, u, d, labels, linear_solver,
+                              engine)  # warm up
+                if device != 'cpu':
+                    torch.cuda.synchronize(device)
+                    torch.cuda.reset_peak_memory_stats(device)
+                start = time.perf_counter()
+                operator = adjoint_solve(net, u, d, labels, linear_solver,
+                                         engine)
+                if device != 'cpu':
+                    torch.cuda.synchronize(device)
+                solve_time = time.perf_counter() - start
+                if graph_time is None:
+                    graph_time = solve_time
+                memory = torch.cuda.max_memory_allocated(device) / 2**20 \
+                    if device != 'cpu' else float('nan')
+                name = 'graph' if operator is None else operator.engine
+                if name == 'func' and not operator.linearized:
+                    name += ' (transposed VJP)'
+                table.add_row([net.name(), batch_size,
+                               linear_solver + ' / ' + name,
+                               n_iters, '{:.1f}'.format(1000 * solve_time),
+                               '{:.2f}'.format(graph_time / solve_time),
+                               '{:.0f}'.format(memory)])
+print(table)
@@ -0,0 +1,89 @@
+import time
+import torch
+from prettytable import PrettyTable
+from Networks import MNIST_FPN, SVHN_FPN, CIFAR10_FPN, BasicBlock
+from FixedPointSolvers import FixedPointSolver
+
+device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+print('device = ', device)
+seed = 0
+torch.manual_seed(seed)
+
+# -----------------------------------------------------------------------------
+# Benchmark settings
+# -----------------------------------------------------------------------------
+batch_size = 100
+eps = 1.0e-3
+max_depth = 200
+n_trials = 5
+n_warmup_batches = 10  # training passes to set batch norm and Lipschitz stats
+
+solver_configs = [('picard', {}),
+                  ('picard', {'precision': 'auto'}),
+                  ('relaxed', {'alpha': 0.5}),
+                  ('relaxed', {'alpha': 0.5, 'adaptive': True}),
+                  ('multires', {'factor': 2}),
+                  ('anderson', {'m': 5}),
+                  ('anderson', {'m': 5, 'beta': 0.8}),
+                  ('broyden', {'memory': 10})]
+
+# -----------------------------------------------------------------------------
+# Networks (settings of the training drivers)
+# -----------------------------------------------------------------------------
+networks = [
+    (MNIST_FPN(lat_layers=2, num_channels=32, contraction_factor=0.5,
+               architecture='FPN'), (1, 28, 28)),
+    (SVHN_FPN(lat_layers=1, num_channels=64, contraction_factor=0.9,
+              block=BasicBlock, num_blocks=[1, 1, 1], architecture='FPN'),
+     (3, 32, 32)),
+    (CIFAR10_FPN(lat_layers=5, num_channels=35, contraction_factor=0.5,
+                 data_layers=16, architecture='FPN'), (3, 32, 32)),
+]
+
+
+def sync():
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def time_solver(net, Qd, solver, solver_kwargs):
+    fp_solver = FixedPointSolver(solver, **solver_kwargs)
+    times = []
+    for _ in range(n_trials):
+        sync()
+        start = time.perf_counter()
+        result = fp_solver(net, Qd, eps=eps, max_depth=max_depth)
+        sync()
+        times.append(time.perf_counter() - start)
+    return result, sorted(times)[len(times) // 2]
+
+
+table = PrettyTable(['Network', 'Solver', 'Options', 'Depth',
+                     'Coarse depth', 'Capped', 'Time (ms)', 'Speedup',
+                     '|u - u_picard|'])
+for net, image_shape in networks:
+    net = net.to(device)
+    net.train()
+    for _ in range(n_warmup_batches):
+        net(torch.randn(batch_size, *image_shape, device=device), eps=eps,
+            max_depth=max_depth)
+    net.eval()
+
+    with torch.no_grad():
+        d = torch.randn(batch_size, *image_shape, device=device)
+        Qd = net.data_space_forward(d)
+        u_ref, picard_time = None, None
+        for solver, solver_kwargs in solver_configs:
+            result, solve_time = time_solver(net, Qd, solver, solver_kwargs)
+            u = result.u
+            if u_ref is None:
+                u_ref, picard_time = u, solve_time
+            table.add_row([net.name(), solver, str(solver_kwargs),
+                           int(result.depth.max()),
+                           '-' if result.coarse_depth is None
+                           else int(result.coarse_depth.max()),
+                           result.capped(eps, max_depth),
+                           '{:.1f}'.format(1000 * solve_time),
+                           '{:.2f}'.format(picard_time / solve_time),
+                           '{:.2e}'.format(torch.norm(u - u_ref).item())])
+print(table)
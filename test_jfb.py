@@ -1,9 +1,19 @@
+import pytest
 import torch
 import torch.nn as nn
-from utils import mnist_loaders, compute_fixed_point
+from utils import mnist_loaders, compute_fixed_point, DepthStats
+from utils import solve_adjoint, adjoint_fallback
 import copy
-import numpy as np
-from BatchCG import cg_batch
+from BatchCG import cg_batch, CGWorkspace, cg_solve
+from FixedPointSolvers import picard, relaxed, anderson, broyden, BroydenState
+from FixedPointSolvers import LatentCache, FixedPointSolver, SOLVERS
+from FixedPointSolvers import LipschitzEstimator, NormalizationSchedule
+from FixedPointSolvers import implicit_backward, attached_step, parse_backward
+from FixedPointSolvers import LinearizedLatentOperator, CompiledLatentOperator
+from FixedPointSolvers import compiled_latent_operator
+from Preconditioners import HutchinsonDiagonal, NystromPreconditioner
+from Preconditioners import KrylovRecycler
+from Networks import MNIST_FPN, CIFAR10_FPN, ContractiveConv2d
 
 
 # ------------------------------------------------
@@ -29,20 +39,12 @@ class test_net(nn.Module):
 
     def forward(self, d: image, eps=1.0e-6, max_depth=1000):
 
-        self.depth = 0.0
         Qd = self.data_space_forward(d)
-        u = torch.zeros(Qd.shape, device=self.device())
-        u_prev = np.Inf*torch.ones(u.shape, device=self.device())
-        all_samp_conv = False
-        while not all_samp_conv and self.depth < max_depth:
+        result = FixedPointSolver('picard')(self, Qd, eps=eps,
+                                            max_depth=max_depth)
+        self.depth = float(result.depth.max())
 
-            u_prev = u.clone()
-            u = self.latent_space_forward(u, Qd)
-            res_norm = torch.max(torch.norm(u - u_prev, dim=1))
-            self.depth += 1.0
-            all_samp_conv = res_norm <= eps
-
-        return self.map_latent_to_inference(u)
+        return self.map_latent_to_inference(result.u)
 
     def device(self):
         return next(self.parameters()).data.device
@@ -88,6 +90,54 @@ class test_net(nn.Module):
 
     def normalize_lip_const(self, u, Qd):
         return
+
+
+# ------------------------------------------------
+# shared fixtures
+# ------------------------------------------------
+
+@pytest.fixture(autouse=True)
+def seed():
+    ''' every test starts from the same random state '''
+    torch.manual_seed(0)
+
+
+@pytest.fixture
+def net():
+    ''' test network with 20 latent features '''
+    return test_net(latent_features=20)
+
+
+@pytest.fixture
+def Qd(net):
+    ''' latent features Q(d) of a batch of 8 random images '''
+    with torch.no_grad():
+        return net.data_space_forward(torch.randn(8, 1, 28, 28))
+
+
+@pytest.fixture
+def fixed_point():
+    ''' test network with 10 latent features, a batch d of 4 random images
+        and its fixed point u
+    '''
+    net = test_net(latent_features=10)
+    d = torch.randn(4, 1, 28, 28)
+    with torch.no_grad():
+        u = picard(net.latent_space_forward, net.data_space_forward(d),
+                   eps=1.0e-8, max_depth=500).u
+    return net, d, u
+
+
+def dense_jacobians(net, u, Qd):
+    ''' J = I - dR/du at u of every sample, as a dense (n_samples, n, n) '''
+    n = u.shape[1]
+    return torch.stack([
+        torch.eye(n) - torch.autograd.functional.jacobian(
+            lambda v: net.latent_space_forward(v, Qd[i:i+1]),
+            u[i:i+1].detach()).view(n, n)
+        for i in range(u.shape[0])])
+
+
 # ------------------------------------------------
 # test JJT symmetry
 # ------------------------------------------------
@@ -189,3 +239,621 @@ def test_Neumann_approximation():
 
     assert(torch.norm(dldu_Jinv_approx - true_sol) < 1e-6)
     print('---- Neumann test passed! ----')
+
+
+def test_active_set_matches_full_batch(net, Qd):
+    with torch.no_grad():
+        full = picard(net.latent_space_forward, Qd, eps=1.0e-8,
+                      max_depth=200, residual='absolute')
+        active = picard(net.latent_space_forward, Qd, eps=1.0e-8,
+                        max_depth=200, active_set=True, residual='absolute')
+
+    assert torch.norm(full.u - active.u) < 1e-6
+    assert (active.depth <= full.depth).all()
+    print('---- active set test passed! ----')
+
+
+def test_anderson_matches_picard(net, Qd):
+    with torch.no_grad():
+        sol_picard = picard(net.latent_space_forward, Qd, eps=1.0e-8,
+                            max_depth=200)
+        sol_anderson = anderson(net.latent_space_forward, Qd, eps=1.0e-8,
+                                max_depth=200, m=5)
+        Ru_prev = net.latent_space_forward(sol_anderson.u_prev, Qd)
+
+    assert torch.norm(sol_picard.u - sol_anderson.u) < 1e-6
+    assert torch.norm(Ru_prev - sol_anderson.u) < 1e-6
+    assert sol_anderson.depth.max() <= sol_picard.depth.max()
+    print('---- Anderson test passed! ----')
+
+
+def test_broyden_matches_picard(net, Qd):
+    state = BroydenState(memory=10)
+    with torch.no_grad():
+        sol_picard = picard(net.latent_space_forward, Qd, eps=1.0e-8,
+                            max_depth=200)
+        sol_broyden = broyden(net.latent_space_forward, Qd, eps=1.0e-8,
+                              max_depth=200, state=state)
+        # the stored inverse Jacobian estimate can be reused
+        sol_reuse = broyden(net.latent_space_forward, Qd, u0=sol_broyden.u,
+                            eps=1.0e-8, max_depth=200, state=state,
+                            reuse=True)
+
+    assert torch.norm(sol_picard.u - sol_broyden.u) < 1e-6
+    assert state.count > 0
+    assert sol_reuse.depth.max() <= sol_broyden.depth.max()
+    print('---- Broyden test passed! ----')
+
+
+def test_latent_cache_lru():
+    Qd = torch.zeros(2, 3, 4, 4)
+    u = torch.randn(2, 3, 4, 4)
+    bytes_per_sample = 3 * 4 * 4 * 2  # fp16
+    cache = LatentCache(max_bytes=3 * bytes_per_sample)
+
+    assert torch.norm(cache.lookup(torch.tensor([0, 1]), Qd)) == 0
+    cache.store(torch.tensor([0, 1]), u)
+    u0 = cache.lookup(torch.tensor([1, 0]), Qd)
+    assert torch.norm(u0 - u.flip(0)) < 1e-2 * torch.norm(u)
+
+    # sample 1 is now the least recently used and gets evicted
+    cache.store(torch.tensor([2, 3]), u)
+    assert len(cache) == 3
+    assert torch.norm(cache.lookup(torch.tensor([1]), Qd[:1])) == 0
+    assert torch.norm(cache.lookup(torch.tensor([0]), Qd[:1])) > 0
+    print('---- latent cache test passed! ----')
+
+
+def test_check_every_matches_every_step_check(net, Qd):
+    with torch.no_grad():
+        for active_set in [False, True]:
+            sol = picard(net.latent_space_forward, Qd, eps=1.0e-6,
+                         max_depth=200, active_set=active_set)
+            sol_k = picard(net.latent_space_forward, Qd, eps=1.0e-6,
+                           max_depth=200, active_set=active_set,
+                           check_every=4)
+            depth, depth_k = sol.depth, sol_k.depth
+            assert torch.norm(sol.u - sol_k.u) < 1e-4
+            assert (depth_k >= depth).all() and (depth_k < depth + 4).all()
+    print('---- check_every test passed! ----')
+
+
+def test_adaptive_relaxation_damps_oscillation():
+    Qd = torch.randn(8, 4, 3, 3)
+
+    def R(u, v):
+        return v - 0.95 * u
+
+    plain = picard(R, Qd, eps=1.0e-6, max_depth=100)
+    adaptive = relaxed(R, Qd, eps=1.0e-6, max_depth=100, adaptive=True)
+    assert plain.capped(1.0e-6, 100) == 8
+    assert adaptive.capped(1.0e-6, 100) == 0
+    assert adaptive.depth.max() < 10
+    assert torch.norm(adaptive.u - Qd / 1.95) < 1e-5
+    print('---- adaptive relaxation test passed! ----')
+
+
+def test_multires_matches_picard():
+    net = MNIST_FPN(lat_layers=2, contraction_factor=0.5)
+    net.eval()
+    d = torch.randn(4, 1, 28, 28)
+    with torch.no_grad():
+        Qd = net.data_space_forward(d)
+        ref = FixedPointSolver('picard')(net, Qd, eps=1.0e-6, max_depth=100)
+        result = FixedPointSolver('multires')(net, Qd, eps=1.0e-6,
+                                              max_depth=100)
+        y_ref = net(d, eps=1.0e-6, max_depth=100)
+        y = net(d, eps=1.0e-6, max_depth=100, solver='multires')
+    assert torch.norm(result.u - ref.u) < 1e-4
+    assert torch.norm(y - y_ref) < 1e-4 * torch.norm(y_ref)
+    assert (result.coarse_depth > 0).all()
+    print('---- multiresolution test passed! ----')
+
+
+def test_registered_solvers_agree(net):
+    d = torch.randn(8, 1, 28, 28)
+    with torch.no_grad():
+        Qd = net.data_space_forward(d)
+        results = {name: FixedPointSolver(name)(net, Qd, eps=1.0e-8,
+                                                max_depth=500)
+                   for name in SOLVERS}
+        y = net(d, eps=1.0e-8, max_depth=500)
+
+        for name, result in results.items():
+            Ru = net.latent_space_forward(result.u, Qd)
+            assert torch.norm(result.u - results['picard'].u) < 1e-6
+            assert torch.norm(Ru - result.u) < 1e-6
+            assert len(result.residual_hist) > 0 and result.solve_time > 0
+        y_ref = net.map_latent_to_inference(results['picard'].u)
+    assert torch.norm(y - y_ref) < 1e-6
+    print('---- solver registry test passed! ----')
+
+
+def test_mixed_precision_promotes_to_fp32(net, Qd):
+    with torch.no_grad():
+        ref = FixedPointSolver('picard')(net, Qd, eps=1.0e-6, max_depth=200)
+        mixed = FixedPointSolver('picard', precision='bf16')(
+            net, Qd, eps=1.0e-6, max_depth=200)
+
+    # bf16 cannot reach eps = 1e-6, so the solve must finish in fp32
+    assert mixed.u.dtype == Qd.dtype
+    assert mixed.residual_hist[-1] <= 1.0e-6
+    assert torch.norm(mixed.u - ref.u) < 1e-4
+    print('---- mixed precision test passed! ----')
+
+
+def test_fused_latent_operator_matches_eager():
+    nets = [(MNIST_FPN(lat_layers=2), (1, 28, 28)),
+            (CIFAR10_FPN(data_layers=1, lat_layers=2), (3, 32, 32))]
+    for net, image_shape in nets:
+        net.eval()
+        d = torch.randn(4, *image_shape)
+        with torch.no_grad():
+            Qd = net.data_space_forward(d)
+            u = torch.randn(Qd.shape)
+            Ru = net.latent_space_forward(u, Qd)
+            Ru_fused = net.latent_space_forward_fused(u, Qd)
+            ref = FixedPointSolver('picard')(net, Qd, eps=1e-5, max_depth=50)
+            fused = FixedPointSolver('picard', compiled='script',
+                                     check_every=5)(net, Qd, eps=1e-5,
+                                                    max_depth=50)
+            y_ref = net(d, eps=1e-5, max_depth=50)
+            y = net(d, eps=1e-5, max_depth=50, compiled='script',
+                    check_every=5)
+        assert torch.norm(Ru_fused - Ru) < 1e-5
+        assert torch.norm(fused.u - ref.u) < 1e-4
+        assert torch.norm(y - y_ref) < 1e-4 * torch.norm(y_ref)
+        assert compiled_latent_operator(net, 'script').active_backend \
+            == 'script'
+    print('---- fused latent operator test passed! ----')
+
+
+def test_compiled_operator_falls_back_with_warning(net, Qd, monkeypatch):
+    def failing_trace(*args, **kwargs):
+        raise RuntimeError('tracing failed')
+    monkeypatch.setattr(torch.jit, 'trace', failing_trace)
+    operator = CompiledLatentOperator(net, 'script')
+    u = torch.randn(Qd.shape)
+    with pytest.warns(UserWarning, match='script backend failed'):
+        Ru = operator(u, Qd)
+    assert operator.active_backend == 'eager'
+    with torch.no_grad():
+        assert torch.equal(Ru, operator.eager(u, Qd))
+    with pytest.raises(ValueError):
+        CompiledLatentOperator(net, 'inductor')
+
+
+def test_depth_stats_aggregates_solve_reports(net):
+    stats = DepthStats(max_depth=5, eps=1.0e-6)
+    residuals = []
+    with torch.no_grad():
+        for _ in range(3):
+            Qd = net.data_space_forward(torch.randn(8, 1, 28, 28))
+            result = FixedPointSolver('picard')(net, Qd, eps=1.0e-6,
+                                                max_depth=5)
+            stats.update(result)
+            residuals.append(result.residual)
+    residuals = torch.cat(residuals).double()
+    summary = stats.summary()
+    assert summary['n_samples'] == 24
+    assert stats.histogram().sum() == 24 and stats.histogram()[5] == 24
+    assert summary['depth_mean'] == 5 and summary['capped'] == 24
+    assert summary['residual_max'] == residuals.max().item() > 1.0e-6
+    assert abs(summary['residual_mean'] - residuals.mean().item()) < 1e-12
+    print('---- depth statistics test passed! ----')
+
+
+def test_lipschitz_estimator_power_iteration():
+    A = torch.diag(torch.tensor([0.9, -0.5, 0.3, 0.1]))
+
+    def R(u, v):
+        return u @ A + v
+
+    Qd = torch.randn(8, 4)
+    u_prev = torch.randn(8, 4)
+    estimator = LipschitzEstimator()
+    for _ in range(30):
+        estimator.update(R, u_prev, R(u_prev, Qd), Qd)
+    assert abs(estimator.estimate.item() - 0.9) < 1e-3
+    assert estimator.n_updates == 30
+
+    # non-normal: spectral radius 0.5, Lipschitz constant |A|_2 ~ 2.06
+    A = torch.tensor([[0.5, 2.0], [0.0, 0.5]])
+
+    def R(u, v):
+        return u @ A.t() + v
+
+    Qd = torch.randn(8, 2)
+    u_prev = torch.randn(8, 2)
+    estimator = LipschitzEstimator()
+    for _ in range(30):
+        estimator.update(R, u_prev, R(u_prev, Qd), Qd)
+    norm = torch.linalg.matrix_norm(A, 2)
+    assert abs(estimator.estimate.item() - norm.item()) < 1e-3 * norm.item()
+    print('---- Lipschitz estimator test passed! ----')
+
+
+def test_normalization_schedule_counts_triggers():
+    net = MNIST_FPN(lat_layers=1)
+    net.train()
+    every_3 = NormalizationSchedule(every=3, on_max_depth=False)
+    on_cap = NormalizationSchedule(every=100)
+    with torch.no_grad():
+        Qd = net.data_space_forward(torch.randn(2, 1, 28, 28))
+        for _ in range(6):
+            FixedPointSolver('picard', lip_schedule=every_3)(
+                net, Qd, eps=1.0e-3, max_depth=50, lip_normalize='after')
+            FixedPointSolver('picard', lip_schedule=on_cap)(
+                net, Qd, eps=1.0e-3, max_depth=1, lip_normalize='after')
+    assert every_3.n_checks == 6 and every_3.n_fired == 2
+    assert every_3.fired_by['interval'] == 2
+    assert on_cap.fired_by == {'interval': 1, 'drift': 0, 'max_depth': 5}
+    print('---- normalization schedule test passed! ----')
+
+
+def test_contractive_latent_layers():
+    conv = ContractiveConv2d(2, 2, kernel_size=3, input_size=(4, 4),
+                             bound=0.5, padding=(1, 1))
+    conv.power_iteration(n_iterations=100)
+    basis = torch.eye(32).view(32, 2, 4, 4)
+    with torch.no_grad():
+        dense = conv._conv(basis, conv.weight).view(32, 32)
+        assert (abs(conv.sigma - torch.linalg.matrix_norm(dense, ord=2))
+               < 1e-4)
+        assert (torch.linalg.matrix_norm((conv(basis) - conv.bias.view(
+            1, 2, 1, 1)).view(32, 32), ord=2) <= 0.5 + 1e-4)
+
+    net = MNIST_FPN(lat_layers=2, contraction_factor=0.5,
+                    architecture='Jacobian', contractive=True, lip_bound=0.9)
+    assert net.lipschitz_bound() <= 0.9 + 1e-6
+    with torch.no_grad():
+        Qd = net.data_space_forward(torch.randn(4, 1, 28, 28))
+        u, w = torch.randn(Qd.shape), torch.randn(Qd.shape)
+        R_diff = torch.norm(net.latent_space_forward(u, Qd)
+                            - net.latent_space_forward(w, Qd))
+    assert R_diff <= 0.9 * torch.norm(u - w)
+    # latent batch norm has no Lipschitz certificate in training mode
+    with pytest.raises(ValueError):
+        MNIST_FPN(lat_layers=2, contraction_factor=0.5, architecture='FPN',
+                  contractive=True, lip_bound=0.9)
+    print('---- contractive latent layer test passed! ----')
+
+
+def test_implicit_backward_modes_agree(fixed_point):
+    net, d, u = fixed_point
+    grads = {}
+    for backward in ['neumann:100', 'adjoint-fixed-point', 'krylov']:
+        net.zero_grad()
+        Qd = net.data_space_forward(d)
+        Ru = implicit_backward(net, net.latent_space_forward(u, Qd), u, Qd,
+                               backward, tol=1.0e-8, maxiter=200)
+        net.map_latent_to_inference(Ru).sum().backward()
+        grads[backward] = net.fc_latent.weight.grad.clone()
+
+    ref = grads['neumann:100']
+    for backward, grad in grads.items():
+        assert torch.norm(grad - ref) < 1e-4 * torch.norm(ref)
+    print('---- implicit backward test passed! ----')
+
+
+def test_phantom_backward(fixed_point):
+    net, d, u = fixed_point
+    grads = {}
+    for backward in ['jfb', 'phantom:1:1', 'neumann:20', 'phantom:21:1']:
+        net.zero_grad()
+        Qd = net.data_space_forward(d)
+        Ru = attached_step(net, u, Qd, backward, tol=1.0e-8, maxiter=200)
+        net.map_latent_to_inference(Ru).sum().backward()
+        grads[backward] = net.fc_latent.weight.grad.clone()
+
+    # one undamped step is JFB, k undamped steps a Neumann series of order k-1
+    for phantom, ref in [('phantom:1:1', 'jfb'),
+                         ('phantom:21:1', 'neumann:20')]:
+        error = torch.norm(grads[phantom] - grads[ref])
+        assert error < 1e-5 * torch.norm(grads[ref])
+    print('---- phantom backward test passed! ----')
+
+
+def test_parse_backward():
+    assert parse_backward('jfb') == ('jfb', [])
+    assert parse_backward('phantom:5:0.5') == ('phantom', [5, 0.5])
+    assert parse_backward('phantom:5:1e-1') == ('phantom', [5, 0.1])
+    assert parse_backward('neumann:1e-3') == ('neumann', [1e-3])
+    assert isinstance(parse_backward('neumann:20')[1][0], int)
+    with pytest.raises(ValueError):
+        parse_backward('unrolled:5')
+    print('---- parse backward test passed! ----')
+
+
+def test_adjoint_solvers_agree(fixed_point):
+    net, d, u = fixed_point
+    with torch.no_grad():
+        Qd = net.data_space_forward(d)
+    u.requires_grad = True
+    Ru = net.latent_space_forward(u, Qd)
+    loss = net.map_latent_to_inference(Ru).pow(2).sum()
+
+    # x J = dl/du with the dense Jacobian of every sample
+    dldu = torch.autograd.grad(loss, Ru, retain_graph=True)[0]
+    J = dense_jacobians(net, u, Qd)
+    ref = torch.linalg.solve(J.transpose(1, 2), dldu.unsqueeze(2)).squeeze(2)
+
+    for engine in [None, 'autograd', 'func']:
+        operator = None
+        if engine == 'func':
+            # test_net scales by a Python float, which torch.func.linearize
+            # (torch 2.0) cannot trace: the JVPs transpose the VJP
+            with pytest.warns(UserWarning, match='linearize'):
+                operator = LinearizedLatentOperator(net, u, Qd, engine)
+            assert not operator.linearized
+        elif engine is not None:
+            operator = LinearizedLatentOperator(net, u, Qd, engine)
+        assert operator is None or operator.engine == engine
+        for linear_solver in ['cg', 'gmres', 'bicgstab']:
+            sol, info = solve_adjoint(u, Ru, loss, linear_solver, tol=1.0e-5,
+                                      maxiter=100, operator=operator)
+            assert info['converged'].all()
+            assert torch.norm(sol - ref) < 1e-3 * torch.norm(ref)
+    print('---- adjoint solvers test passed! ----')
+
+
+def test_linearized_operator_on_networks():
+    for net in [MNIST_FPN(lat_layers=2, architecture='Jacobian'),
+                MNIST_FPN(lat_layers=2, architecture='FPN'),
+                CIFAR10_FPN(data_layers=1, lat_layers=2)]:
+        image_shape = (1, 28, 28) if isinstance(net, MNIST_FPN) else \
+            (3, 32, 32)
+        for training in [True, False]:
+            net.train(training)
+            with torch.no_grad():
+                Qd = net.data_space_forward(torch.randn(2, *image_shape))
+            u = torch.randn(Qd.shape)
+            state = copy.deepcopy(net.state_dict())
+            operator = LinearizedLatentOperator(net, u, Qd, 'func')
+            reference = LinearizedLatentOperator(net, u, Qd, 'autograd')
+            assert operator.engine == 'func' and operator.linearized
+            v = torch.randn(2, Qd[0].numel(), 1)
+            for product in ['vJ', 'vJT']:
+                ref = getattr(reference, product)(v)
+                error = torch.norm(getattr(operator, product)(v) - ref)
+                assert error < 1e-5 * torch.norm(ref)
+            # the batch norm statistics are not updated
+            for name, value in net.state_dict().items():
+                assert torch.equal(value, state[name])
+    print('---- linearized operator test passed! ----')
+
+
+def test_preconditioners_reduce_cg_iterations():
+    K, n = 4, 40
+    # badly scaled diagonal with a weak coupling (for the diagonal) and a
+    # few large eigenvalues above a cluster (for the Nystrom approximation)
+    d = torch.logspace(0, 4, n, dtype=torch.double)
+    E = torch.randn(n, n, dtype=torch.double)
+    E = 0.1 * (E + E.t()) / n**0.5
+    A_diagonal = d.sqrt().view(-1, 1) * (torch.eye(n) + E) * d.sqrt()
+    Q = torch.linalg.qr(torch.randn(n, n, dtype=torch.double))[0]
+    eigenvalues = 1 + torch.rand(n, dtype=torch.double)
+    eigenvalues[:10] = torch.logspace(2, 4, 10, dtype=torch.double)
+    A_low_rank = (Q * eigenvalues) @ Q.t()
+
+    B = torch.randn(K, n, 1, dtype=torch.double)
+    for A, preconditioner in [(A_diagonal, HutchinsonDiagonal(n_probes=256)),
+                              (A_low_rank, NystromPreconditioner(rank=20))]:
+        A = A.expand(K, n, n)
+
+        def A_bmm(X):
+            return A @ X
+
+        X_ref = torch.linalg.solve(A, B)
+        _, info = cg_batch(A_bmm, B, rtol=1e-10, maxiter=500)
+        preconditioner.update(A_bmm, B)
+        X, info_M = cg_batch(preconditioner.shifted(A_bmm), B,
+                             M_bmm=preconditioner.M_bmm, rtol=1e-10,
+                             maxiter=500)
+        assert info_M['optimal']
+        assert info_M['niter'] < info['niter']
+        assert torch.norm(X - X_ref) < 1e-6 * torch.norm(X_ref)
+    print('---- preconditioner test passed! ----')
+
+
+def test_adjoint_fallback(fixed_point):
+    net, d, u = fixed_point
+    with torch.no_grad():
+        Qd = net.data_space_forward(d)
+    u.requires_grad = True
+    Ru = net.latent_space_forward(u, Qd)
+    loss = net.map_latent_to_inference(Ru).pow(2).sum()
+    dldu = torch.autograd.grad(loss, Ru, retain_graph=True)[0]
+    solve_kwargs = {'linear_solver': 'cg', 'tol': 1.0e-5, 'maxiter': 1}
+
+    sol, info = solve_adjoint(u, Ru, loss, **solve_kwargs)
+    assert not info['optimal']
+    assert adjoint_fallback(u, Ru, loss, sol, info, 'skip')[0] is None
+    assert adjoint_fallback(u, Ru, loss, sol, info, 'partial')[0] is sol
+
+    sol_jfb, _ = adjoint_fallback(u, Ru, loss, sol, info, 'jfb')
+    converged = info['converged'].view(-1)
+    assert torch.equal(sol_jfb[~converged], dldu[~converged])
+    assert torch.equal(sol_jfb[converged], sol[converged])
+
+    # the retry solves the normal equations x (J J^T + shift I) = dl/du J^T
+    solve_kwargs['maxiter'] = 100
+    sol_shift, info_shift = adjoint_fallback(u, Ru, loss, sol, info, 'shift',
+                                             retry_shift=1.0e-2,
+                                             **solve_kwargs)
+    J = dense_jacobians(net, u, Qd)
+    ref = torch.linalg.solve(J @ J.transpose(1, 2) + 1.0e-2 * torch.eye(10),
+                             J @ dldu.unsqueeze(2)).squeeze(2)
+    assert info_shift['optimal']
+    assert torch.norm(sol_shift - ref) < 1e-3 * torch.norm(ref)
+    print('---- adjoint fallback test passed! ----')
+
+
+def test_cg_batch_one_matvec_per_iteration():
+    K, n = 3, 20
+    # system k has 4 + 4k distinct eigenvalues, so CG needs as many steps
+    A = torch.zeros(K, n, n, dtype=torch.double)
+    for k in range(K):
+        Q = torch.linalg.qr(torch.randn(n, n, dtype=torch.double))[0]
+        eigenvalues = torch.arange(1, 4 + 4 * k + 1, dtype=torch.double)
+        eigenvalues = eigenvalues.repeat(n)[:n]
+        A[k] = (Q * eigenvalues) @ Q.t()
+    B = torch.randn(K, n, 1, dtype=torch.double)
+    n_calls = [0]
+
+    def A_bmm(X):
+        n_calls[0] += 1
+        return A @ X
+
+    for check_every in [None, 5]:
+        n_calls[0] = 0
+        X, info = cg_batch(A_bmm, B, X0=torch.zeros_like(B), rtol=1e-10,
+                           maxiter=100, check_every=check_every)
+        assert info['optimal']
+        assert info['n_matvecs'] == n_calls[0]
+        n_checks = info['niter'] // check_every if check_every else 0
+        assert n_calls[0] == 1 + info['niter'] + n_checks
+        assert (info['niters'][:, 0] <= torch.tensor([5, 9, 13])).all()
+        assert int(info['niters'].max()) == info['niter']
+        assert (info['residual'] <= 1e-10 * torch.norm(B, dim=1)).all()
+        assert torch.norm(X - torch.linalg.solve(A, B)) < 1e-8
+        assert info['n_system_matvecs'] == K * info['n_matvecs']
+
+        # compacted: only the systems that have not converged are multiplied
+        X_c, info_c = cg_batch(lambda X, index: A[index] @ X, B,
+                               X0=torch.zeros_like(B), rtol=1e-10,
+                               maxiter=100, check_every=check_every,
+                               compact=True)
+        assert torch.equal(info_c['niters'], info['niters'])
+        assert torch.allclose(X_c, X, rtol=1e-10, atol=1e-12)
+        assert info_c['n_system_matvecs'] < info['n_system_matvecs']
+        if check_every is None:
+            # K for the initial residual, then one per active iteration
+            assert (info_c['n_system_matvecs']
+                   == K + int(info['niters'].sum()))
+    print('---- cg_batch test passed! ----')
+
+
+def test_cg_batch_workspace():
+    K, n = 4, 15
+    Q = torch.randn(K, n, n, dtype=torch.double)
+    A = Q @ Q.transpose(1, 2) / n + 0.1 * torch.eye(n, dtype=torch.double)
+    workspace = CGWorkspace()
+    for check_every in [None, 5]:
+        B = torch.randn(K, n, 1, dtype=torch.double)
+        X, info = cg_batch(lambda X: A @ X, B, M_bmm=lambda X: 2 * X,
+                           rtol=1e-10, maxiter=100, check_every=check_every)
+        X_w, info_w = cg_batch(lambda X: A @ X, B, M_bmm=lambda X: 2 * X,
+                               rtol=1e-10, maxiter=100,
+                               check_every=check_every, workspace=workspace)
+        # bitwise identical iterates, converged to the dense solution
+        assert info_w['niter'] == info['niter']
+        assert torch.equal(info_w['niters'], info['niters'])
+        assert torch.equal(info_w['residual'], info['residual'])
+        assert torch.equal(X_w, X)
+        assert info_w['optimal']
+        assert torch.allclose(X_w, torch.linalg.solve(A, B), atol=1e-8)
+    # the second solve of the same shape reuses the buffers of the first
+    assert workspace.n_allocations == 1
+    print('---- cg_batch workspace test passed! ----')
+
+
+def test_cg_solve_gradients():
+    K, n = 3, 8
+    Q = torch.randn(K, n, n, dtype=torch.double)
+    A = Q @ Q.transpose(1, 2) / n + 0.5 * torch.eye(n, dtype=torch.double)
+    B = torch.randn(K, n, 2, dtype=torch.double, requires_grad=True)
+
+    def solve(B):
+        return cg_solve(lambda X: A @ X, B, M_bmm=lambda X: X / 2,
+                        rtol=1e-14, maxiter=200)
+
+    assert torch.autograd.gradcheck(solve, (B,))
+    assert torch.autograd.gradgradcheck(solve, (B,))
+    X = solve(B)
+    assert X.grad_fn is not None
+    assert torch.allclose(X, torch.linalg.solve(A, B))
+    print('---- cg_solve gradient test passed! ----')
+
+
+def test_krylov_recycler_saves_iterations():
+    K, n, rank = 6, 40, 5
+    # a few small eigenvalues make the solutions share their eigenvectors
+    Q = torch.linalg.qr(torch.randn(n, n, dtype=torch.double))[0]
+    eigenvalues = torch.cat([torch.logspace(-4, -2, rank, dtype=torch.double),
+                             torch.linspace(1, 10, n - rank,
+                                            dtype=torch.double)])
+    A = (Q * eigenvalues) @ Q.t()
+    E = torch.randn(n, n, dtype=torch.double)
+    E = 1e-5 * (E + E.t()) / torch.norm(E)
+    recycler = KrylovRecycler(rank=rank, measure_every=1)
+    cold_iters, recycled_iters = 0, 0
+    cold_matvecs, recycled_matvecs = 0, 0
+    for step in range(4):
+        A_step = A + step * E  # one optimizer step per batch
+        B = torch.randn(K, n, 1, dtype=torch.double)
+
+        def A_bmm(X):
+            return A_step @ X
+
+        X0, AX0, M_bmm = recycler.deflate(A_bmm, B)
+        X, info = cg_batch(A_bmm, B, M_bmm=M_bmm, X0=X0, AX0=AX0, rtol=0,
+                           atol=1e-8, maxiter=500)
+        _, info_cold = cg_batch(A_bmm, B, rtol=0, atol=1e-8, maxiter=500)
+        assert info['optimal'] and info_cold['optimal']
+        assert torch.norm(X - torch.linalg.solve(A_step, B)) < 1e-6
+        # A X0 is not computed again, A W takes one matvec per column of W
+        assert info['n_matvecs'] == info['niter'] + (step == 0)
+        assert recycler.deflation_matvecs == (rank if step > 0 else 0)
+        assert recycler.measuring() == (step > 0)
+        info['n_matvecs'] += recycler.deflation_matvecs
+        recycler.observe(X, info, info_cold if recycler.measuring() else None)
+        if step > 0:
+            assert torch.allclose(AX0, A_step @ X0)
+            cold_iters += info_cold['niter']
+            recycled_iters += info['niter']
+            cold_matvecs += info_cold['n_matvecs']
+            recycled_matvecs += info['n_matvecs']
+    assert recycled_iters < 0.7 * cold_iters
+    assert recycled_matvecs < 0.8 * cold_matvecs
+    assert recycler.n_measured == 3 and recycler.n_matvecs == 3 * rank
+    assert recycler.iterations_saved == cold_iters - recycled_iters
+    assert recycler.matvecs_saved == cold_matvecs - recycled_matvecs
+    print('---- Krylov recycler test passed! ----')
+
+
+def test_single_data_space_pass():
+    net = MNIST_FPN(lat_layers=2, contraction_factor=0.5)
+    net.train()
+    ref = copy.deepcopy(net)
+    d = torch.randn(4, 1, 28, 28)
+    n_calls = [0]
+    data_space_forward = net.data_space_forward
+
+    def counted_data_space_forward(d):
+        n_calls[0] += 1
+        return data_space_forward(d)
+
+    net.data_space_forward = counted_data_space_forward
+    torch.manual_seed(1)
+    y = net(d, eps=1.0e-4, max_depth=50)
+    y.sum().backward()
+    assert n_calls[0] == 1
+    assert int(net.bn_1.num_batches_tracked) == 1
+
+    # the former two passes: Q(d) without gradients for the solve, then again
+    torch.manual_seed(1)
+    with torch.no_grad():
+        Qd = ref.data_space_forward(d)
+        u = FixedPointSolver('picard')(ref, Qd, eps=1.0e-4, max_depth=50,
+                                       lip_normalize='after').u
+    Ru = ref.latent_space_forward(u, ref.data_space_forward(d))
+    y_ref = ref.map_latent_to_inference(Ru)
+    y_ref.sum().backward()
+    assert int(ref.bn_1.num_batches_tracked) == 2
+    assert torch.allclose(y, y_ref, rtol=1e-5, atol=1e-7)
+    for p, p_ref in zip(net.parameters(), ref.parameters()):
+        assert (p.grad is None) == (p_ref.grad is None)
+        if p.grad is not None:
+            assert torch.allclose(p.grad, p_ref.grad, rtol=1e-5, atol=1e-7)
+    print('---- single data space pass test passed! ----')
@@ -47,7 +47,25 @@ train_loader, test_loader = cifar_loaders(train_batch_size=batch_size,
                                           test_batch_size=test_batch_size,
                                           augment=True)
 
+# adjoint solver: 'cg' on the normal equations, or 'gmres' / 'bicgstab'
+# directly on the adjoint system (one vector-Jacobian product per matvec)
+linear_solver = 'cg'
+# preconditioner: None, 'shift', 'diagonal' (Hutchinson), 'nystrom' or an
+# instance, e.g. Preconditioners.TikhonovShift(1e-3, target_iters=20) for
+# an adaptive shift
+preconditioner = None
+# batches whose CG solve did not converge: 'skip', 'partial', 'jfb' or
+# 'shift' (retry with a larger shift)
+cg_fallback = 'skip'
+# rank of the subspace recycled from the adjoint solutions of the previous
+# batches to deflate the next CG solves (0: off)
+recycle_rank = 0
+
 # train network!
 T = train_Jacobian_based_net(T, max_epochs, lr_scheduler, train_loader,
                              test_loader, optimizer, criterion, num_classes,
-                             eps, max_depth, save_dir=save_dir, JTJ_shift=1e-1)
+                             eps, max_depth, save_dir=save_dir, JTJ_shift=1e-1,
+                             linear_solver=linear_solver,
+                             preconditioner=preconditioner,
+                             cg_fallback=cg_fallback,
+                             recycle_rank=recycle_rank)
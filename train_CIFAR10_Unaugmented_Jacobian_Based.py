@@ -4,6 +4,7 @@ import torch.optim as optim
 from prettytable import PrettyTable
 import time
 from BatchCG import cg_batch
+from FixedPointSolvers import LinearizedLatentOperator
 from time import sleep
 from tqdm import tqdm
 
@@ -34,21 +35,23 @@ def get_test_stats(net, data_loader, criterion, eps, max_depth):
     correct = 0
     net.eval()
     with torch.no_grad():
-        for d_test, labels in test_loader:
+        for d_test, labels in data_loader:
             labels = labels.to(device)
             d_test = d_test.to(device)
             batch_size = d_test.shape[0]
 
             Qd = net.data_space_forward(d_test)
-            y, depth = compute_fixed_point(T, Qd, max_depth, device, eps=eps)
+            y, depth = compute_fixed_point(net, Qd, max_depth, device,
+                                           eps=eps, solver=solver,
+                                           **solver_kwargs)
             S_Ru = net.map_latent_to_inference(y)
             test_loss += batch_size * criterion(S_Ru, labels).item()
 
             pred = S_Ru.argmax(dim=1, keepdim=True)
             correct += pred.eq(labels.view_as(pred)).sum().item()
 
-    test_loss /= len(test_loader.dataset)
-    test_acc = 100. * correct/len(test_loader.dataset)
+    test_loss /= len(data_loader.dataset)
+    test_acc = 100. * correct/len(data_loader.dataset)
 
     net.train()
 
@@ -70,6 +73,14 @@ T = CIFAR10_FPN_Unaugmented_Jacobian_Based(block=BasicBlock,
 T = T.to(device)
 eps = 1.0e-1
 max_depth = 50
+# fixed point solver: 'picard', 'relaxed', 'anderson', 'broyden',
+# 'multires' or a FixedPointSolvers.FixedPointSolver
+solver = 'picard'
+# e.g. {'memory': 10} for 'broyden'; add 'lip_estimator':
+# FixedPointSolvers.LipschitzEstimator() to normalize with power iteration
+# and 'lip_schedule': FixedPointSolvers.NormalizationSchedule(every=10) to
+# normalize only every 10 batches (or on weight drift / max_depth)
+solver_kwargs = {}
 
 # -----------------------------------------------------------------------------
 # Training settings
@@ -107,6 +118,8 @@ n_Umatvecs = []
 max_iter_cg = max_depth
 tol_cg = eps
 JTJ_shift = 1e-3
+# 'func' (torch.func) or 'autograd' matvecs, see LinearizedLatentOperator
+matvec_engine = 'func'
 save_dir = './'
 
 # save histories for testing data set
@@ -150,21 +163,24 @@ for epoch in range(max_epochs):
             # Find Fixed Point
             # -----------------------------------------------------------------
             train_batch_size = d.shape[0]  # re-define if batch size changes
+            # a single data space pass with gradients: the solve iterates on
+            # Qd.detach() and the backprop reuses Qd
+            T.train()
+            Qd = T.data_space_forward(d)
             with torch.no_grad():
-                Qd = T.data_space_forward(d)
-                u, depth = compute_fixed_point(T, Qd, max_depth, device,
-                                               eps=eps)
+                u, depth = compute_fixed_point(T, Qd.detach(), max_depth,
+                                               device, eps=eps,
+                                               solver=solver,
+                                               **solver_kwargs)
                 temp_max_depth = max(depth, temp_max_depth)
 
             # -----------------------------------------------------------------
             # Jacobian_Based Backprop
             # -----------------------------------------------------------------
-            T.train()
             optimizer.zero_grad()  # Initialize gradient to zero
 
             # compute output for backprop
             u.requires_grad = True
-            Qd = T.data_space_forward(d)
 
             Ru = T.latent_space_forward(u, Qd)
 
@@ -173,73 +189,25 @@ for epoch in range(max_epochs):
             train_loss = loss.detach().cpu().numpy() * train_batch_size
             loss_ave += train_loss
 
-            # compute rhs: = J * dldu = J * dS/du * dl/dS
+            # dldu = dS/du * dl/dS
             dldu = torch.autograd.grad(outputs=loss, inputs=Ru,
                                        retain_graph=True,
-                                       create_graph=True,
                                        only_inputs=True)[0]
-            dldu = dldu.detach()  # note: dldu here = dS/du * dl/dS
+            # vectorize channels (when R is a CNN) and unsqueeze for number
+            # of rhs. CG requires it to have dimensions
+            # n_samples x n_features x n_rh
+            dldu = dldu.detach().view(train_batch_size, -1, 1)
 
             # -----------------------------------------------------------------
-            # rhs = J^T * dldu = (I - dRdu^T) * dldu
+            # Normal equations x (J J^T + JTJ_shift I) = dldu J^T of the
+            # adjoint system x J = dldu, J = I - dRdu, with R linearized once
+            # for all CG iterations
             # -----------------------------------------------------------------
-            dRduT_dldu = torch.autograd.grad(outputs=Ru, inputs=u,
-                                             grad_outputs=dldu,
-                                             retain_graph=True,
-                                             create_graph=True,
-                                             only_inputs=True)[0]
-            rhs = dldu - dRduT_dldu
-            # -----------------------------------------------------------------
-
-            rhs = rhs.detach()
-            # vectorize channels (when R is a CNN)
-            rhs = rhs.view(train_batch_size, -1)
-            # unsqueeze for number of rhs. CG requires it
-            # to have dimensions n_samples x n_features x n_rh
-            rhs = rhs.unsqueeze(2)
+            operator = LinearizedLatentOperator(T, u, Qd, matvec_engine)
+            rhs = operator.vJT(dldu)
 
-            # -----------------------------------------------------------------
-            # Define JTJ matvec function
-            # -----------------------------------------------------------------
-            def JTJ_matvec(v, u=u, Ru=Ru):
-                # inputs:
-                # v = vector to be multiplied by
-                #     U = I - alpha*DS - (1-alpha)*DT) requires grad
-                # u = fixed point vector u
-                # (should be untracked and vectorized!) requires grad
-                # Ru = R applied to u (requires grad)
-
-                # assumes one rhs:
-                # x (n_samples, n_dim, n_rhs) -> (n_samples, n_dim)
-
-                v = v.squeeze(2)      # squeeze number of RHS
-                v = v.view(Ru.shape)  # reshape to filter space
-                v.requires_grad = True
-
-                # (dRdu)^T * v = JT * v
-                dRduT_mv = torch.autograd.grad(outputs=Ru, inputs=u,
-                                               grad_outputs=v,
-                                               retain_graph=True,
-                                               create_graph=True,
-                                               only_inputs=True)[0]
-                JTv = v - dRduT_mv
-
-                # compute J * JTv
-                # trick for computing J * (JTv):
-                # # take take derivative d(JTv)/dv * JTv = J * JTv
-                dRdu_JTv = torch.autograd.grad(outputs=JTv,
-                                               inputs=v,
-                                               grad_outputs=JTv.detach(),
-                                               retain_graph=True,
-                                               create_graph=True,
-                                               only_inputs=True)[0]
-                JJTv = JTv - dRdu_JTv  # J = I - dRdu
-                v = v.detach()
-                JTv = JTv.detach()
-                Amv = JJTv.detach()
-                Amv = Amv.view(Ru.shape[0], -1)
-                Amv = Amv.unsqueeze(2).detach()
-                return Amv + JTJ_shift*v.view(Amv.shape)
+            def JTJ_matvec(v):
+                return operator.vJJT(v, JTJ_shift)
 
             JTJinv_rhs, info = cg_batch(JTJ_matvec, rhs, M_bmm=None, X0=None,
                                         rtol=0, atol=tol_cg,
@@ -5,12 +5,14 @@ import time
 from tqdm import tqdm
 import torchvision.transforms as transforms
 from torchvision import datasets
-import numpy as np
-from BatchCG import cg_batch
+from BatchCG import cg_batch, gmres_batch, bicgstab_batch, CGWorkspace
+from FixedPointSolvers import make_solver, LinearizedLatentOperator
+from Preconditioners import TikhonovShift, NystromPreconditioner
+from Preconditioners import KrylovRecycler, make_preconditioner
 
 
 def get_stats(net, test_loader, criterion, num_classes: int, eps: float,
-              max_depth: int):
+              max_depth: int, depth_stats=None):
     test_loss = 0
     num_correct_labels = 0
 
@@ -28,6 +30,8 @@ def get_stats(net, test_loader, criterion, num_classes: int, eps: float,
                 ut[i, labels[i].cpu().numpy()] = 1.0
 
             y = net(d_test, eps=eps, max_depth=max_depth)
+            if depth_stats is not None:
+                depth_stats.update(getattr(net, 'solve_report', None))
 
             if str(criterion) == "MSELoss()":
                 batch_loss = criterion(y.double(), ut.double()).item()
@@ -57,14 +61,91 @@ def model_params(net):
     return table
 
 
+class DepthStats:
+    ''' Distribution of the fixed point solves over an epoch
+
+        update(report) adds the per-sample depths and final residuals of a
+        FixedPointSolvers.SolverResult (e.g. net.solve_report) and its solve
+        and normalization times. The tensors stay on their device until
+        summary() or histogram() is called, so collecting the statistics
+        does not synchronize every batch. A sample counts as capped if it
+        reached max_depth with a final residual above eps (or, without eps,
+        if it reached max_depth).
+    '''
+
+    def __init__(self, max_depth, eps=None):
+        self.max_depth = max_depth
+        self.eps = eps
+        self.depths = []
+        self.residuals = []
+        self.solve_time = 0.0
+        self.norm_time = 0.0
+        self.n_solves = 0
+
+    def update(self, report):
+        if report is None:
+            return
+        self.depths.append(report.depth.detach())
+        if report.residual is not None:
+            self.residuals.append(report.residual.detach())
+        self.solve_time += report.solve_time
+        self.norm_time += report.norm_time
+        self.n_solves += 1
+
+    def histogram(self):
+        ''' Number of samples that took 0, 1, ..., max_depth iterations '''
+        if not self.depths:
+            return torch.zeros(self.max_depth + 1, dtype=torch.long)
+        depths = torch.cat(self.depths).cpu().clamp(max=self.max_depth)
+        return torch.bincount(depths, minlength=self.max_depth + 1)
+
+    def summary(self):
+        ''' Depth quantiles, capped samples, residuals and times as a dict '''
+        if not self.depths:
+            return {}
+        depths = torch.cat(self.depths).cpu().double()
+        q = torch.quantile(depths, torch.tensor([0.5, 0.9, 0.99],
+                                                dtype=torch.double))
+        capped = depths >= self.max_depth
+        stats = {'n_samples': depths.numel(),
+                 'depth_mean': depths.mean().item(),
+                 'depth_p50': q[0].item(),
+                 'depth_p90': q[1].item(),
+                 'depth_p99': q[2].item(),
+                 'depth_max': depths.max().item(),
+                 'solve_time': self.solve_time,
+                 'norm_time': self.norm_time}
+        if len(self.residuals) == len(self.depths):
+            residuals = torch.cat(self.residuals).cpu().double()
+            stats['residual_max'] = residuals.max().item()
+            stats['residual_mean'] = residuals.mean().item()
+            if self.eps is not None:
+                capped = capped & (residuals > self.eps)
+        stats['capped'] = int(capped.sum())
+        return stats
+
+    def __str__(self):
+        stats = self.summary()
+        if not stats:
+            return 'depth: no solves'
+        fmt = 'depth: mean = {:5.1f}, p50/p90/p99/max = {:.0f}/{:.0f}/{:.0f}'
+        fmt += '/{:.0f}, capped = {:d}/{:d} | solve = {:5.1f} sec, '
+        fmt += 'normalize = {:5.1f} sec'
+        return fmt.format(stats['depth_mean'], stats['depth_p50'],
+                          stats['depth_p90'], stats['depth_p99'],
+                          stats['depth_max'], stats['capped'],
+                          stats['n_samples'], stats['solve_time'],
+                          stats['norm_time'])
+
+
 def train_class_net(net, max_epochs, lr_scheduler, train_loader,
                     test_loader, optimizer, criterion,
-                    num_classes, eps, max_depth, save_dir='./'):
+                    num_classes, eps, max_depth, save_dir='./',
+                    latent_cache=None, backward='jfb'):
 
     fmt = '[{:3d}/{:3d}]: train - ({:6.2f}%, {:6.2e}), test - ({:6.2f}%, '
     fmt += '{:6.2e}) | depth = {:4.1f} | lr = {:5.1e} | time = {:4.1f} sec'
 
-    depth_ave = 0.0
     train_acc = 0.0
     best_test_acc = 0.0
 
@@ -74,6 +155,7 @@ def train_class_net(net, max_epochs, lr_scheduler, train_loader,
     test_acc_hist = []
     train_loss_hist = []
     train_acc_hist = []
+    depth_stats_hist = []  # per-epoch summaries of the train/test solves
 
     print(net)
     print(model_params(net))
@@ -83,24 +165,30 @@ def train_class_net(net, max_epochs, lr_scheduler, train_loader,
         sleep(0.5)  # slows progress bar so it won't print on multiple lines
         loss_ave = 0.0
         epoch_start_time = time.time()
+        train_depth_stats = DepthStats(max_depth, eps)
+        test_depth_stats = DepthStats(max_depth, eps)
         tot = len(train_loader)
         with tqdm(total=tot, unit=" batch", leave=False, ascii=True) as tepoch:
 
             tepoch.set_description("[{:3d}/{:3d}]".format(epoch+1, max_epochs))
 
-            for _, (d, labels) in enumerate(train_loader):
+            for _, (d, labels, *sample_ids) in enumerate(train_loader):
                 labels = labels.to(net.device())
                 d = d.to(net.device())
                 batch_size = d.shape[0]
                 if net.name() == "MNIST_FCN":
                     d = d.view(d.size()[0], 784).to(net.device())
+                cache_kwargs = {}
+                if latent_cache is not None:
+                    cache_kwargs = {'cache': latent_cache,
+                                    'indices': sample_ids[0]}
                 # -------------------------------------------------------------
                 # Apply network to get fixed point and then backprop
                 # -------------------------------------------------------------
                 optimizer.zero_grad()
-                y = net(d, eps=eps, max_depth=max_depth)
-
-                depth_ave = 0.99 * depth_ave + 0.01 * net.depth
+                y = net(d, eps=eps, max_depth=max_depth, backward=backward,
+                        **cache_kwargs)
+                train_depth_stats.update(getattr(net, 'solve_report', None))
                 output = None
                 if str(criterion) == "MSELoss()":
                     ut = torch.zeros((batch_size, num_classes))
@@ -136,12 +224,18 @@ def train_class_net(net, max_epochs, lr_scheduler, train_loader,
                                                  criterion,
                                                  num_classes,
                                                  eps,
-                                                 max_depth)
+                                                 max_depth,
+                                                 test_depth_stats)
 
         test_loss_hist.append(test_loss)
         test_acc_hist.append(test_acc)
         train_loss_hist.append(loss_ave)
         train_acc_hist.append(train_acc)
+        depth_stats_hist.append(
+            {'train': train_depth_stats.summary(),
+             'test': test_depth_stats.summary(),
+             'train_histogram': train_depth_stats.histogram(),
+             'test_histogram': test_depth_stats.histogram()})
 
         epoch_end_time = time.time()
         time_epoch = epoch_end_time - epoch_start_time
@@ -150,9 +244,15 @@ def train_class_net(net, max_epochs, lr_scheduler, train_loader,
         total_time += time_epoch
 
         print(fmt.format(epoch+1, max_epochs, train_acc, loss_ave,
-                         test_acc, test_loss, depth_ave,
+                         test_acc, test_loss,
+                         depth_stats_hist[-1]['train'].get('depth_mean', 0.0),
                          optimizer.param_groups[0]['lr'],
                          time_epoch))
+        print('    train ' + str(train_depth_stats))
+        print('    test  ' + str(test_depth_stats))
+        lip_schedule = getattr(net, 'solver_kwargs', {}).get('lip_schedule')
+        if lip_schedule is not None:
+            print('    ' + str(lip_schedule))
         # ---------------------------------------------------------------------
         # Save weights
         # ---------------------------------------------------------------------
@@ -180,6 +280,7 @@ def train_class_net(net, max_epochs, lr_scheduler, train_loader,
                 'lr_scheduler': lr_scheduler,
                 'time_hist': time_hist,
                 'eps': eps,
+                'depth_stats_hist': depth_stats_hist,
             }
             file_name = save_dir + net.name() + '_history.pth'
             torch.save(state, file_name)
@@ -190,21 +291,40 @@ def train_class_net(net, max_epochs, lr_scheduler, train_loader,
     return net
 
 
-def mnist_loaders(train_batch_size, test_batch_size=None):
+class IndexedDataset(torch.utils.data.Dataset):
+    ''' Dataset wrapper that also yields the index of each sample
+
+        Batches then come as (d, labels, indices), which lets the trainers
+        key a FixedPointSolvers.LatentCache by sample.
+    '''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return (*self.dataset[index], index)
+
+
+def mnist_loaders(train_batch_size, test_batch_size=None, indexed=False):
     if test_batch_size is None:
         test_batch_size = train_batch_size
 
-    train_loader = train_loader = torch.utils.data.DataLoader(
-                        datasets.MNIST('data',
-                                       train=True,
-                                       download=True,
-                                       transform=transforms.Compose([
-                                        transforms.ToTensor(),
-                                        transforms.Normalize((0.1307,),
-                                                             (0.3081,))
-                                       ])),
-                        batch_size=train_batch_size,
-                        shuffle=True)
+    train_dataset = datasets.MNIST('data',
+                                   train=True,
+                                   download=True,
+                                   transform=transforms.Compose([
+                                    transforms.ToTensor(),
+                                    transforms.Normalize((0.1307,),
+                                                         (0.3081,))
+                                   ]))
+    if indexed:
+        train_dataset = IndexedDataset(train_dataset)
+    train_loader = torch.utils.data.DataLoader(train_dataset,
+                                               batch_size=train_batch_size,
+                                               shuffle=True)
     test_loader = torch.utils.data.DataLoader(
                         datasets.MNIST('data',
                                        train=False,
@@ -218,20 +338,23 @@ def mnist_loaders(train_batch_size, test_batch_size=None):
     return train_loader, test_loader
 
 
-def svhn_loaders(train_batch_size, test_batch_size=None):
+def svhn_loaders(train_batch_size, test_batch_size=None, indexed=False):
     if test_batch_size is None:
         test_batch_size = train_batch_size
 
     normalize = transforms.Normalize(mean=[0.4377, 0.4438, 0.4728],
                                      std=[0.1980, 0.2010, 0.1970])
-    train_loader = torch.utils.data.DataLoader(
-            datasets.SVHN(
+    train_dataset = datasets.SVHN(
                 root='data', split='train', download=True,
                 transform=transforms.Compose([
                     transforms.ToTensor(),
                     normalize
                 ]),
-            ),
+            )
+    if indexed:
+        train_dataset = IndexedDataset(train_dataset)
+    train_loader = torch.utils.data.DataLoader(
+            train_dataset,
             batch_size=train_batch_size, shuffle=True)
     test_loader = torch.utils.data.DataLoader(
         datasets.SVHN(
@@ -244,7 +367,8 @@ def svhn_loaders(train_batch_size, test_batch_size=None):
     return train_loader, test_loader
 
 
-def cifar_loaders(train_batch_size, test_batch_size=None, augment=True):
+def cifar_loaders(train_batch_size, test_batch_size=None, augment=True,
+                  indexed=False):
     if test_batch_size is None:
         test_batch_size = train_batch_size
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
@@ -270,6 +394,8 @@ def cifar_loaders(train_batch_size, test_batch_size=None, augment=True):
     test_dataset = datasets.CIFAR10('data',
                                     train=False,
                                     transform=trans_comp)
+    if indexed:
+        train_dataset = IndexedDataset(train_dataset)
     train_loader = torch.utils.data.DataLoader(train_dataset,
                                                batch_size=train_batch_size,
                                                shuffle=True, pin_memory=True)
@@ -282,54 +408,290 @@ def cifar_loaders(train_batch_size, test_batch_size=None, augment=True):
 # ------------------------------------------------------------------------------
 # Jacobian-based functions
 # ------------------------------------------------------------------------------
-def compute_fixed_point(T, Qd, max_depth, device, eps=1e-4):
+def compute_fixed_point(T, Qd, max_depth, device, eps=1e-4, solver='picard',
+                        cache=None, indices=None, **solver_kwargs):
 
-    depth = 0.0
-    u = torch.zeros(Qd.shape, device=T.device())
-    u_prev = np.Inf * torch.ones(u.shape, device=T.device())
+    # warm-start from cached fixed points when a LatentCache is given
+    u0 = None
+    if cache is not None:
+        u0 = cache.lookup(indices, Qd)
 
     # approximately normalize weights by lipschitz constant before
     # computing fixed point
-    T.normalize_lip_const(u, Qd)
     with torch.no_grad():
-        all_samp_conv = False
-        while not all_samp_conv and depth < max_depth:
-            u_prev = u.clone()
-            u = T.latent_space_forward(u, Qd)
-            depth += 1.0
-            all_samp_conv = torch.max(torch.norm(u - u_prev, dim=1)) <= eps
-    return u.detach(), depth
+        result = make_solver(solver, **solver_kwargs)(T, Qd, eps=eps,
+                                                      max_depth=max_depth,
+                                                      u0=u0,
+                                                      lip_normalize='before')
+    if cache is not None:
+        cache.store(indices, result.u)
+    T.solve_report = result
+    return result.u.detach(), float(result.depth.max())
+
+
+def solve_adjoint(u, Ru, loss, linear_solver='cg', tol=1.0e-3, maxiter=100,
+                  operator=None, preconditioner=None, workspace=None,
+                  recycler=None):
+    ''' Solve the adjoint system x J = dl/du with J = I - dR/du at the fixed
+        point u (which requires grad), where Ru = R(u, Qd) carries its graph
+
+        'cg' runs cg_batch on the normal equations x J J^T = dl/du J^T, which
+        squares the condition number of J. 'gmres' and 'bicgstab' solve
+        x J = dl/du directly with gmres_batch or bicgstab_batch and one
+        vector-Jacobian product per matvec. The matvecs use operator (a
+        FixedPointSolvers.LinearizedLatentOperator) if given, and otherwise
+        the graph of Ru, where a 'cg' matvec takes a create_graph double
+        backward. preconditioner (see Preconditioners.py) is updated with
+        the matvec before the solve, shifts it, preconditions it and
+        observes the result. workspace (a BatchCG.CGWorkspace) is passed to
+        cg_batch; the returned x is then one of its buffers. recycler (a
+        Preconditioners.KrylovRecycler) deflates the 'cg' solve and
+        observes the solution; its matvecs count in info['n_matvecs'], and
+        when it is measuring, the system is also solved cold to measure the
+        savings. Every sample is its own system; info['converged'] flags
+        the samples that reached the tolerance. Returns x in the shape of
+        Ru.
+    '''
+    if linear_solver not in ('cg', 'gmres', 'bicgstab'):
+        raise ValueError('Unknown linear solver: ' + str(linear_solver))
+    if recycler is not None and linear_solver != 'cg':
+        raise ValueError('Krylov recycling deflates the symmetric normal '
+                         'equations of linear_solver=\'cg\'')
+    batch_size = Ru.shape[0]
+
+    def solve(krylov, A_bmm, rhs):
+        M_bmm = None
+        if preconditioner is not None:
+            preconditioner.update(A_bmm, rhs)
+            A_bmm = preconditioner.shifted(A_bmm)
+            M_bmm = preconditioner.M_bmm
+        X0 = None
+        kwargs = {}
+        if krylov is cg_batch and workspace is not None:
+            kwargs['workspace'] = workspace
+        cold_M_bmm = M_bmm
+        if recycler is not None:
+            X0, kwargs['AX0'], M_bmm = recycler.deflate(A_bmm, rhs, M_bmm)
+        sol, info = krylov(A_bmm, rhs, M_bmm=M_bmm, X0=X0, rtol=0, atol=tol,
+                           maxiter=maxiter, **kwargs)
+        if preconditioner is not None:
+            preconditioner.observe(info)
+        if recycler is not None:
+            cold_info = None
+            if recycler.measuring():
+                # without the workspace, which holds sol
+                _, cold_info = krylov(A_bmm, rhs, M_bmm=cold_M_bmm, rtol=0,
+                                      atol=tol, maxiter=maxiter)
+            info['n_matvecs'] += recycler.deflation_matvecs
+            recycler.observe(sol, info, cold_info)
+        return sol.view(Ru.shape), info
+
+    if operator is not None or linear_solver != 'cg':
+        dldu = torch.autograd.grad(outputs=loss, inputs=Ru,
+                                   retain_graph=True, only_inputs=True)[0]
+        dldu = dldu.detach().view(batch_size, -1, 1)
+        if linear_solver == 'cg':
+            return solve(cg_batch, operator.vJJT, operator.vJT(dldu))
+        krylov = {'gmres': gmres_batch, 'bicgstab': bicgstab_batch}
+        if operator is not None:
+            return solve(krylov[linear_solver], operator.vJ, dldu)
+
+        def v_J_matvec(v):
+            # v (n_samples, n_dim, 1) -> v*J = v - v*dRdu (n_samples, n_dim, 1)
+            v = v.view(Ru.shape)
+            v_dRdu = torch.autograd.grad(outputs=Ru, inputs=u,
+                                         grad_outputs=v, retain_graph=True,
+                                         only_inputs=True)[0]
+            return (v - v_dRdu).view(batch_size, -1, 1)
+
+        return solve(krylov[linear_solver], v_J_matvec, dldu)
+
+    # ---------------------------------------------------------------------
+    # compute rhs = dldu * J^T
+    # ---------------------------------------------------------------------
+
+    # dldu = dl/dS * dS/du
+    dldu = torch.autograd.grad(outputs=loss, inputs=Ru,
+                               retain_graph=True,
+                               create_graph=True,
+                               only_inputs=True)[0]
+
+    # compute dldu * J
+    dldu_dRdu = torch.autograd.grad(outputs=Ru, inputs=u,
+                                    grad_outputs=dldu,
+                                    retain_graph=True,
+                                    create_graph=True,
+                                    only_inputs=True)[0]
+    dldu_J = dldu - dldu_dRdu
+
+    # autograd trick: d(v*J)/v * v = v * J^T
+    dldu_JT = torch.autograd.grad(outputs=dldu_J, inputs=dldu,
+                                  grad_outputs=dldu,
+                                  retain_graph=True,
+                                  create_graph=True,
+                                  only_inputs=True)[0]
+    rhs = dldu_JT
+
+    rhs = rhs.detach()
+    # vectorize channels (when R is a CNN)
+    rhs = rhs.view(batch_size, -1)
+    # CG requires it to have dims: n_samples x n_features x n_rh
+    rhs = rhs.unsqueeze(2)  # unsqueeze for number of rhs.
+
+    # ---------------------------------------------------------------------
+    # Define JJT matvec function
+    # ---------------------------------------------------------------------
+
+    def v_JJT_matvec(v, u=u, Ru=Ru):
+        # inputs:
+        # v = vector to be multiplied by JJT
+        # u = fixed point vector u (requires grad)
+        # Ru = R applied to u (requires grad)
+
+        # assumes one rhs:
+        # x (n_samples, n_dim, n_rhs) -> (n_samples, n_dim)
+
+        v = v.squeeze(2)      # squeeze number of RHS
+        v = v.view(Ru.shape)  # reshape to filter space
+        v.requires_grad = True
+
+        # compute v*J = v*(I - dRdu)
+        v_dRdu = torch.autograd.grad(outputs=Ru, inputs=u,
+                                     grad_outputs=v,
+                                     retain_graph=True,
+                                     create_graph=True,
+                                     only_inputs=True)[0]
+        v_J = v - v_dRdu
+
+        # compute v_JJT
+        v_JJT = torch.autograd.grad(outputs=v_J, inputs=v,
+                                    grad_outputs=v_J,
+                                    retain_graph=True,
+                                    create_graph=True,
+                                    only_inputs=True)[0]
+
+        v = v.detach()
+        v_J = v_J.detach()
+        Amv = v_JJT.detach()
+        Amv = Amv.view(Ru.shape[0], -1)
+        Amv = Amv.unsqueeze(2).detach()
+        return Amv
+
+    return solve(cg_batch, v_JJT_matvec, rhs)
+
+
+CG_FALLBACKS = ('skip', 'partial', 'jfb', 'shift')
+
+
+def adjoint_fallback(u, Ru, loss, sol, info, cg_fallback='skip',
+                     retry_shift=1.0e-2, **solve_kwargs):
+    ''' The adjoint solution to use after solve_adjoint did not converge
+
+        'skip' returns None (the batch is skipped), 'partial' the partial
+        Krylov solution, 'jfb' replaces the solution of every unconverged
+        sample by dl/du (its JFB gradient) and 'shift' solves again with
+        the shift of the preconditioner raised to max(retry_shift,
+        10 shift) and keeps the partial solution of that retry. solve_kwargs
+        are the arguments of solve_adjoint. Returns (sol, info).
+    '''
+    if cg_fallback not in CG_FALLBACKS:
+        raise ValueError('Unknown CG fallback: ' + str(cg_fallback)
+                         + ', choose from ' + str(CG_FALLBACKS))
+    if cg_fallback == 'skip':
+        return None, info
+    if cg_fallback == 'shift':
+        preconditioner = solve_kwargs.pop('preconditioner', None)
+        if preconditioner is None:
+            preconditioner = TikhonovShift()
+        shift = preconditioner.shift
+        preconditioner.shift = max(retry_shift, 10 * shift)
+        try:
+            return solve_adjoint(u, Ru, loss, preconditioner=preconditioner,
+                                 **solve_kwargs)
+        finally:
+            preconditioner.shift = shift
+    if cg_fallback == 'jfb':
+        dldu = torch.autograd.grad(outputs=loss, inputs=Ru,
+                                   retain_graph=True, only_inputs=True)[0]
+        converged = info['converged'].view(-1, *[1] * (Ru.dim() - 1))
+        sol = torch.where(converged, sol, dldu)
+    return sol, info
 
 
 def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
                              test_loader, optimizer, criterion,
                              num_classes, eps, max_depth, save_dir='./',
-                             JTJ_shift=0.0):
+                             JTJ_shift=0.0, solver='picard',
+                             solver_kwargs=None, latent_cache=None,
+                             linear_solver='cg', matvec_engine='func',
+                             preconditioner=None, cg_fallback='skip',
+                             retry_shift=1.0e-2, recycle_rank=0):
+    ''' Jacobian-based training: the gradient dl/du J^{-1} dR/dtheta with
+        J = I - dR/du, where the adjoint system is solved by solve_adjoint
+        with linear_solver 'cg' (normal equations), 'gmres' or 'bicgstab'
+
+        matvec_engine 'func' or 'autograd' linearizes R once per batch with
+        a LinearizedLatentOperator; None takes the matvecs from the graph of
+        the batch, with a create_graph double backward per 'cg' matvec.
+
+        preconditioner is None, a name registered in Preconditioners.py
+        ('shift', 'diagonal' or 'nystrom', created with shift=JTJ_shift) or
+        a preconditioner instance. JTJ_shift only applies to a preconditioner
+        given by name: without a preconditioner the adjoint system is solved
+        unshifted, and preconditioner='shift' gives a fixed Tikhonov shift
+        of JTJ_shift.
+
+        cg_fallback selects what a batch whose adjoint solve did not
+        converge contributes (see adjoint_fallback): 'skip' (no optimizer
+        step), 'partial', 'jfb' or 'shift' (retry with retry_shift).
+
+        recycle_rank > 0 deflates every 'cg' adjoint solve with a
+        KrylovRecycler of that rank, built from the solutions of the
+        previous batches; every 20th deflated solve is also solved cold to
+        measure the savings.
+    '''
 
     avg_time = 0.0
     total_time = 0.0
     time_hist = []
     n_Umatvecs = []
+    solver_kwargs = solver_kwargs or {}
     max_iter_cg = max_depth
     tol_cg = eps
+    if isinstance(preconditioner, str):
+        preconditioner = make_preconditioner(preconditioner, shift=JTJ_shift)
+    workspace = CGWorkspace()  # CG buffers reused by every batch
+    recycler = KrylovRecycler(rank=recycle_rank) if recycle_rank else None
+    if isinstance(preconditioner, NystromPreconditioner) and \
+            linear_solver != 'cg':
+        raise ValueError('The Nystrom preconditioner needs the symmetric '
+                         'normal equations of linear_solver=\'cg\'')
+    if recycle_rank and linear_solver != 'cg':
+        raise ValueError('Krylov recycling deflates the symmetric normal '
+                         'equations of linear_solver=\'cg\'')
 
-    depth_ave = 0.0
     best_test_acc = 0.0
     train_acc = 0.0
 
     test_loss_hist = []   # test loss history array
     test_acc_hist = []    # test accuracy history array
     depth_test_hist = []  # test depths history array
+    depth_stats_hist = []  # per-epoch summaries of the train/test solves
+    cg_iters_hist = []    # per-epoch lists of the CG iterations per batch
+    cg_fallback_hist = []  # per-epoch counts of skipped / fallback batches
     train_loss_hist = []  # train loss history array
     train_acc_hist = []   # train accuracy history array
 
     fmt = '[{:4d}/{:4d}]: train acc = {:5.2f}% | train_loss = {:7.3e} | '
     fmt += ' test acc = {:5.2f}% | test loss = {:7.3e} | '
     fmt += 'depth = {:5.1f} | lr = {:5.1e} | time = {:4.1f} sec | n_Umatvecs '
-    fmt += '= {:4d} | cg = {:7.3e}'
+    fmt += '= {:4d} | cg = {:7.3e} | unconverged = {:4d}'
+    cg_fmt = '    cg iters/batch: mean {:.1f}, p90 {:.0f}, max {:d} | '
+    cg_fmt += 'unconverged batches: skipped {:d}, fallback ({:s}) {:d}'
     print(net)                 # display Tnet configuration
     print(model_params(net))   # display Tnet parameters
-    print('\nTraining Jacobian-based Network')
+    print('\nTraining Jacobian-based Network, linear solver = '
+          + linear_solver)
 
     for epoch in range(max_epochs):
 
@@ -337,40 +699,55 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
         tot = len(train_loader)
         temp_n_Umatvecs = 0  # XXX - return and explain
         cg_iters = 0
+        n_unconverged = 0  # samples whose adjoint solve did not converge
+        batch_cg_iters = []
+        n_skipped = 0   # batches without an optimizer step
+        n_fallback = 0  # batches updated with the cg_fallback gradient
         start_time_epoch = time.time()
         temp_max_depth = 0
+        train_depth_stats = DepthStats(max_depth, eps)
+        test_depth_stats = DepthStats(max_depth, eps)
         loss_ave = 0.0
         with tqdm(total=tot, unit=" batch", leave=False, ascii=True) as tepoch:
 
             tepoch.set_description("[{:3d}/{:3d}]".format(epoch+1, max_epochs))
 
-            for idx, (d, labels) in enumerate(train_loader):
+            for idx, (d, labels, *sample_ids) in enumerate(train_loader):
                 labels = labels.to(net.device())
                 d = d.to(net.device())
+                cache_kwargs = {}
+                if latent_cache is not None:
+                    cache_kwargs = {'cache': latent_cache,
+                                    'indices': sample_ids[0]}
 
                 # --------------------------------------------------------------
                 # Find Fixed Point
                 # --------------------------------------------------------------
                 train_batch_size = d.shape[0]  # redefine if batch size changes
                 # u0 = torch.zeros((train_batch_size, lat_dim)).to(device)
+                # a single data space pass with gradients: the solve
+                # iterates on Qd.detach() and the backprop reuses Qd, so
+                # the BatchNorm running statistics are updated once
+                net.train()
+                Qd = net.data_space_forward(d)
                 with torch.no_grad():
-                    Qd = net.data_space_forward(d)
-                    u, depth = compute_fixed_point(net, Qd, max_depth,
-                                                   net.device(), eps=eps)
+                    u, depth = compute_fixed_point(net, Qd.detach(), max_depth,
+                                                   net.device(), eps=eps,
+                                                   solver=solver,
+                                                   **cache_kwargs,
+                                                   **solver_kwargs)
 
-                    depth_ave = 0.99 * depth_ave + 0.01 * net.depth
+                    train_depth_stats.update(net.solve_report)
 
                     temp_max_depth = max(depth, temp_max_depth)
 
                 # -------------------------------------------------------------
                 # Jacobian_Based Backprop
                 # -------------------------------------------------------------
-                net.train()
                 optimizer.zero_grad()  # Initialize gradient to zero
 
                 # compute output for backprop
                 u.requires_grad = True
-                Qd = net.data_space_forward(d)
 
                 Ru = net.latent_space_forward(u, Qd)
                 S_Ru = net.map_latent_to_inference(Ru)
@@ -378,91 +755,40 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
                 train_loss = loss.detach().cpu().numpy() * train_batch_size
                 loss_ave += train_loss
 
-                # -------------------------------------------------------------
-                # compute rhs = dldu * J^T
-                # -------------------------------------------------------------
-
-                # dldu = dl/dS * dS/du
-                dldu = torch.autograd.grad(outputs=loss, inputs=Ru,
-                                           retain_graph=True,
-                                           create_graph=True,
-                                           only_inputs=True)[0]
-
-                # compute dldu * J
-                dldu_dRdu = torch.autograd.grad(outputs=Ru, inputs=u,
-                                                grad_outputs=dldu,
-                                                retain_graph=True,
-                                                create_graph=True,
-                                                only_inputs=True)[0]
-                dldu_J = dldu - dldu_dRdu
-
-                # autograd trick: d(v*J)/v * v = v * J^T
-                dldu_JT = torch.autograd.grad(outputs=dldu_J, inputs=dldu,
-                                              grad_outputs=dldu,
-                                              retain_graph=True,
-                                              create_graph=True,
-                                              only_inputs=True)[0]
-                rhs = dldu_JT
-
-                rhs = rhs.detach()
-                # vectorize channels (when R is a CNN)
-                rhs = rhs.view(train_batch_size, -1)
-                # CG requires it to have dims: n_samples x n_features x n_rh
-                rhs = rhs.unsqueeze(2)  # unsqueeze for number of rhs.
-
-                # -------------------------------------------------------------
-                # Define JJT matvec function
-                # -------------------------------------------------------------
-
-                def v_JJT_matvec(v, u=u, Ru=Ru):
-                    # inputs:
-                    # v = vector to be multiplied by JJT
-                    # u = fixed point vector u (requires grad)
-                    # Ru = R applied to u (requires grad)
-
-                    # assumes one rhs:
-                    # x (n_samples, n_dim, n_rhs) -> (n_samples, n_dim)
-
-                    v = v.squeeze(2)      # squeeze number of RHS
-                    v = v.view(Ru.shape)  # reshape to filter space
-                    v.requires_grad = True
-
-                    # compute v*J = v*(I - dRdu)
-                    v_dRdu = torch.autograd.grad(outputs=Ru, inputs=u,
-                                                 grad_outputs=v,
-                                                 retain_graph=True,
-                                                 create_graph=True,
-                                                 only_inputs=True)[0]
-                    v_J = v - v_dRdu
-
-                    # compute v_JJT
-                    v_JJT = torch.autograd.grad(outputs=v_J, inputs=v,
-                                                grad_outputs=v_J,
-                                                retain_graph=True,
-                                                create_graph=True,
-                                                only_inputs=True)[0]
-
-                    v = v.detach()
-                    v_J = v_J.detach()
-                    Amv = v_JJT.detach()
-                    Amv = Amv.view(Ru.shape[0], -1)
-                    Amv = Amv.unsqueeze(2).detach()
-                    return Amv
-
-                normal_eq_sol, info = cg_batch(v_JJT_matvec, rhs, M_bmm=None,
-                                               X0=None, rtol=0, atol=tol_cg,
-                                               maxiter=max_iter_cg,
-                                               verbose=False)
-                # JTJinv_v has size (batch_size x n_hidden_features)
-                # n_rhs is squeezed
-                normal_eq_sol = normal_eq_sol.squeeze(2)
-                normal_eq_sol = normal_eq_sol.view(Ru.shape)
+                operator = None
+                if matvec_engine is not None:
+                    operator = LinearizedLatentOperator(net, u, Qd,
+                                                        matvec_engine)
+                normal_eq_sol, info = solve_adjoint(u, Ru, loss,
+                                                    linear_solver, tol_cg,
+                                                    max_iter_cg, operator,
+                                                    preconditioner, workspace,
+                                                    recycler)
 
                 temp_n_Umatvecs += info['niter'] * train_batch_size
                 cg_iters += info['niter']
-
-                if info['optimal']:
-                    # avoid updating "bad batches", update when CG converges
+                batch_cg_iters.append(info['niter'])
+                n_unconverged += int((~info['converged']).sum())
+
+                if not info['optimal']:
+                    normal_eq_sol, info_fallback = adjoint_fallback(
+                        u, Ru, loss, normal_eq_sol, info, cg_fallback,
+                        retry_shift, linear_solver=linear_solver, tol=tol_cg,
+                        maxiter=max_iter_cg, operator=operator,
+                        preconditioner=preconditioner, workspace=workspace,
+                        recycler=recycler)
+                    if info_fallback is not info:
+                        temp_n_Umatvecs += (info_fallback['niter']
+                                            * train_batch_size)
+                        cg_iters += info_fallback['niter']
+                    if normal_eq_sol is None:
+                        n_skipped += 1
+                    else:
+                        n_fallback += 1
+
+                if normal_eq_sol is not None:
+                    # with cg_fallback='skip', "bad batches" (where CG did
+                    # not converge) are not updated
 
                     # compute dTdtheta
                     # Ru = Ru.view(train_batch_size, -1)
@@ -497,7 +823,8 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
 
         # compute test loss and accuracy
         test_loss, test_acc, correct = get_stats(net, test_loader, criterion,
-                                                 10, eps, max_depth)
+                                                 10, eps, max_depth,
+                                                 test_depth_stats)
         # test_loss, test_acc, correct = get_stats_Jacobian(net, test_loader,
         # criterion, eps, max_depth)
 
@@ -511,12 +838,20 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
         total_time += time_epoch
         avg_time /= total_time/(epoch+1)
         n_Umatvecs.append(temp_n_Umatvecs)
+        cg_iters_hist.append(batch_cg_iters)
+        cg_fallback_hist.append({'skipped': n_skipped,
+                                 'fallback': n_fallback})
 
         test_loss_hist.append(test_loss)
         test_acc_hist.append(test_acc)
         train_loss_hist.append(loss_ave)
         train_acc_hist.append(train_acc)
         depth_test_hist.append(net.depth)
+        depth_stats_hist.append(
+            {'train': train_depth_stats.summary(),
+             'test': test_depth_stats.summary(),
+             'train_histogram': train_depth_stats.histogram(),
+             'test_histogram': test_depth_stats.histogram()})
 
         # ---------------------------------------------------------------------
         # Print outputs to console
@@ -525,7 +860,22 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
         print(fmt.format(epoch+1, max_epochs, train_acc, loss_ave,
                          test_acc, test_loss, temp_max_depth,
                          optimizer.param_groups[0]['lr'],
-                         time_epoch, temp_n_Umatvecs, cg_iters))
+                         time_epoch, temp_n_Umatvecs, cg_iters,
+                         n_unconverged))
+        print('    train ' + str(train_depth_stats))
+        print('    test  ' + str(test_depth_stats))
+        if batch_cg_iters:
+            iters = torch.tensor(batch_cg_iters, dtype=torch.float)
+            print(cg_fmt.format(float(iters.mean()),
+                                float(torch.quantile(iters, 0.9)),
+                                max(batch_cg_iters), n_skipped, cg_fallback,
+                                n_fallback))
+        if preconditioner is not None:
+            print('    ' + str(preconditioner))
+        if recycler is not None:
+            print('    ' + str(recycler))
+        if 'lip_schedule' in solver_kwargs:
+            print('    ' + str(solver_kwargs['lip_schedule']))
 
         # ---------------------------------------------------------------------
         # Save weights
@@ -558,11 +908,27 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
                 'n_Umatvecs': n_Umatvecs,
                 'time_hist': time_hist,
                 'tol_cg': tol_cg,
+                'linear_solver': linear_solver,
+                'matvec_engine': matvec_engine,
+                'cg_iters_hist': cg_iters_hist,
+                'cg_fallback': cg_fallback,
+                'cg_fallback_hist': cg_fallback_hist,
+                'recycle_rank': recycle_rank,
+                'recycled_iterations_saved': (recycler.iterations_saved
+                                              if recycler is not None
+                                              else 0.0),
+                'recycled_matvecs_saved': (recycler.matvecs_saved
+                                           if recycler is not None
+                                           else 0.0),
+                'recycled_measured_solves': (recycler.n_measured
+                                             if recycler is not None
+                                             else 0),
                 'eps': eps,
                 'net_state_dict': net.state_dict(),
                 'test_loss_hist': test_loss_hist,
                 'test_acc_hist': test_acc_hist,
-                'depth_test_hist': depth_test_hist
+                'depth_test_hist': depth_test_hist,
+                'depth_stats_hist': depth_stats_hist
             }
             file_name = save_dir + net.name() + '_history.pth'
             torch.save(state, file_name)
@@ -574,20 +940,22 @@ def train_Jacobian_based_net(net, max_epochs, lr_scheduler, train_loader,
 def train_Neumann_FPN_net(net, max_epochs, lr_scheduler, train_loader,
                           test_loader, optimizer, criterion,
                           num_classes, eps, max_depth, save_dir='./',
-                          neumann_order=0):
+                          neumann_order=0, solver='picard',
+                          solver_kwargs=None, latent_cache=None):
 
     avg_time = 0.0
     total_time = 0.0
     time_hist = []
     n_Umatvecs = []
+    solver_kwargs = solver_kwargs or {}
 
-    depth_ave = 0.0
     best_test_acc = 0.0
     train_acc = 0.0
 
     test_loss_hist = []   # test loss history array
     test_acc_hist = []    # test accuracy history array
     depth_test_hist = []  # test depths history array
+    depth_stats_hist = []  # per-epoch summaries of the train/test solves
     train_loss_hist = []  # train loss history array
     train_acc_hist = []   # train accuracy history array
 
@@ -607,38 +975,49 @@ def train_Neumann_FPN_net(net, max_epochs, lr_scheduler, train_loader,
         cg_iters = 0
         start_time_epoch = time.time()
         temp_max_depth = 0
+        train_depth_stats = DepthStats(max_depth, eps)
+        test_depth_stats = DepthStats(max_depth, eps)
         loss_ave = 0.0
         with tqdm(total=tot, unit=" batch", leave=False, ascii=True) as tepoch:
 
             tepoch.set_description("[{:3d}/{:3d}]".format(epoch+1, max_epochs))
 
-            for idx, (d, labels) in enumerate(train_loader):
+            for idx, (d, labels, *sample_ids) in enumerate(train_loader):
                 labels = labels.to(net.device())
                 d = d.to(net.device())
+                cache_kwargs = {}
+                if latent_cache is not None:
+                    cache_kwargs = {'cache': latent_cache,
+                                    'indices': sample_ids[0]}
 
                 # -------------------------------------------------------------
                 # Find Fixed Point
                 # -------------------------------------------------------------
                 train_batch_size = d.shape[0]  # redefine if batch size changes
 
+                # a single data space pass with gradients: the solve
+                # iterates on Qd.detach() and the backprop reuses Qd, so
+                # the BatchNorm running statistics are updated once
+                net.train()
+                Qd = net.data_space_forward(d)
                 with torch.no_grad():
-                    Qd = net.data_space_forward(d)
-                    u, depth = compute_fixed_point(net, Qd, max_depth,
-                                                   net.device(), eps=eps)
+                    u, depth = compute_fixed_point(net, Qd.detach(), max_depth,
+                                                   net.device(), eps=eps,
+                                                   solver=solver,
+                                                   **cache_kwargs,
+                                                   **solver_kwargs)
 
-                    depth_ave = 0.99 * depth_ave + 0.01 * net.depth
+                    train_depth_stats.update(net.solve_report)
 
                     temp_max_depth = max(depth, temp_max_depth)
 
                 # -------------------------------------------------------------
                 # Jacobian_Based Backprop
                 # -------------------------------------------------------------
-                net.train()
                 optimizer.zero_grad()  # Initialize gradient to zero
 
                 # compute output for backprop
                 u.requires_grad = True
-                Qd = net.data_space_forward(d)
 
                 Ru = net.latent_space_forward(u, Qd)
                 S_Ru = net.map_latent_to_inference(Ru)
@@ -704,7 +1083,8 @@ def train_Neumann_FPN_net(net, max_epochs, lr_scheduler, train_loader,
 
         # compute test loss and accuracy
         test_loss, test_acc, correct = get_stats(net, test_loader, criterion,
-                                                 10, eps, max_depth)
+                                                 10, eps, max_depth,
+                                                 test_depth_stats)
 
         end_time_epoch = time.time()
         time_epoch = end_time_epoch - start_time_epoch
@@ -722,6 +1102,11 @@ def train_Neumann_FPN_net(net, max_epochs, lr_scheduler, train_loader,
         train_loss_hist.append(loss_ave)
         train_acc_hist.append(train_acc)
         depth_test_hist.append(net.depth)
+        depth_stats_hist.append(
+            {'train': train_depth_stats.summary(),
+             'test': test_depth_stats.summary(),
+             'train_histogram': train_depth_stats.histogram(),
+             'test_histogram': test_depth_stats.histogram()})
 
         # ---------------------------------------------------------------------
         # Print outputs to console
@@ -731,6 +1116,10 @@ def train_Neumann_FPN_net(net, max_epochs, lr_scheduler, train_loader,
                          test_acc, test_loss, temp_max_depth,
                          optimizer.param_groups[0]['lr'],
                          time_epoch, temp_n_Umatvecs, cg_iters))
+        print('    train ' + str(train_depth_stats))
+        print('    test  ' + str(test_depth_stats))
+        if 'lip_schedule' in solver_kwargs:
+            print('    ' + str(solver_kwargs['lip_schedule']))
 
         # ---------------------------------------------------------------------
         # Save weights
@@ -766,7 +1155,8 @@ def train_Neumann_FPN_net(net, max_epochs, lr_scheduler, train_loader,
                 'net_state_dict': net.state_dict(),
                 'test_loss_hist': test_loss_hist,
                 'test_acc_hist': test_acc_hist,
-                'depth_test_hist': depth_test_hist
+                'depth_test_hist': depth_test_hist,
+                'depth_stats_hist': depth_stats_hist
             }
             file_name = save_dir + net.name() + '_history.pth'
             torch.save(state, file_name)